@@ -7,14 +7,103 @@ import logging
 import csv
 import json
 import requests
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import StringIO
-from world_population import WorldOMeters
+import numpy
+from world_population import DEFAULT_POPULATION_MAX_AGE, WorldOMeters
+from columnar import ColumnarRecords, top_by_column
+from location_index import LocationIndex
+from incremental import IncrementalState, population_digest
+from output_tags import input_hash
+from rollup import CountryRollup
+from rankings import Rankings
+from derived import DerivedMetrics
+from lod import DEFAULT_LOD_LEVEL, LodIndex
+from combined import COMBINED_VERSION, CombinedOutput
+from snapshots import SnapshotStore
+from query import generate_lookup
+from download_cache import DEFAULT_TIMEOUT, create_session, open_url_stream, text_lines
+from metrics import StageMetrics, TimedIterator
 import utils
+import hashlib
+import os
 import sys
 
 # TODO: The file only uses time_series data sources, maybe we should make it
 # explicit in the functions, for later we may support more data source types
 
+METRICS = ["confirmed", "deaths", "recovered"]
+# Part of the input hash of the outputs, it must be increased when a code change alters them
+OUTPUTS_VERSION = 1
+
+# The time series files by name, with the helper attributes of their contents and URL
+TIME_SERIES = {
+    "Global Confirmed": ("global_confirmed_dataset", "global_confirmed_url"),
+    "Global Deaths": ("global_deaths_dataset", "global_deaths_url"),
+    "Global Recovered": ("global_recovered_dataset", "global_recovered_url"),
+    "US Confirmed": ("us_confirmed_dataset", "us_confirmed_url"),
+    "US Deaths": ("us_deaths_dataset", "us_deaths_url"),
+}
+# The time series files each metric is generated from
+METRIC_SOURCES = {
+    "confirmed": ["Global Confirmed", "US Confirmed"],
+    "deaths": ["Global Deaths", "US Deaths"],
+    "recovered": ["Global Recovered"],
+}
+
+# The helper of a worker process, set once per worker by init_metric_worker
+_worker_helper = None
+
+
+def init_metric_worker(helper):
+    """
+    Keeps the helper in the worker process, with the fork start method it's inherited
+    without pickling, otherwise it's pickled once per worker instead of once per task.
+    """
+    global _worker_helper
+    _worker_helper = helper
+
+
+def process_metric_in_worker(metric):
+    """
+    Runs the process_<metric> of the worker helper
+    :param metric str: One of METRICS
+    :returns dict: The "date_keys" of the processed metric, the "metrics" recorded, the
+             "staged_files" of its outputs to be committed by the parent, and the
+             "output_tags" and local "source_files" fingerprints to be saved by the parent
+    """
+    # Each metric is checked on its own, the checks between metrics are done by
+    # the parent in a fixed order so the result doesn't depend on the scheduling,
+    # the outputs are only renamed into place by the parent once they passed them
+    _worker_helper.date_keys = []
+    _worker_helper.metrics = StageMetrics()
+    _worker_helper.staged_files = []
+    if _worker_helper.output_tags is not None:
+        _worker_helper.output_tags.completed = dict()
+    getattr(_worker_helper, "process_{}".format(metric))()
+    res = dict()
+    res["date_keys"] = _worker_helper.date_keys
+    res["metrics"] = _worker_helper.metrics
+    res["staged_files"] = _worker_helper.staged_files
+    res["output_tags"] = dict()
+    if _worker_helper.output_tags is not None:
+        res["output_tags"] = _worker_helper.output_tags.completed
+    res["source_files"] = dict()
+    if _worker_helper.local_source is not None:
+        res["source_files"] = _worker_helper.local_source.files
+    return res
+
+
+def csv_lines(content):
+    """
+    Returns the lines of a file for the csv module
+    :param content: The downloaded bytes, or an iterable of text lines such as the text_lines of a stream
+    """
+    if isinstance(content, bytes):
+        return StringIO(content.decode())
+    return content
+
 
 class CSSEGISandData:
     """
@@ -22,7 +111,7 @@ class CSSEGISandData:
     It's used to transform it into arrays/objects in javascript for the ThreeJS javascript code
     """
 
-    def __init__(self, logger, USFileType=False, offset_dates=None, forceProcessUS=False):
+    def __init__(self, logger, USFileType=False, offset_dates=None, forceProcessUS=False, engine="dict"):
         """
         Sets up initial variables on the source of the data
         :param logger: The logger object
@@ -30,6 +119,7 @@ class CSSEGISandData:
         :param offset_dates int: Index in the header_array where the dates start
                (i.e. "Day1" in the example above, would mean offset_dates: 4)
         :param forceProcessUS bool: Mark the records as needing to be forcefully processed or not
+        :param engine str: "dict" builds a dict per location-day, "numpy" builds ColumnarRecords
         """
         self.logger = logging.getLogger("CSSEGISandData")
         self.USFileType = USFileType
@@ -49,6 +139,9 @@ class CSSEGISandData:
                 "Overriding the first date column to be: %s", offset_dates)
             self.offset_dates = offset_dates
         self.forceProcessUS = forceProcessUS
+        if engine not in ("dict", "numpy"):
+            raise ValueError("Unknown parsing engine: {}".format(engine))
+        self.engine = engine
         self.date_keys = []
 
     def parse_header(self, header_array):
@@ -69,19 +162,15 @@ class CSSEGISandData:
             # Zero-pad to 2 "digits" month and day
             day = day.rjust(2, '0')
             month = month.rjust(2, '0')
-            new_date_key = "{}-{}-{}".format(year, month, day)
-            self.logger.debug("New date %s makes key: %s",
-                              date_item, new_date_key)
-            self.date_keys.append(new_date_key)
+            self.date_keys.append("{}-{}-{}".format(year, month, day))
         self.logger.info("Found date_keys: %s", self.date_keys)
 
-    def parse_data_line(self, data_array):
+    def parse_location(self, data_array):
         """
-        The data line is composed of: SomeProvince/SomeState,SomeCountry/SomeRegion,Lat0,Lng0,Day1Value,Day2Value,Day3Value
+        Extracts the location fields of a data line
         :param data_array list: A line split already by commas
-        :returns tuple: ("Lat,Lng,Country - Region,True,True", [{"Year-Mothh-Day":{"cumulative": CumulativeValue, "day": DayTotal, "delta": Delta}},{}])
+        :returns tuple: ("Lat,Lng,Country - Region", "Lat", "Lng", "Country - Region")
         """
-        res = dict()
         if self.USFileType:
             country_region = "{} - {}".format(data_array[7].replace(
                 ",", ""), data_array[6].replace(",", ""))
@@ -98,12 +187,20 @@ class CSSEGISandData:
             lat = data_array[2]
             lng = data_array[3]
         gps_key = "{},{},{}".format(lat, lng, country_region)
+        return (gps_key, lat, lng, country_region)
+
+    def parse_data_line(self, data_array):
+        """
+        The data line is composed of: SomeProvince/SomeState,SomeCountry/SomeRegion,Lat0,Lng0,Day1Value,Day2Value,Day3Value
+        :param data_array list: A line split already by commas
+        :returns tuple: ("Lat,Lng,Country - Region,True,True", [{"Year-Mothh-Day":{"cumulative": CumulativeValue, "day": DayTotal, "delta": Delta}},{}])
+        """
+        res = dict()
+        gps_key, _lat, _lng, _country_region = self.parse_location(data_array)
         prev_cumulative = None
         prev_day_value = None
         for date_idx, date_item in enumerate(data_array[self.offset_dates:]):
             current_column_date = self.date_keys[date_idx]
-            self.logger.debug("Found data %s for day: %s",
-                              date_item, current_column_date)
             # The data may be a 0.0 in some columns, but ases shouldn't be floating points?
             curr_date_value = int(float(date_item))
             if prev_cumulative is None:
@@ -125,14 +222,16 @@ class CSSEGISandData:
 
     def parse_csv_file_contents(self, content):
         """
-        :param file_contents str: The contents of the files downloaded from github
+        :param content bytes: The contents of the files downloaded from github, or an iterable of their lines
         :returns dict like ({"lat,lng,Country - Province,False,False":[{"2020-02-01":{"cumulative": 100, "day": 2, "delta": -5}}])
+                 With the numpy engine a ColumnarRecords is returned, which behaves like the dict.
         """
+        if self.engine == "numpy":
+            return self.parse_csv_file_contents_columnar(content)
         self.logger.info("INIT parse csv file contents")
         res = dict()
-        # Convert the incoming string into a file object
-        csv_file_obj = StringIO(content.decode())
-        csv_reader = csv.reader(csv_file_obj, delimiter=',', quotechar='"')
+        # Convert the incoming bytes into a file object, streamed lines are used as they are
+        csv_reader = csv.reader(csv_lines(content), delimiter=',', quotechar='"')
         for lineno, csv_line in enumerate(csv_reader):
             # Remove the new line:
             # The first items in the CSV are:
@@ -146,6 +245,74 @@ class CSSEGISandData:
         self.logger.info("DONE parse csv file contents")
         return res
 
+    def parse_csv_file_contents_columnar(self, content):
+        """
+        Parses the file into a single cumulative matrix of locations x dates.
+        Like the dict version, a repeated location key overwrites the earlier row
+        but keeps its position.
+        :param content bytes: The contents of the files downloaded from github, or an iterable of their lines
+        :returns ColumnarRecords: The matrix and the location metadata table
+        """
+        self.logger.info("INIT parse csv file contents into columns")
+        keys = []
+        lats = []
+        lngs = []
+        locations = []
+        rows = []
+        row_index = dict()
+        csv_reader = csv.reader(csv_lines(content), delimiter=',', quotechar='"')
+        for lineno, csv_line in enumerate(csv_reader):
+            if lineno == 0:
+                if len(self.date_keys) == 0:
+                    self.parse_header(csv_line)
+                continue
+            gps_key, lat, lng, country_region = self.parse_location(csv_line)
+            date_values = csv_line[self.offset_dates:]
+            if len(date_values) != len(self.date_keys):
+                raise ValueError("Line {} has {} dates, expected {}".format(
+                    lineno, len(date_values), len(self.date_keys)))
+            # The data may be a 0.0 in some columns, they are truncated after the whole matrix is built
+            row_values = numpy.array(date_values, dtype=numpy.float64)
+            if gps_key in row_index:
+                rows[row_index[gps_key]] = row_values
+                continue
+            row_index[gps_key] = len(keys)
+            keys.append(gps_key)
+            lats.append(lat)
+            lngs.append(lng)
+            locations.append(country_region)
+            rows.append(row_values)
+        if rows:
+            cumulative = numpy.vstack(rows).astype(numpy.int64)
+        else:
+            cumulative = numpy.zeros(
+                (0, len(self.date_keys)), dtype=numpy.int64)
+        self.logger.info("DONE parse csv file contents into columns")
+        return ColumnarRecords(keys, lats, lngs, locations, self.date_keys, cumulative)
+
+    def is_aggregated_location(self, location):
+        """
+        The global file contains an aggregated US row, unless it's forcefully processed
+        it's neither drawn nor added to the global stats, the US file already has the details.
+        :param location str: The "Country - Province" of a record
+        """
+        return not self.USFileType and location == "US" and not self.forceProcessUS
+
+    def location_index(self, records, global_population_dataset):
+        """
+        Returns the LocationIndex of the records, it's built once and kept in the records
+        :param records ColumnarRecords: The parsed records
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :returns LocationIndex: The index of the records rows
+        """
+        # The index keeps a reference to the population dataset, so its id is not reused
+        index_key = (id(global_population_dataset),
+                     self.USFileType, self.forceProcessUS)
+        if index_key not in records.location_indexes:
+            records.location_indexes[index_key] = LocationIndex(
+                records, global_population_dataset, self.is_aggregated_location)
+        return records.location_indexes[index_key]
+
     def get_stats_for_day(self, gps_records, series_key, global_population_dataset, global_population):
         """
         Returns a dict with collected stats for a given day.
@@ -179,7 +346,7 @@ class CSSEGISandData:
             _lat, _lng, location = lat_lng_key.split(",")
             for day_key, region_day_data in lat_lng_data.items():
                 if day_key == series_key:
-                    if not self.USFileType and location == "US" and not self.forceProcessUS:
+                    if self.is_aggregated_location(location):
                         logging.debug("Ignoring stat for day: %s location: %s",
                                       day_key, location)
                     else:
@@ -211,74 +378,318 @@ class CSSEGISandData:
         res["delta_global"] = delta_global
         return res
 
-    def generate_globe_json_string(self, gps_records, global_population_dataset, global_population, pretty_print=False):
+    def get_series_stats(self, gps_records, global_population_dataset, global_population, date_keys=None):
+        """
+        Returns the stats for every day, sorted by date key.
+        The result is the same as calling get_stats_for_day for each day, but the records are
+        scanned only once and the tops and totals are calculated column-wise.
+        :param gps_records dict: The per-day gps records with their cumulative/day/delta values
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world, a sum of the above dataset.
+        :param date_keys list: The days to calculate, by default all the date_keys in the header
+        :returns: list of dicts, see get_stats_for_day
+        """
+        if date_keys is None:
+            date_keys = self.date_keys
+        records = ColumnarRecords.from_gps_records(gps_records, date_keys)
+        series_keys = sorted(date_keys)
+        columns = [records.date_index[series_key] for series_key in series_keys]
+        location_index = self.location_index(
+            records, global_population_dataset)
+        has_population = location_index.has_population
+        population = location_index.population.astype(numpy.float64)
+        included = ~location_index.hidden
+        top_cumulative, top_cumulative_idx = top_by_column(records.cumulative)
+        top_day, top_day_idx = top_by_column(numpy.abs(records.day))
+        top_delta, top_delta_idx = top_by_column(numpy.abs(records.delta))
+        percent_rows = numpy.flatnonzero(has_population)
+        top_percent, top_percent_idx = top_by_column(
+            (records.cumulative[percent_rows] / population[percent_rows, None]) * 100)
+        if len(percent_rows):
+            # Translate the index of the population subset back into the location index
+            top_percent_idx = numpy.where(
+                top_percent > 0, percent_rows[top_percent_idx], 0)
+        cumulative_global = records.cumulative[included].sum(axis=0)
+        day_global = records.day[included].sum(axis=0)
+        delta_global = records.delta[included].sum(axis=0)
+        res = []
+        for series_key, col in zip(series_keys, columns):
+            day_stats = dict()
+            day_stats["name"] = series_key
+            day_stats["top_cumulative"] = {
+                "value": int(top_cumulative[col]), "location_idx": int(top_cumulative_idx[col])}
+            day_stats["top_day"] = {
+                "value": int(top_day[col]), "location_idx": int(top_day_idx[col])}
+            day_stats["top_delta"] = {
+                "value": int(top_delta[col]), "location_idx": int(top_delta_idx[col])}
+            day_stats["top_cumulative_percent"] = dict()
+            if top_percent[col] > 0:
+                day_stats["top_cumulative_percent"]["value"] = float(top_percent[col])
+            else:
+                day_stats["top_cumulative_percent"]["value"] = 0
+            day_stats["top_cumulative_percent"]["location_idx"] = int(top_percent_idx[col])
+            day_stats["cumulative_global"] = int(cumulative_global[col])
+            day_stats["cumulative_global_percent"] = (
+                day_stats["cumulative_global"] / global_population) * 100
+            day_stats["day_global"] = int(day_global[col])
+            day_stats["delta_global"] = int(delta_global[col])
+            res.append(day_stats)
+        return res
+
+    def generate_location_structs(self, gps_records, global_population_dataset):
+        """
+        Yields the location structs of the globe JSON one at a time, only one location
+        is materialized at any point.
+        :param gps_records dict: The per-day gps records with their cumulative/day/delta values
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        """
+        records = ColumnarRecords.from_gps_records(gps_records, self.date_keys)
+        location_index = self.location_index(
+            records, global_population_dataset)
+        columns = [records.date_index[series_key]
+                   for series_key in sorted(records.date_keys)]
+        # Let's push the locations and their daily values
+        for location_id in location_index.valid_ids:
+            cumulative = records.cumulative[location_id, columns].tolist()
+            day = records.day[location_id, columns].tolist()
+            delta = records.delta[location_id, columns].tolist()
+            if location_index.hidden[location_id]:
+                # The data for US in this filetype is aggregated, let's not draw it twice
+                # we will send a "hide" flag
+                day_array = [list(day_values) + [1]
+                             for day_values in zip(cumulative, day, delta)]
+            else:
+                day_array = [list(day_values)
+                             for day_values in zip(cumulative, day, delta)]
+            location_struct = dict()
+            location_struct["lat"] = float(location_index.lat[location_id])
+            location_struct["lng"] = float(location_index.lng[location_id])
+            location_struct["location"] = location_index.locations[location_id]
+            location_struct["values"] = day_array
+            # When the population is zero, we filter them out on the javascript side
+            location_struct["population_2020"] = int(
+                location_index.population[location_id])
+            yield location_struct
+
+    def generate_globe_json_chunks(self, gps_records, global_population_dataset, global_population, series_stats=None):
+        """
+        Yields the globe JSON in pieces, one location or one day of stats at a time.
+        The joined pieces are the same as generate_globe_json_string without pretty_print.
+        :param gps_records dict: The per-day gps records with their cumulative/day/delta values
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world, a sum of the above dataset.
+        :param series_stats list: Already calculated stats (see get_series_stats), to avoid recalculating them
+        """
+        self.logger.info("INIT streaming the JSON")
+        self.logger.debug("Daily series identified: %s", self.date_keys)
+        if series_stats is None:
+            series_stats = self.get_series_stats(
+                gps_records, global_population_dataset, global_population)
+        # The separators are the json.dumps defaults, ", " and ": "
+        yield '{"locations": ['
+        for location_number, location_struct in enumerate(self.generate_location_structs(gps_records, global_population_dataset)):
+            if location_number:
+                yield ", "
+            yield json.dumps(location_struct)
+        yield '], "series_stats": ['
+        for day_number, day_stats in enumerate(series_stats):
+            if day_number:
+                yield ", "
+            yield json.dumps(day_stats)
+        yield "]}"
+        self.logger.info("DONE streaming the JSON")
+
+    def globe_location_rows(self, records, global_population_dataset):
+        """
+        Returns the metadata of the records that can be drawn on the globe,
+        in the same order and with the same lat/lng filtering as generate_location_structs
+        :param records ColumnarRecords: The parsed records
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :returns list: (row, location_struct without "values") tuples
+        """
+        location_index = self.location_index(
+            records, global_population_dataset)
+        return [(int(location_id), location_index.location_struct(location_id))
+                for location_id in location_index.valid_ids]
+
+    def generate_globe_binary(self, gps_records, global_population_dataset, global_population, blob_name, series_stats=None):
+        """
+        Returns the globe data as a small JSON index and the chunks of a binary blob.
+        The blob is a little-endian Int32 matrix of locations x dates x channels,
+        the channels being cumulative, day and delta. The index holds the locations,
+        date keys and series stats, see README.md.
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world, a sum of the above dataset.
+        :param blob_name str: The file name of the blob, relative to the index
+        :param series_stats list: Already calculated stats (see get_series_stats), to avoid recalculating them
+        :returns tuple: (index JSON str, generator of bytes chunks)
+        """
+        records = ColumnarRecords.from_gps_records(gps_records, self.date_keys)
+        if series_stats is None:
+            series_stats = self.get_series_stats(
+                records, global_population_dataset, global_population)
+        series_keys = sorted(records.date_keys)
+        columns = [records.date_index[series_key] for series_key in series_keys]
+        location_rows = self.globe_location_rows(
+            records, global_population_dataset)
+        int32 = numpy.iinfo(numpy.int32)
+        for matrix in (records.cumulative, records.day, records.delta):
+            if matrix.size and (matrix.max() > int32.max or matrix.min() < int32.min):
+                raise ValueError("The values do not fit in the Int32 blob")
+        index = dict()
+        index["format"] = "globe-binary"
+        index["version"] = 1
+        index["blob"] = blob_name
+        index["dtype"] = "<i4"
+        index["channels"] = ["cumulative", "day", "delta"]
+        index["shape"] = [len(location_rows), len(series_keys), 3]
+        index["date_keys"] = series_keys
+        index["locations"] = [location_struct for _row,
+                              location_struct in location_rows]
+        index["series_stats"] = series_stats
+
+        def blob_chunks():
+            # One location at a time, to avoid a copy of the whole matrix
+            for row, _location_struct in location_rows:
+                yield numpy.stack((records.cumulative[row, columns],
+                                   records.day[row, columns],
+                                   records.delta[row, columns]), axis=1).astype("<i4").tobytes()
+        return (json.dumps(index), blob_chunks())
+
+    def generate_globe_lookup(self, gps_records, global_population_dataset, blob_name):
+        """
+        Returns the query lookup of the binary blob, see query.generate_lookup
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param blob_name str: The file name of the blob, relative to the lookup
+        :returns str: The lookup JSON
+        """
+        records = ColumnarRecords.from_gps_records(gps_records, self.date_keys)
+        location_rows = self.globe_location_rows(
+            records, global_population_dataset)
+        return generate_lookup(blob_name, [location_struct for _row, location_struct in location_rows],
+                               sorted(records.date_keys), ["cumulative", "day", "delta"])
+
+    def generate_globe_tiles(self, gps_records, global_population_dataset, global_population, tile_days=None, series_stats=None):
+        """
+        Splits the globe data into date tiles, each with the values and series stats of its days.
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world, a sum of the above dataset.
+        :param tile_days int: The number of days per tile, by default there is a tile per month
+        :param series_stats list: Already calculated stats (see get_series_stats), to avoid recalculating them
+        :returns tuple: (manifest dict without the "tiles", list of (tile name, first day index, end day index, tile JSON str))
+        """
+        records = ColumnarRecords.from_gps_records(gps_records, self.date_keys)
+        if series_stats is None:
+            series_stats = self.get_series_stats(
+                records, global_population_dataset, global_population)
+        series_keys = sorted(records.date_keys)
+        location_rows = self.globe_location_rows(
+            records, global_population_dataset)
+        rows = [row for row, _location_struct in location_rows]
+        # The date keys look like 20-01-22, a month tile groups the "20-01" prefix
+        tile_ranges = []
+        for day_idx, series_key in enumerate(series_keys):
+            if tile_days:
+                # Fixed size tiles are named after their first day
+                tile_name = series_keys[day_idx - day_idx % tile_days]
+            else:
+                tile_name = series_key[:5]
+            if not tile_ranges or tile_ranges[-1][0] != tile_name:
+                tile_ranges.append([tile_name, day_idx, day_idx + 1])
+            else:
+                tile_ranges[-1][2] = day_idx + 1
+        manifest = dict()
+        manifest["format"] = "globe-tiles"
+        manifest["version"] = 1
+        manifest["channels"] = ["cumulative", "day", "delta"]
+        manifest["date_keys"] = series_keys
+        manifest["locations"] = [location_struct for _row,
+                                 location_struct in location_rows]
+        tiles = []
+        for tile_name, first_day, last_day in tile_ranges:
+            columns = [records.date_index[series_key]
+                       for series_key in series_keys[first_day:last_day]]
+            values = numpy.stack((records.cumulative[numpy.ix_(rows, columns)],
+                                  records.day[numpy.ix_(rows, columns)],
+                                  records.delta[numpy.ix_(rows, columns)]), axis=2)
+            tile = dict()
+            tile["name"] = tile_name
+            tile["first_day_index"] = first_day
+            tile["date_keys"] = series_keys[first_day:last_day]
+            tile["series_stats"] = series_stats[first_day:last_day]
+            tile["values"] = values.tolist()
+            tiles.append((tile_name, first_day, last_day, json.dumps(tile)))
+        return (manifest, tiles)
+
+    def generate_compact_json_chunks(self, gps_records, global_population_dataset, global_population, series_stats=None):
+        """
+        Yields the globe JSON in the compact schema (schema_version 2, see data/data-schema.json).
+        Only the cumulative values are stored, day and delta are derived by the reader:
+        - "offset": The number of leading days with a cumulative of 0, they are not stored
+        - "values": The cumulative of day offset, followed by the difference with the previous day
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world, a sum of the above dataset.
+        :param series_stats list: Already calculated stats (see get_series_stats), to avoid recalculating them
+        """
+        self.logger.info("INIT streaming the compact JSON")
+        records = ColumnarRecords.from_gps_records(gps_records, self.date_keys)
+        if series_stats is None:
+            series_stats = self.get_series_stats(
+                records, global_population_dataset, global_population)
+        series_keys = sorted(records.date_keys)
+        columns = [records.date_index[series_key] for series_key in series_keys]
+        yield '{"schema_version": 2, "date_keys": '
+        yield json.dumps(series_keys)
+        yield ', "locations": ['
+        for location_number, (row, location_struct) in enumerate(self.globe_location_rows(records, global_population_dataset)):
+            cumulative = records.cumulative[row, columns]
+            non_zero = numpy.flatnonzero(cumulative)
+            offset = int(non_zero[0]) if len(non_zero) else len(columns)
+            location_struct["offset"] = offset
+            location_struct["values"] = numpy.diff(
+                cumulative[offset:], prepend=0).tolist()
+            if location_number:
+                yield ", "
+            yield json.dumps(location_struct)
+        yield '], "series_stats": ['
+        for day_number, day_stats in enumerate(series_stats):
+            if day_number:
+                yield ", "
+            yield json.dumps(day_stats)
+        yield "]}"
+        self.logger.info("DONE streaming the compact JSON")
+
+    def generate_globe_json_string(self, gps_records, global_population_dataset, global_population, pretty_print=False, series_stats=None):
         """
         Returns a JSON object that can be loaded into the our globe drawing functions
         :param gps_records dict: The per-day gps records with their cumulative/day/delta values
         :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
         :param global_population int: The total population of the world, a sum of the above dataset.
         :param pretty_print bool: human readable json structures
+        :param series_stats list: Already calculated stats (see get_series_stats), to avoid recalculating them
         Data format: see data/-data-schema.json
         """
+        if not pretty_print:
+            return "".join(self.generate_globe_json_chunks(
+                gps_records, global_population_dataset, global_population, series_stats=series_stats))
         self.logger.info("INIT creating array structs for the JSON")
         # First, let's scan day indexes, they will become series and be in the dropdown:
-        locations = []
-        series_stats = []
-        # Let's push the locations and their daily values
-        for lat_lng_key, lat_lng_data in gps_records.items():
-            lat, lng, location = lat_lng_key.split(",")
-            try:
-                lat = float(lat)
-                lng = float(lng)
-            except:
-                self.logger.error(
-                    "Unable to parse lat/lng on key %s", lat_lng_key)
-                continue
-            day_array = []
-            for day_key in sorted(lat_lng_data.keys()):
-                region_day_data = lat_lng_data[day_key]
-                if not self.USFileType and location == "US" and not self.forceProcessUS:
-                    # The data for US in this filetype is aggregated, let's not draw it twice
-                    # we will send a "hide" flag
-                    day_array.append([
-                        region_day_data["cumulative"],
-                        region_day_data["day"],
-                        region_day_data["delta"],
-                        1,
-                    ])
-                else:
-                    # Let's rounde the day value by 3 floats to reduce json file size
-                    day_array.append([
-                        region_day_data["cumulative"],
-                        region_day_data["day"],
-                        region_day_data["delta"],
-                    ])
-            location_struct = dict()
-            location_struct["lat"] = lat
-            location_struct["lng"] = lng
-            location_struct["location"] = location
-            location_struct["values"] = day_array
-            if location in global_population_dataset.keys():
-                location_struct["population_2020"] = int(
-                    global_population_dataset[location])
-            else:
-                # When the population is zero, we filter them out on the javascript side
-                location_struct["population_2020"] = 0
-            locations.append(location_struct)
+        locations = list(self.generate_location_structs(
+            gps_records, global_population_dataset))
         # Now let's push stats for the day
         self.logger.debug("Daily series identified: %s", self.date_keys)
-        for series in sorted(self.date_keys):
-            day_stats = self.get_stats_for_day(
-                gps_records, series, global_population_dataset, global_population)
-            series_stats.append(day_stats)
+        if series_stats is None:
+            series_stats = self.get_series_stats(
+                gps_records, global_population_dataset, global_population)
         self.logger.info("DONE creating array structs for the JSON")
         res = dict()
         res["locations"] = locations
         res["series_stats"] = series_stats
-        if pretty_print:
-            return json.dumps(res, sort_keys=True, indent=2)
-        else:
-            return json.dumps(res)
+        return json.dumps(res, sort_keys=True, indent=2)
 
 
 class CSSEGISandDataHelper:
@@ -286,15 +697,95 @@ class CSSEGISandDataHelper:
     Uses the CSSEGISandData internals to provie confirmed, deaths and recovered
     """
 
-    def __init__(self, logger):
+    def __init__(self, logger, engine="dict", state_dir=None, cache=None, base_url=None,
+                 session=None, timeout=DEFAULT_TIMEOUT, load_population=True, download_workers=6,
+                 output_dir="data", output_format="json", tiles=False, tile_days=None,
+                 compact=False, population_file=None, population_max_age=DEFAULT_POPULATION_MAX_AGE,
+                 metrics=None, stream=False, local_source=None, output_tags=None, rollups=False,
+                 rankings=None, snapshot_dir=None, derived=False,
+                 lod=False, lod_level=DEFAULT_LOD_LEVEL, combined=False):
         """
         Sets up initial variables for the helper
+        :param logger: The logger object
+        :param engine str: The CSSEGISandData parsing engine, "dict" or "numpy"
+        :param state_dir str: Where to persist the state of each output between runs,
+               when set only the new days appended upstream are calculated
+        :param cache DownloadCache: When set, the downloads go through this cache
+        :param base_url str: Overrides the URL of the time series directory, i.e. for a local server
+        :param session requests.Session: The pooled session shared by all the downloads
+        :param timeout float: The timeout in seconds of each request
+        :param load_population bool: Load the population now, otherwise it's downloaded
+               concurrently with the time series in load_default_datasources
+        :param download_workers int: The number of concurrent downloads
+        :param output_dir str: The directory where the JSON files are written
+        :param output_format str: "json", "binary" (index JSON + Int32 blob) or "both"
+        :param tiles bool: Also write date tiles with a manifest, see write_globe_tiles
+        :param tile_days int: The number of days per tile, by default there is a tile per month
+        :param compact bool: Write the JSON in the compact schema, see generate_compact_json_chunks
+        :param population_file str: Where the parsed population table is persisted between runs
+        :param population_max_age float: The seconds after which the population_file is refreshed
+        :param metrics StageMetrics: Where the spans of each stage are recorded, see metrics.py
+        :param stream bool: Don't download the time series upfront, each file is parsed line by line
+               as it's received, see parse_records
+        :param local_source LocalSource: Read the time series from a local checkout instead of downloading them
+        :param output_tags OutputTags: The input hashes of the outputs written, the outputs whose
+               inputs didn't change since they were written are skipped, see skip_unchanged
+        :param rollups bool: Group the locations by country, without the aggregated rows, and
+               write the per-country sums into <output_dir>/<name>.countries.json, see rollup.py
+        :param rankings int: When set, the top location ids of each day are written into
+               <output_dir>/<name>.rankings.json, see rankings.py
+        :param snapshot_dir str: When set, the parsed matrices of each run are kept there, see snapshots.py
+        :param derived bool: Also write the rolling means and per 100k rates into
+               <output_dir>/<name>.derived.json and <output_dir>/<name>.derived.bin, see derived.py
+        :param lod bool: Also write the quadtree clusters of the locations into
+               <output_dir>/<name>.lod.json and <output_dir>/<name>.lod.bin, see lod.py
+        :param lod_level int: The finest quadtree level of the clusters
+        :param combined bool: Also join the binary outputs of all the metrics into
+               <output_dir>/combined.json and <output_dir>/combined.bin, see combined.py
         """
         self.logger = logging.getLogger("CSSEGISandDataHelper")
-        raw_https_repo = "raw.githubusercontent.com/CSSEGISandData/COVID-19"
-        base_url = "https://{}/{}".format(
-            raw_https_repo,
-            "master/csse_covid_19_data/csse_covid_19_time_series/")
+        self.engine = engine
+        self.state_dir = state_dir
+        self.cache = cache
+        if session is None:
+            session = cache.session if cache is not None else create_session()
+        self.session = session
+        self.timeout = timeout
+        self.download_workers = download_workers
+        self.output_dir = output_dir
+        if output_format not in ("json", "binary", "both"):
+            raise ValueError("Unknown output format: {}".format(output_format))
+        self.output_format = output_format
+        if combined and output_format == "json":
+            raise ValueError("The combined output is built from the binary outputs")
+        self.combined = combined
+        self.tiles = tiles
+        self.tile_days = tile_days
+        self.compact = compact
+        self.download_timings = dict()
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self.stream = stream
+        self.local_source = local_source
+        self.output_tags = output_tags
+        self.rollups = rollups
+        self.rankings = rankings
+        self.snapshot_dir = snapshot_dir
+        self.derived = derived
+        self.lod = lod
+        self.lod_level = lod_level
+        # The input hash of each output being processed
+        self.input_hashes = dict()
+        # When a list, the output files are staged into it instead of renamed into place, see process_metric_in_worker
+        self.staged_files = None
+        for dataset_attribute, _url_attribute in TIME_SERIES.values():
+            setattr(self, dataset_attribute, None)
+        self.global_population_dataset = None
+        self.global_population = None
+        if base_url is None:
+            raw_https_repo = "raw.githubusercontent.com/CSSEGISandData/COVID-19"
+            base_url = "https://{}/{}".format(
+                raw_https_repo,
+                "master/csse_covid_19_data/csse_covid_19_time_series/")
         self.global_confirmed_url = "{}/{}".format(
             base_url, "time_series_covid19_confirmed_global.csv")
         self.us_confirmed_url = "{}/{}".format(
@@ -305,16 +796,27 @@ class CSSEGISandDataHelper:
             base_url, "time_series_covid19_deaths_US.csv")
         self.global_recovered_url = "{}/{}".format(
             base_url, "time_series_covid19_recovered_global.csv")
+        self.world_pop_handler = WorldOMeters(
+            cache=self.cache, session=self.session, timeout=self.timeout,
+            population_file=population_file, max_age=population_max_age)
         self.date_keys = []
-        self.load_world_population()
+        if load_population:
+            self.load_world_population()
         self.date_keys = []
 
-    def load_world_population(self):
+    def load_world_population(self, content=None, population_dataset=None):
         """
         Loads the WorldOMeters data
+        :param content bytes: The already downloaded population page, by default it's downloaded
+        :param population_dataset dict: The already parsed population {"Country": <Population>}
         """
-        world_pop_handler = WorldOMeters()
-        world_pop_handler.load_default_datasources()
+        world_pop_handler = self.world_pop_handler
+        if population_dataset is not None:
+            world_pop_handler.global_population_dataset = population_dataset
+        elif content is None:
+            world_pop_handler.load_default_datasources()
+        else:
+            world_pop_handler.parse_population_page(content)
         self.global_population_dataset = world_pop_handler.global_population_dataset
         global_population = 0
         for country in self.global_population_dataset.keys():
@@ -325,30 +827,63 @@ class CSSEGISandDataHelper:
         """
         Performs http requests to load the data from the configured URLs.
         The data is loaded into strings which can later be parsed
+        The URLs are downloaded concurrently through the pooled session, including the
+        population page when it hasn't been loaded yet.
+        In stream mode only the population is loaded, the time series are downloaded while parsed.
+        With a local source only the population is loaded too, the time series are read from it.
         """
         self.logger.info("INIT load_default_datasources")
-        self.logger.debug("Downloading Global Confirmed from %s",
-                          self.global_confirmed_url)
-        global_confirmed_req = requests.get(self.global_confirmed_url)
-        self.logger.debug("Downloading Global Deaths from %s",
-                          self.global_deaths_url)
-        global_deaths_req = requests.get(self.global_deaths_url)
-        self.logger.debug("Downloading  Global Recovered %s",
-                          self.global_recovered_url)
-        global_recovered_req = requests.get(self.global_recovered_url)
-        self.logger.debug("Downloading US Confirmed from %s",
-                          self.us_confirmed_url)
-        us_confirmed_req = requests.get(self.us_confirmed_url)
-        self.logger.debug("Downloading US Deaths from %s",
-                          self.us_confirmed_url)
-        us_deaths_req = requests.get(self.us_deaths_url)
-        self.global_confirmed_dataset = global_confirmed_req.content
-        self.global_deaths_dataset = global_deaths_req.content
-        self.global_recovered_dataset = global_recovered_req.content
-        self.us_confirmed_dataset = us_confirmed_req.content
-        self.us_deaths_dataset = us_deaths_req.content
+        sources = []
+        if not self.stream and self.local_source is None:
+            sources = [(name, getattr(self, url_attribute))
+                       for name, (_dataset_attribute, url_attribute) in TIME_SERIES.items()]
+        if self.global_population_dataset is None and self.world_pop_handler.load_population_file():
+            self.load_world_population(
+                population_dataset=self.world_pop_handler.global_population_dataset)
+        if self.global_population_dataset is None:
+            sources.append(("Global Population",
+                            self.world_pop_handler.global_population_url))
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            futures = [(name, executor.submit(self.timed_download, name, url))
+                       for name, url in sources]
+            contents = {name: future.result() for name, future in futures}
+        for name, (dataset_attribute, _url_attribute) in TIME_SERIES.items():
+            if name in contents:
+                setattr(self, dataset_attribute, contents[name])
+        if "Global Population" in contents:
+            with self.metrics.span("parse", "Global Population", bytes_in=len(contents["Global Population"])) as span:
+                self.load_world_population(contents["Global Population"])
+                span["rows"] = len(self.global_population_dataset)
+        for name, _url in sources:
+            elapsed, size = self.download_timings[name]
+            self.logger.info("Downloaded %s: %s bytes in %.2fs",
+                             name, size, elapsed)
         self.logger.info("DONE load_default_datasources")
 
+    def timed_download(self, name, url):
+        """
+        Downloads an URL and records how long it took in download_timings
+        :param name str: The name of the source for the report
+        :param url str: The URL to download
+        """
+        self.logger.debug("Downloading %s from %s", name, url)
+        start = time.perf_counter()
+        content = self.download(url)
+        self.download_timings[name] = (time.perf_counter() - start, len(content))
+        self.metrics.record(
+            "download", name, self.download_timings[name][0], bytes_in=len(content))
+        return content
+
+    def download(self, url):
+        """
+        Returns the body of an URL, through the cache if there is one
+        """
+        if self.cache is not None:
+            return self.cache.get(url)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
     def date_keys_sanity_check(self, new_date_keys, do_exit=True):
         """
         Ensures date_keys colected from the headers are the same for consistency
@@ -364,58 +899,524 @@ class CSSEGISandDataHelper:
         self.date_keys = new_date_keys
         return True
 
+    def open_stream(self, url):
+        """
+        Returns a context manager of a TeeReader over the body of an URL, through the cache if there is one
+        """
+        if self.cache is not None:
+            return self.cache.open_stream(url)
+        return open_url_stream(self.session, url, self.timeout)
+
+    def parse_records(self, csse_handler, name):
+        """
+        Parses a time series file, recording a "parse" span.
+        When the file wasn't downloaded upfront, it's streamed and parsed line by line as it's
+        received, so the download overlaps with the parsing and the raw file is never held
+        in memory. The span then includes the download.
+        With a local source, the lines are read from the memory-mapped file.
+        :param csse_handler CSSEGISandData: The handler of the file type
+        :param name str: The name of the file in TIME_SERIES, i.e. "Global Confirmed"
+        """
+        dataset_attribute, url_attribute = TIME_SERIES[name]
+        content = getattr(self, dataset_attribute)
+        with self.metrics.span("parse", name) as span:
+            if content is None and self.local_source is not None:
+                # The local file has the name of the file in the URL
+                with self.local_source.open_stream(os.path.basename(getattr(self, url_attribute))) as reader:
+                    records = csse_handler.parse_csv_file_contents(
+                        text_lines(reader))
+                span["bytes_in"] = reader.bytes_read
+            elif content is None:
+                with self.open_stream(getattr(self, url_attribute)) as reader:
+                    records = csse_handler.parse_csv_file_contents(
+                        text_lines(reader))
+                span["bytes_in"] = reader.bytes_read
+            else:
+                records = csse_handler.parse_csv_file_contents(content)
+                span["bytes_in"] = len(content)
+            span["rows"] = len(records)
+            span["cells"] = len(records) * len(csse_handler.date_keys)
+        return records
+
+    def write_output_chunks(self, filename, chunks, mode="w"):
+        """
+        Writes the chunks of an output, the time spent producing the chunks is
+        recorded as a "serialize" span and the rest as a "write" span
+        :param filename str: The destination file
+        :param chunks iterable: The str (or bytes for mode "wb") pieces of the content
+        :param mode str: "w" for text, "wb" for binary chunks
+        """
+        timed_chunks = TimedIterator(chunks)
+        start = time.perf_counter()
+        written = utils.write_chunks_to_file(
+            filename, timed_chunks, mode=mode, staged=self.staged_files)
+        elapsed = time.perf_counter() - start
+        name = os.path.relpath(filename, self.output_dir)
+        self.metrics.record("serialize", name,
+                            timed_chunks.seconds, bytes_out=written)
+        self.metrics.record("write", name, elapsed -
+                            timed_chunks.seconds, bytes_out=written)
+        return written
+
+    def output_files(self, name):
+        """
+        Returns the paths of the files written for an output with the configured formats
+        :param name str: The name of the output, i.e. "confirmed"
+        """
+        res = []
+        if self.output_format in ("json", "both"):
+            res.append("{}.json".format(name))
+        if self.output_format in ("binary", "both"):
+            res.extend(["{}.bin".format(name), "{}.lookup.json".format(name),
+                        "{}.index.json".format(name)])
+        if self.tiles:
+            res.append("{}.manifest.json".format(name))
+            res.extend(self.manifest_tile_files(name))
+        if self.rollups:
+            res.append("{}.countries.json".format(name))
+        if self.rankings:
+            res.append("{}.rankings.json".format(name))
+        if self.derived:
+            res.extend(["{}.derived.bin".format(name), "{}.derived.json".format(name)])
+        if self.lod:
+            res.extend(["{}.lod.bin".format(name), "{}.lod.json".format(name)])
+        return [os.path.join(self.output_dir, filename) for filename in res]
+
+    def manifest_tile_files(self, name):
+        """
+        Returns the tile files listed in the manifest of an output, relative to output_dir
+        A missing or unreadable manifest lists no tiles, its file list then differs from the tag
+        :param name str: The name of the output, i.e. "confirmed"
+        """
+        manifest_file = os.path.join(
+            self.output_dir, "{}.manifest.json".format(name))
+        try:
+            with open(manifest_file) as file_handle:
+                manifest = json.load(file_handle)
+            return [tile_entry["file"] for tile_entry in manifest["tiles"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def source_hash(self, name):
+        """
+        Returns the sha256 of a time series file without parsing it
+        :param name str: The name of the file in TIME_SERIES, i.e. "Global Confirmed"
+        :returns str: The hex digest, None when it's not known before parsing (stream mode)
+        """
+        dataset_attribute, url_attribute = TIME_SERIES[name]
+        content = getattr(self, dataset_attribute)
+        if content is not None:
+            return hashlib.sha256(content).hexdigest()
+        if self.local_source is not None:
+            return self.local_source.file_hash(os.path.basename(getattr(self, url_attribute)))
+        return None
+
+    def output_input_hash(self, name):
+        """
+        Returns the hash of everything an output is generated from: the raw time series,
+        the population table, the settings of the output and OUTPUTS_VERSION
+        :param name str: The name of the output, i.e. "confirmed"
+        :returns str: The hex digest, None when the time series hashes are not known
+        """
+        inputs = dict()
+        inputs["outputs_version"] = OUTPUTS_VERSION
+        inputs["sources"] = dict()
+        for source in METRIC_SOURCES[name]:
+            inputs["sources"][source] = self.source_hash(source)
+            if inputs["sources"][source] is None:
+                return None
+        inputs["population_digest"] = population_digest(
+            self.global_population_dataset)
+        inputs["output_format"] = self.output_format
+        inputs["compact"] = self.compact
+        inputs["tiles"] = self.tiles
+        inputs["tile_days"] = self.tile_days
+        inputs["rollups"] = self.rollups
+        inputs["rankings"] = self.rankings
+        inputs["derived"] = self.derived
+        inputs["lod_level"] = self.lod_level if self.lod else None
+        # A snapshot is only recorded when the output is generated
+        inputs["snapshot_dir"] = os.path.abspath(
+            self.snapshot_dir) if self.snapshot_dir else None
+        return input_hash(inputs)
+
+    def skip_unchanged(self, name):
+        """
+        Checks if an output was written from the same inputs, see output_input_hash.
+        Its files are then reused as they are, without parsing nor writing.
+        :param name str: The name of the output, i.e. "confirmed"
+        :returns bool: True when the output is up to date and can be skipped
+        """
+        if self.output_tags is None:
+            return False
+        self.input_hashes[name] = self.output_input_hash(name)
+        if self.input_hashes[name] is None:
+            return False
+        if not self.output_tags.is_current(name, self.input_hashes[name], self.output_files(name)):
+            return False
+        self.logger.info("Reusing %s, its inputs didn't change", name)
+        self.metrics.outputs[name] = "reused"
+        return True
+
+    def merge_records(self, lhs, rhs):
+        """
+        Merges the records of two files, the rhs records overwrite the lhs
+        """
+        if isinstance(lhs, ColumnarRecords) and isinstance(rhs, ColumnarRecords):
+            return lhs.merge(rhs)
+        return utils.merge_dict(lhs, rhs)
+
+    def write_outputs(self, csse_handler, gps_records, name):
+        """
+        Writes the outputs of the records in the configured output_format
+        When a state_dir is configured, the stats of the days processed on the
+        previous run are reused if upstream only appended new days.
+        :param csse_handler CSSEGISandData: The handler that parsed the records
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param name str: The name of the output, i.e. "confirmed"
+        """
+        # Converted once, so the location index is shared by all the outputs
+        gps_records = ColumnarRecords.from_gps_records(
+            gps_records, csse_handler.date_keys)
+        if self.snapshot_dir:
+            with self.metrics.span("write", "{} snapshot".format(name)):
+                SnapshotStore(self.snapshot_dir).save(name, gps_records)
+        rollup = None
+        if self.rollups:
+            with self.metrics.span("stats", "{} countries".format(name)) as span:
+                rollup = CountryRollup(gps_records, csse_handler.location_index(
+                    gps_records, self.global_population_dataset))
+                span["rows"] = len(gps_records)
+                span["cells"] = gps_records.cumulative.size
+            # The outputs are written in the order of the rollup ranges
+            gps_records = rollup.records
+        state = None
+        # Calculated once for all the formats
+        with self.metrics.span("stats", name) as span:
+            if self.state_dir:
+                state = IncrementalState(os.path.join(
+                    self.state_dir, "{}.json".format(name)))
+                state.load()
+                series_stats = state.series_stats(
+                    csse_handler, gps_records, self.global_population_dataset, self.global_population)
+            else:
+                series_stats = csse_handler.get_series_stats(
+                    gps_records, self.global_population_dataset, self.global_population)
+            span["rows"] = len(gps_records)
+            span["cells"] = gps_records.cumulative.size
+        if rollup is not None:
+            # Not in the state, the undrawn rows are added again on every run
+            series_stats = rollup.add_undrawn_totals(
+                series_stats, self.global_population)
+        rankings = None
+        if self.rankings:
+            with self.metrics.span("stats", "{} rankings".format(name)) as span:
+                rankings = Rankings(gps_records, csse_handler.location_index(
+                    gps_records, self.global_population_dataset), self.rankings)
+                span["rows"] = len(gps_records)
+                span["cells"] = gps_records.cumulative.size
+        derived = None
+        if self.derived:
+            with self.metrics.span("stats", "{} derived".format(name)) as span:
+                derived = DerivedMetrics(gps_records, csse_handler.location_index(
+                    gps_records, self.global_population_dataset))
+                span["rows"] = len(gps_records)
+                span["cells"] = gps_records.cumulative.size
+        lod_index = None
+        if self.lod:
+            with self.metrics.span("stats", "{} lod".format(name)) as span:
+                lod_index = LodIndex(gps_records, csse_handler.location_index(
+                    gps_records, self.global_population_dataset), self.lod_level)
+                span["rows"] = len(gps_records)
+                span["cells"] = gps_records.cumulative.size
+        if self.output_format in ("json", "both"):
+            self.write_globe_json(csse_handler, gps_records, name, series_stats)
+        if self.output_format in ("binary", "both"):
+            self.write_globe_binary(
+                csse_handler, gps_records, name, series_stats)
+        if self.tiles:
+            self.write_globe_tiles(
+                csse_handler, gps_records, name, series_stats)
+        if rollup is not None:
+            self.write_output_chunks(os.path.join(
+                self.output_dir, "{}.countries.json".format(name)), rollup.generate_json_chunks())
+        if rankings is not None:
+            self.write_output_chunks(os.path.join(
+                self.output_dir, "{}.rankings.json".format(name)), rankings.generate_json_chunks())
+        if derived is not None:
+            self.write_blob_output(derived, "{}.derived".format(name))
+        if lod_index is not None:
+            self.write_blob_output(lod_index, "{}.lod".format(name))
+        if state is not None:
+            state.save()
+        self.metrics.outputs[name] = "generated"
+        if self.output_tags is not None and self.input_hashes.get(name) is not None:
+            self.output_tags.tag(
+                name, self.input_hashes[name], self.output_files(name))
+
+    def write_globe_json(self, csse_handler, gps_records, name, series_stats=None):
+        """
+        Writes the globe JSON of the records into <output_dir>/<name>.json
+        """
+        if self.compact:
+            chunks = csse_handler.generate_compact_json_chunks(
+                gps_records, self.global_population_dataset, self.global_population, series_stats=series_stats)
+        else:
+            chunks = csse_handler.generate_globe_json_chunks(
+                gps_records, self.global_population_dataset, self.global_population, series_stats=series_stats)
+        self.write_output_chunks(os.path.join(
+            self.output_dir, "{}.json".format(name)), chunks)
+
+    def write_globe_binary(self, csse_handler, gps_records, name, series_stats=None):
+        """
+        Writes the binary blob into <output_dir>/<name>.bin, its query lookup into <output_dir>/<name>.lookup.json
+        and its index into <output_dir>/<name>.index.json
+        The blob is written first, so the lookup and the index never point to a missing blob.
+        """
+        blob_name = "{}.bin".format(name)
+        lookup_name = "{}.lookup.json".format(name)
+        index_name = "{}.index.json".format(name)
+        with self.metrics.span("serialize", index_name):
+            index, blob_chunks = csse_handler.generate_globe_binary(
+                gps_records, self.global_population_dataset, self.global_population, blob_name, series_stats=series_stats)
+        self.write_output_chunks(os.path.join(
+            self.output_dir, blob_name), blob_chunks, mode="wb")
+        with self.metrics.span("serialize", lookup_name):
+            lookup = csse_handler.generate_globe_lookup(
+                gps_records, self.global_population_dataset, blob_name)
+        self.write_output_chunks(os.path.join(
+            self.output_dir, lookup_name), [lookup])
+        self.write_output_chunks(os.path.join(
+            self.output_dir, index_name), [index])
+
+    def write_blob_output(self, output, prefix):
+        """
+        Writes the blob of a side output into <output_dir>/<prefix>.bin and its index into <output_dir>/<prefix>.json
+        The index is written last, so it never points to a missing blob.
+        :param output DerivedMetrics: The side output, i.e. DerivedMetrics or LodIndex
+        :param prefix str: The file name without extension, i.e. "confirmed.derived"
+        """
+        blob_name = "{}.bin".format(prefix)
+        index_name = "{}.json".format(prefix)
+        with self.metrics.span("serialize", index_name):
+            index, blob_chunks = output.generate_binary(blob_name)
+        self.write_output_chunks(os.path.join(
+            self.output_dir, blob_name), blob_chunks, mode="wb")
+        self.write_output_chunks(os.path.join(
+            self.output_dir, index_name), [index])
+
+    def write_globe_tiles(self, csse_handler, gps_records, name, series_stats=None):
+        """
+        Writes the date tiles into <output_dir>/tiles/<name>/ and their manifest into <output_dir>/<name>.manifest.json
+        The tile file names contain their content hash, an unchanged tile keeps its file and
+        can be cached forever. Tiles no longer in the manifest are removed once it's written.
+        """
+        tiles_dir = os.path.join(self.output_dir, "tiles", name)
+        os.makedirs(tiles_dir, exist_ok=True)
+        with self.metrics.span("serialize", "tiles/{}".format(name)) as span:
+            manifest, tiles = csse_handler.generate_globe_tiles(
+                gps_records, self.global_population_dataset, self.global_population,
+                tile_days=self.tile_days, series_stats=series_stats)
+            span["bytes_out"] = sum(len(tile_json)
+                                    for _name, _first, _last, tile_json in tiles)
+        write_start = time.perf_counter()
+        tiles_written = 0
+        manifest["tiles"] = []
+        for tile_name, first_day, last_day, tile_json in tiles:
+            content = tile_json.encode()
+            tile_hash = hashlib.sha256(content).hexdigest()
+            tile_file = "{}-{}.{}.json".format(name, tile_name, tile_hash[:16])
+            tile_path = os.path.join(tiles_dir, tile_file)
+            if not os.path.exists(tile_path):
+                tiles_written += utils.write_chunks_to_file(
+                    tile_path, [content], mode="wb", staged=self.staged_files)
+            tile_entry = dict()
+            tile_entry["name"] = tile_name
+            tile_entry["first_day_index"] = first_day
+            tile_entry["days"] = last_day - first_day
+            tile_entry["file"] = "tiles/{}/{}".format(name, tile_file)
+            tile_entry["sha256"] = tile_hash
+            tile_entry["bytes"] = len(content)
+            manifest["tiles"].append(tile_entry)
+        # Only the tiles that changed are written
+        self.metrics.record("write", "tiles/{}".format(name),
+                            time.perf_counter() - write_start, bytes_out=tiles_written)
+        self.write_output_chunks(os.path.join(
+            self.output_dir, "{}.manifest.json".format(name)), [json.dumps(manifest)])
+        current_files = set(os.path.basename(
+            tile_entry["file"]) for tile_entry in manifest["tiles"])
+        for tile_file in os.listdir(tiles_dir):
+            if tile_file.endswith(".json") and tile_file not in current_files:
+                if self.staged_files is not None:
+                    # Removed once the new manifest is committed
+                    self.staged_files.append(
+                        (None, os.path.join(tiles_dir, tile_file)))
+                else:
+                    os.remove(os.path.join(tiles_dir, tile_file))
 
     def process_confirmed(self):
         """
         Processes the global confirmed in-memory records
         """
+        if self.skip_unchanged("confirmed"):
+            return
         logger = logging.getLogger("Confirmed")
-        csse_handler_global = CSSEGISandData(logger, USFileType=False)
-        global_confirmed_gps_data = csse_handler_global.parse_csv_file_contents(
-            self.global_confirmed_dataset)
+        csse_handler_global = CSSEGISandData(
+            logger, USFileType=False, engine=self.engine)
+        global_confirmed_gps_data = self.parse_records(
+            csse_handler_global, "Global Confirmed")
         self.date_keys_sanity_check(csse_handler_global.date_keys)
-        csse_handler_us = CSSEGISandData(logger, USFileType=True)
-        us_confirmed_gps_data = csse_handler_us.parse_csv_file_contents(
-            self.us_confirmed_dataset)
+        csse_handler_us = CSSEGISandData(
+            logger, USFileType=True, engine=self.engine)
+        us_confirmed_gps_data = self.parse_records(
+            csse_handler_us, "US Confirmed")
         self.date_keys_sanity_check(csse_handler_us.date_keys)
-        confirmed_gps_data = utils.merge_dict(
+        confirmed_gps_data = self.merge_records(
             global_confirmed_gps_data, us_confirmed_gps_data)
-        utils.write_to_file("data/confirmed.json",
-                            csse_handler_global.generate_globe_json_string(confirmed_gps_data, self.global_population_dataset, self.global_population))
+        self.write_outputs(csse_handler_global,
+                           confirmed_gps_data, "confirmed")
 
     def process_deaths(self):
         """
         Processes the global confirmed in-memory records
         """
+        if self.skip_unchanged("deaths"):
+            return
         logger = logging.getLogger("Deaths")
-        csse_handler_global = CSSEGISandData(logger, USFileType=False)
-        global_deaths_gps_data = csse_handler_global.parse_csv_file_contents(
-            self.global_deaths_dataset)
+        csse_handler_global = CSSEGISandData(
+            logger, USFileType=False, engine=self.engine)
+        global_deaths_gps_data = self.parse_records(
+            csse_handler_global, "Global Deaths")
         self.date_keys_sanity_check(csse_handler_global.date_keys)
         # The header of the US file has the dates start at offset 12
         # perhaps we should validate this never changes, or the data will
         # be out of sync
         csse_handler_us = CSSEGISandData(
-            logger, USFileType=True, offset_dates=12)
-        us_deaths_gps_data = csse_handler_us.parse_csv_file_contents(
-            self.us_deaths_dataset)
+            logger, USFileType=True, offset_dates=12, engine=self.engine)
+        us_deaths_gps_data = self.parse_records(
+            csse_handler_us, "US Deaths")
         self.date_keys_sanity_check(csse_handler_us.date_keys)
-        deaths_gps_data = utils.merge_dict(
+        deaths_gps_data = self.merge_records(
             global_deaths_gps_data, us_deaths_gps_data)
-        utils.write_to_file("data/deaths.json",
-                            csse_handler_global.generate_globe_json_string(deaths_gps_data, self.global_population_dataset, self.global_population))
+        self.write_outputs(csse_handler_global,
+                           deaths_gps_data, "deaths")
 
     def process_recovered(self):
         """
         Processes the global confirmed in-memory records
         """
+        if self.skip_unchanged("recovered"):
+            return
         logger = logging.getLogger("Recovered")
-        csse_handler_global = CSSEGISandData(logger)
-        global_recovered_gps_data = csse_handler_global.parse_csv_file_contents(
-            self.global_recovered_dataset)
+        csse_handler_global = CSSEGISandData(logger, engine=self.engine)
+        global_recovered_gps_data = self.parse_records(
+            csse_handler_global, "Global Recovered")
         self.date_keys_sanity_check(csse_handler_global.date_keys)
         # _date_keys, us_recovered_gps_data = parse_csv_file_contents("../../COVID-19/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_US.csv", USFileType=True)
         # There's no recovered dataset for US
-        utils.write_to_file("data/recovered.json",
-                            csse_handler_global.generate_globe_json_string(global_recovered_gps_data, self.global_population_dataset, self.global_population))
+        self.write_outputs(csse_handler_global,
+                           global_recovered_gps_data, "recovered")
+
+    def process_all(self, workers=1):
+        """
+        Processes confirmed, deaths and recovered.
+        With more than one worker, the metrics are processed at the same time in a process pool.
+        :param workers int: The number of worker processes, 1 processes them sequentially
+        """
+        if workers <= 1:
+            for metric in METRICS:
+                getattr(self, "process_{}".format(metric))()
+            self.write_combined()
+            self.save_tags()
+            return
+        self.logger.info("INIT processing %s with %s workers",
+                         ",".join(METRICS), workers)
+        with ProcessPoolExecutor(max_workers=min(workers, len(METRICS)),
+                                 initializer=init_metric_worker, initargs=(self,)) as executor:
+            futures = [executor.submit(process_metric_in_worker, metric)
+                       for metric in METRICS]
+            committed = 0
+            try:
+                # The results are checked in the METRICS order, like the sequential run,
+                # and the outputs of a metric are committed only once its date keys matched
+                for future in futures:
+                    result = future.result()
+                    # A skipped metric has no date keys
+                    if result["date_keys"]:
+                        self.date_keys_sanity_check(result["date_keys"])
+                    utils.commit_staged_files(result["staged_files"])
+                    committed += 1
+                    self.metrics.extend(result["metrics"].spans)
+                    self.metrics.outputs.update(result["metrics"].outputs)
+                    if self.output_tags is not None:
+                        # Tagged again now that the files, i.e. the tiles of the manifest, are in place
+                        for name, tag in result["output_tags"].items():
+                            self.output_tags.tag(
+                                name, tag["input_hash"], self.output_files(name))
+                    if self.local_source is not None:
+                        self.local_source.files.update(result["source_files"])
+            finally:
+                # The metrics after a failed one are not written, like the sequential run
+                for future in futures[committed:]:
+                    if future.exception() is None:
+                        utils.discard_staged_files(
+                            future.result()["staged_files"])
+        self.write_combined()
+        self.save_tags()
+        self.logger.info("DONE processing %s", ",".join(METRICS))
+
+    def combined_input_hash(self):
+        """
+        Returns the hash of the input hashes of the metric outputs that the combined output joins
+        :returns str: The hex digest, None when a metric output of this run has no tag (i.e. stream mode)
+        """
+        if self.output_tags is None:
+            return None
+        inputs = dict()
+        inputs["combined_version"] = COMBINED_VERSION
+        inputs["metrics"] = dict()
+        for metric in METRICS:
+            # A generated output without a new tag would still have the tag of an older run
+            if self.metrics.outputs.get(metric) == "generated" and metric not in self.output_tags.completed:
+                return None
+            if metric not in self.output_tags.tags:
+                return None
+            inputs["metrics"][metric] = self.output_tags.tags[metric]["input_hash"]
+        return input_hash(inputs)
 
+    def write_combined(self):
+        """
+        Writes the combined output of the metrics into <output_dir>/combined.bin and its index into
+        <output_dir>/combined.json, unless it was written from the same metric outputs, see combined_input_hash.
+        The index is written last, so it never points to a missing blob.
+        """
+        if not self.combined:
+            return
+        files = [os.path.join(self.output_dir, file_name)
+                 for file_name in ("combined.bin", "combined.json")]
+        inputs_hash = self.combined_input_hash()
+        if inputs_hash is not None and self.output_tags.is_current("combined", inputs_hash, files):
+            self.logger.info("Reusing the combined output, the metrics didn't change")
+            self.metrics.outputs["combined"] = "reused"
+            return
+        with self.metrics.span("serialize", "combined.json"):
+            index, blob_chunks = CombinedOutput(
+                self.output_dir, METRICS).generate_binary("combined.bin")
+        self.write_output_chunks(files[0], blob_chunks, mode="wb")
+        self.write_output_chunks(files[1], [index])
+        self.metrics.outputs["combined"] = "generated"
+        if inputs_hash is not None:
+            self.output_tags.tag("combined", inputs_hash, files)
+
+    def save_tags(self):
+        """
+        Persists the output tags and the local source fingerprints once the outputs are written
+        """
+        reused = [name for name, status in self.metrics.outputs.items()
+                  if status == "reused"]
+        if reused:
+            self.logger.info("Reused outputs: %s", ",".join(reused))
+        if self.output_tags is not None:
+            self.output_tags.save()
+        if self.local_source is not None:
+            self.local_source.save()
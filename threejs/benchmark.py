@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Benchmarks the parsing, stats and output generation on synthetic files shaped
+like the CSSEGISandData time series, so it runs without network access.
+The results are written as JSON to compare them between commits:
+    ./benchmark.py --locations 10000 --dates 3000 --output before.json
+    ./benchmark.py --locations 10000 --dates 3000 --compare before.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import logging
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy
+from CSSEGISandData import CSSEGISandData, CSSEGISandDataHelper
+from metrics import max_rss_bytes
+
+BENCHMARK_VERSION = 1
+FIRST_DATE = datetime.date(2020, 1, 22)
+
+
+def synthetic_date_headers(dates):
+    """
+    Returns the date headers of the time series, i.e. 1/22/20, starting on the first upstream day
+    :param dates int: The number of days
+    """
+    res = []
+    for day_number in range(dates):
+        date = FIRST_DATE + datetime.timedelta(days=day_number)
+        res.append("{}/{}/{}".format(date.month, date.day, date.strftime("%y")))
+    return res
+
+
+def synthetic_cumulative(locations, dates, seed):
+    """
+    Returns a locations x dates matrix of non-decreasing cumulative values.
+    Each location starts at a random day and grows at its own rate.
+    """
+    random_state = numpy.random.RandomState(seed)
+    rates = random_state.gamma(1.0, 20.0, size=(locations, 1))
+    increments = random_state.poisson(rates, size=(locations, dates))
+    first_days = random_state.randint(0, max(dates, 1), size=(locations, 1))
+    increments[numpy.arange(dates)[None, :] < first_days] = 0
+    return numpy.cumsum(increments, axis=1)
+
+
+def csv_value_lines(prefixes, cumulative):
+    """
+    Joins each location prefix with its row of values
+    """
+    return ["{},{}".format(prefix, ",".join(map(str, row)))
+            for prefix, row in zip(prefixes, cumulative.tolist())]
+
+
+def generate_global_csv(locations, dates, seed=0):
+    """
+    Returns a global time series file, with the aggregated US row first,
+    every 5th location has a province and some province names contain commas
+    :param locations int: The number of rows
+    :param dates int: The number of date columns
+    :param seed int: The seed of the random values
+    :returns bytes: The CSV contents
+    """
+    random_state = numpy.random.RandomState(seed)
+    lats = random_state.uniform(-60, 70, size=locations)
+    lngs = random_state.uniform(-180, 180, size=locations)
+    prefixes = []
+    for location_number in range(locations):
+        if location_number == 0:
+            province, country = "", "US"
+        elif location_number % 5 == 0:
+            province = '"Province, {}"'.format(location_number)
+            country = "Country {}".format(location_number // 5)
+        else:
+            province, country = "", "Country {}".format(location_number)
+        prefixes.append("{},{},{:.4f},{:.4f}".format(
+            province, country, lats[location_number], lngs[location_number]))
+    header = ["Province/State", "Country/Region",
+              "Lat", "Long"] + synthetic_date_headers(dates)
+    lines = [",".join(header)] + csv_value_lines(
+        prefixes, synthetic_cumulative(locations, dates, seed))
+    return "\n".join(lines).encode()
+
+
+def generate_us_csv(locations, dates, seed=0, population_column=False):
+    """
+    Returns an US time series file, one row per county
+    :param locations int: The number of counties
+    :param dates int: The number of date columns
+    :param seed int: The seed of the random values
+    :param population_column bool: Add the Population column of the US deaths file
+    :returns bytes: The CSV contents
+    """
+    random_state = numpy.random.RandomState(seed + 1)
+    lats = random_state.uniform(25, 49, size=locations)
+    lngs = random_state.uniform(-124, -67, size=locations)
+    populations = random_state.randint(1000, 1000000, size=locations)
+    prefixes = []
+    for location_number in range(locations):
+        county = "County {}".format(location_number)
+        state = "State {}".format(location_number // 60)
+        prefix = '{},US,USA,840,{},{},{},US,{:.4f},{:.4f},"{}, {}, US"'.format(
+            84000000 + location_number, 1000 + location_number, county, state,
+            lats[location_number], lngs[location_number], county, state)
+        if population_column:
+            prefix = "{},{}".format(prefix, populations[location_number])
+        prefixes.append(prefix)
+    header = ["UID", "iso2", "iso3", "code3", "FIPS", "Admin2", "Province_State",
+              "Country_Region", "Lat", "Long_", "Combined_Key"]
+    if population_column:
+        header.append("Population")
+    header += synthetic_date_headers(dates)
+    lines = [",".join(header)] + csv_value_lines(
+        prefixes, synthetic_cumulative(locations, dates, seed + 1))
+    return "\n".join(lines).encode()
+
+
+def synthetic_population(locations):
+    """
+    Returns the population dataset of the countries of generate_global_csv
+    """
+    res = dict()
+    for location_number in range(1, locations):
+        if location_number % 5:
+            res["Country {}".format(location_number)] = 1000000 + location_number
+    return res
+
+
+def git_commit():
+    """
+    Returns the commit of the working tree, None outside of a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """
+    Runs the benchmarks on synthetic data and collects their results
+    """
+
+    def __init__(self, locations=280, us_locations=3000, dates=500, repeat=3,
+                 engines=("dict", "numpy"), memory=True, seed=0):
+        """
+        Generates the synthetic datasets
+        :param locations int: Rows of the global files
+        :param us_locations int: Rows of the US files
+        :param dates int: Date columns of all the files
+        :param repeat int: Timed runs of each benchmark, the minimum and median are reported
+        :param engines list: The parsing engines to benchmark
+        :param memory bool: Also run each benchmark once with tracemalloc to find its peak allocations
+        :param seed int: The seed of the random values
+        """
+        self.logger = logging.getLogger("Benchmark")
+        self.locations = locations
+        self.us_locations = us_locations
+        self.dates = dates
+        self.repeat = repeat
+        self.engines = engines
+        self.memory = memory
+        self.seed = seed
+        self.logger.info("INIT generating %s global and %s US locations x %s dates",
+                         locations, us_locations, dates)
+        self.global_csv = generate_global_csv(locations, dates, seed)
+        self.us_confirmed_csv = generate_us_csv(us_locations, dates, seed)
+        self.us_deaths_csv = generate_us_csv(
+            us_locations, dates, seed, population_column=True)
+        self.global_population_dataset = synthetic_population(locations)
+        self.global_population = sum(self.global_population_dataset.values())
+        self.logger.info("DONE generating the datasets")
+        self.results = []
+
+    def measure(self, name, engine, function, locations):
+        """
+        Times a function and records its result
+        :param name str: The name of the benchmark
+        :param engine str: The parsing engine used
+        :param function function: The function to measure, called without arguments
+        :param locations int: The locations processed, to report the cells per second
+        """
+        timings = []
+        for _run in range(self.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        result = dict()
+        result["name"] = name
+        result["engine"] = engine
+        result["runs"] = self.repeat
+        result["seconds_min"] = min(timings)
+        result["seconds_median"] = float(numpy.median(timings))
+        result["locations"] = locations
+        result["dates"] = self.dates
+        result["cells_per_second"] = locations * self.dates / min(timings)
+        if self.memory:
+            # tracemalloc slows the allocations down, so it's not enabled on the timed runs
+            gc.collect()
+            tracemalloc.start()
+            function()
+            result["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        result["max_rss_bytes"] = max_rss_bytes()
+        self.logger.info("%s (%s): %.3fs", name, engine, result["seconds_min"])
+        self.results.append(result)
+        return result
+
+    def helper(self, engine, output_dir):
+        """
+        Returns a CSSEGISandDataHelper loaded with the synthetic datasets
+        """
+        csse_helper = CSSEGISandDataHelper(
+            self.logger, engine=engine, load_population=False, output_dir=output_dir)
+        csse_helper.global_population_dataset = self.global_population_dataset
+        csse_helper.global_population = self.global_population
+        csse_helper.global_confirmed_dataset = self.global_csv
+        csse_helper.global_deaths_dataset = self.global_csv
+        csse_helper.global_recovered_dataset = self.global_csv
+        csse_helper.us_confirmed_dataset = self.us_confirmed_csv
+        csse_helper.us_deaths_dataset = self.us_deaths_csv
+        return csse_helper
+
+    def run(self):
+        """
+        Runs all the benchmarks of each engine
+        :returns list: The results, one dict per benchmark and engine
+        """
+        total_locations = self.locations + self.us_locations
+        for engine in self.engines:
+            self.measure("parse_global", engine, lambda: CSSEGISandData(
+                self.logger, engine=engine).parse_csv_file_contents(self.global_csv), self.locations)
+            self.measure("parse_us", engine, lambda: CSSEGISandData(
+                self.logger, USFileType=True, engine=engine).parse_csv_file_contents(self.us_confirmed_csv), self.us_locations)
+            csse_handler = CSSEGISandData(self.logger, engine=engine)
+            records = csse_handler.parse_csv_file_contents(self.global_csv)
+            last_day = csse_handler.date_keys[-1]
+            # A single day, get_stats_for_day scans all the records for each day
+            self.measure("get_stats_for_day", engine, lambda: csse_handler.get_stats_for_day(
+                records, last_day, self.global_population_dataset, self.global_population), self.locations)
+            self.measure("get_series_stats", engine, lambda: csse_handler.get_series_stats(
+                records, self.global_population_dataset, self.global_population), self.locations)
+            self.measure("generate_globe_json_string", engine, lambda: csse_handler.generate_globe_json_string(
+                records, self.global_population_dataset, self.global_population), self.locations)
+            del records
+            with tempfile.TemporaryDirectory() as output_dir:
+                csse_helper = self.helper(engine, output_dir)
+                self.measure("process_confirmed", engine,
+                             csse_helper.process_confirmed, total_locations)
+                self.measure("process_deaths", engine,
+                             csse_helper.process_deaths, total_locations)
+                self.measure("process_recovered", engine,
+                             csse_helper.process_recovered, self.locations)
+        return self.results
+
+    def report(self):
+        """
+        Returns the results along with the configuration and environment of the run
+        """
+        res = dict()
+        res["benchmark_version"] = BENCHMARK_VERSION
+        res["git_commit"] = git_commit()
+        res["python"] = platform.python_version()
+        res["numpy"] = numpy.__version__
+        res["platform"] = platform.platform()
+        res["config"] = {
+            "locations": self.locations,
+            "us_locations": self.us_locations,
+            "dates": self.dates,
+            "repeat": self.repeat,
+            "engines": list(self.engines),
+            "seed": self.seed,
+        }
+        res["results"] = self.results
+        return res
+
+
+def compare_results(previous, current):
+    """
+    Returns the speedup of each benchmark present in both reports
+    :param previous dict: A report written by a previous run
+    :param current dict: The report of this run
+    :returns list: (name, engine, previous seconds, current seconds, speedup) tuples
+    """
+    previous_seconds = {(result["name"], result["engine"]): result["seconds_min"]
+                        for result in previous["results"]}
+    res = []
+    for result in current["results"]:
+        key = (result["name"], result["engine"])
+        if key in previous_seconds:
+            res.append((result["name"], result["engine"], previous_seconds[key],
+                        result["seconds_min"], previous_seconds[key] / result["seconds_min"]))
+    return res
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments
+    :param argv list: The arguments, by default sys.argv is used
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmarks transform.py on synthetic CSSEGISandData files")
+    parser.add_argument("--locations", type=int, default=280,
+                        help="Rows of the synthetic global files")
+    parser.add_argument("--us-locations", type=int, default=3000,
+                        help="Rows of the synthetic US files")
+    parser.add_argument("--dates", type=int, default=500,
+                        help="Date columns of the synthetic files")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs of each benchmark")
+    parser.add_argument("--engine", nargs="+", choices=["dict", "numpy"], default=["dict", "numpy"],
+                        help="The parsing engines to benchmark")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the tracemalloc run of each benchmark")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic values")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="Where the JSON results are written")
+    parser.add_argument("--compare",
+                        help="A previous results file to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The parsers log every date key found and the writers every file, keep only the benchmark logs
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("Benchmark").setLevel(logging.INFO)
+    logger = logging.getLogger("main benchmark")
+    logger.setLevel(logging.INFO)
+    benchmark = Benchmark(locations=args.locations, us_locations=args.us_locations,
+                          dates=args.dates, repeat=args.repeat, engines=args.engine,
+                          memory=not args.no_memory, seed=args.seed)
+    benchmark.run()
+    report = benchmark.report()
+    with open(args.output, "w") as file_handle:
+        json.dump(report, file_handle, indent=2)
+    logger.info("Results written to %s", args.output)
+    if args.compare:
+        with open(args.compare) as file_handle:
+            previous = json.load(file_handle)
+        for name, engine, previous_seconds, current_seconds, speedup in compare_results(previous, report):
+            logger.info("%s (%s): %.3fs -> %.3fs, %.2fx",
+                        name, engine, previous_seconds, current_seconds, speedup)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Columnar storage for the CSSEGISandData time series.
+Instead of one dict per location-day, the cumulative values are kept in a
+single integer matrix (locations x dates) and the day/delta values are derived
+with vectorized differencing.
+"""
+import logging
+from collections.abc import Mapping
+import numpy
+
+
+def day_values(cumulative):
+    """
+    Derives the daily values from a cumulative matrix.
+    The first day has no previous value, so the daily value is the cumulative.
+    :param cumulative numpy.ndarray: locations x dates cumulative values
+    :returns numpy.ndarray: locations x dates daily values
+    """
+    res = numpy.empty_like(cumulative)
+    if cumulative.shape[1] == 0:
+        return res
+    res[:, 0] = cumulative[:, 0]
+    numpy.subtract(cumulative[:, 1:], cumulative[:, :-1], out=res[:, 1:])
+    return res
+
+
+def delta_values(day):
+    """
+    Derives the daily delta from a daily values matrix.
+    There is no delta for the first day, it is set to 0.
+    :param day numpy.ndarray: locations x dates daily values
+    :returns numpy.ndarray: locations x dates delta values
+    """
+    res = numpy.empty_like(day)
+    if day.shape[1] == 0:
+        return res
+    res[:, 0] = 0
+    numpy.subtract(day[:, 1:], day[:, :-1], out=res[:, 1:])
+    return res
+
+
+class LocationDays(Mapping):
+    """
+    Read-only view of a single location in the dict format:
+    {"Year-Month-Day": {"cumulative": X, "day": Y, "delta": Z}}
+    The dicts are created on access, they are not stored.
+    """
+
+    def __init__(self, records, row):
+        self.records = records
+        self.row = row
+
+    def __getitem__(self, date_key):
+        col = self.records.date_index[date_key]
+        return {
+            "cumulative": int(self.records.cumulative[self.row, col]),
+            "day": int(self.records.day[self.row, col]),
+            "delta": int(self.records.delta[self.row, col]),
+        }
+
+    def __iter__(self):
+        return iter(self.records.date_keys)
+
+    def __len__(self):
+        return len(self.records.date_keys)
+
+    def items(self):
+        """
+        Iterates over the days, converting a full row at once instead of cell by cell
+        """
+        cumulative = self.records.cumulative[self.row].tolist()
+        day = self.records.day[self.row].tolist()
+        delta = self.records.delta[self.row].tolist()
+        for col, date_key in enumerate(self.records.date_keys):
+            yield date_key, {
+                "cumulative": cumulative[col],
+                "day": day[col],
+                "delta": delta[col],
+            }
+
+
+class ColumnarRecords(Mapping):
+    """
+    The parsed time series of a file.
+    - keys_list: The "lat,lng,Country - Province" keys, one per matrix row
+    - lats, lngs, locations: The location metadata table, one entry per row
+    - location_indexes: The LocationIndex built for these rows, see CSSEGISandData.location_index
+    - date_keys: The "Year-Month-Day" keys, one per matrix column
+    - cumulative: numpy int64 matrix of locations x dates
+    It behaves as the dict returned by CSSEGISandData.parse_csv_file_contents
+    so it can be used as a compatibility view on the existing functions.
+    """
+
+    def __init__(self, keys, lats, lngs, locations, date_keys, cumulative):
+        self.logger = logging.getLogger("ColumnarRecords")
+        self.keys_list = list(keys)
+        self.lats = list(lats)
+        self.lngs = list(lngs)
+        self.locations = list(locations)
+        self.date_keys = list(date_keys)
+        self.cumulative = cumulative
+        self.row_index = {key: row for row, key in enumerate(self.keys_list)}
+        self.date_index = {date_key: col for col,
+                           date_key in enumerate(self.date_keys)}
+        self._day = None
+        self._delta = None
+        # The LocationIndex of these rows, built once per population dataset
+        self.location_indexes = dict()
+
+    @property
+    def day(self):
+        """
+        The daily values, calculated once on first access
+        """
+        if self._day is None:
+            self._day = day_values(self.cumulative)
+        return self._day
+
+    @property
+    def delta(self):
+        """
+        The daily delta values, calculated once on first access
+        """
+        if self._delta is None:
+            self._delta = delta_values(self.day)
+        return self._delta
+
+    def __getitem__(self, gps_key):
+        return LocationDays(self, self.row_index[gps_key])
+
+    def __iter__(self):
+        return iter(self.keys_list)
+
+    def __len__(self):
+        return len(self.keys_list)
+
+    def __contains__(self, gps_key):
+        return gps_key in self.row_index
+
+    def to_dict(self):
+        """
+        Materializes the records in the dict format of parse_csv_file_contents
+        """
+        return {key: dict(location_days.items()) for key, location_days in self.items()}
+
+    def tail(self, start, last_cumulative, last_day):
+        """
+        Returns the records of the date columns from start onwards.
+        The day/delta of the first column are derived from the values of the previous column,
+        which are given instead of read so the earlier columns don't need to be kept.
+        :param start int: The first date column to include
+        :param last_cumulative list: The cumulative value of each location on column start - 1
+        :param last_day list: The day value of each location on column start - 1
+        :returns ColumnarRecords: The trailing date columns
+        """
+        cumulative = self.cumulative[:, start:]
+        res = ColumnarRecords(self.keys_list, self.lats, self.lngs, self.locations,
+                              self.date_keys[start:], cumulative)
+        previous_cumulative = numpy.array(
+            last_cumulative, dtype=numpy.int64).reshape(-1, 1)
+        previous_day = numpy.array(last_day, dtype=numpy.int64).reshape(-1, 1)
+        day = numpy.diff(cumulative, axis=1, prepend=previous_cumulative)
+        res._day = day
+        res._delta = numpy.diff(day, axis=1, prepend=previous_day)
+        # Same rows, the location indexes can be shared
+        res.location_indexes = self.location_indexes
+        return res
+
+    def take(self, rows):
+        """
+        Returns the records of some rows, in the given order
+        :param rows numpy.ndarray: The row numbers to include
+        :returns ColumnarRecords: A new object with those rows
+        """
+        res = ColumnarRecords([self.keys_list[row] for row in rows], [self.lats[row] for row in rows],
+                              [self.lngs[row] for row in rows], [
+                                  self.locations[row] for row in rows],
+                              self.date_keys, self.cumulative[rows])
+        # The dict records carry their own day/delta, keep them as they are
+        if self._day is not None:
+            res._day = self._day[rows]
+        if self._delta is not None:
+            res._delta = self._delta[rows]
+        return res
+
+    def merge(self, other):
+        """
+        Merges two records in the same way utils.merge_dict does, the rows from other
+        overwrite the rows with the same key, new keys are appended at the end
+        :param other ColumnarRecords: The records to merge into a copy of these
+        :returns ColumnarRecords: A new object with the merged rows
+        """
+        if self.date_keys != other.date_keys:
+            raise ValueError("Unable to merge records with different date keys")
+        keys = list(self.keys_list)
+        lats = list(self.lats)
+        lngs = list(self.lngs)
+        locations = list(self.locations)
+        rows = list(range(len(keys)))
+        row_index = dict(self.row_index)
+        # The rows coming from other are offset by the size of this matrix
+        offset = len(self.keys_list)
+        for other_row, key in enumerate(other.keys_list):
+            if key in row_index:
+                rows[row_index[key]] = offset + other_row
+                continue
+            row_index[key] = len(keys)
+            keys.append(key)
+            lats.append(other.lats[other_row])
+            lngs.append(other.lngs[other_row])
+            locations.append(other.locations[other_row])
+            rows.append(offset + other_row)
+        cumulative = numpy.concatenate(
+            (self.cumulative, other.cumulative))[rows]
+        return ColumnarRecords(keys, lats, lngs, locations, self.date_keys, cumulative)
+
+    @classmethod
+    def from_gps_records(cls, gps_records, date_keys):
+        """
+        Builds the matrices from the dict format in a single pass.
+        Missing days are stored as 0, which contribute nothing to the stats.
+        :param gps_records dict: The output of CSSEGISandData.parse_csv_file_contents
+        :param date_keys list: The date keys that become the matrix columns
+        :returns ColumnarRecords: The records, or gps_records itself if it's already columnar
+        """
+        if isinstance(gps_records, cls):
+            return gps_records
+        date_index = {date_key: col for col, date_key in enumerate(date_keys)}
+        keys = list(gps_records.keys())
+        cumulative = numpy.zeros((len(keys), len(date_keys)), dtype=numpy.int64)
+        day = numpy.zeros_like(cumulative)
+        delta = numpy.zeros_like(cumulative)
+        lats = []
+        lngs = []
+        locations = []
+        for row, gps_key in enumerate(keys):
+            lat, lng, location = gps_key.split(",")
+            lats.append(lat)
+            lngs.append(lng)
+            locations.append(location)
+            for day_key, region_day_data in gps_records[gps_key].items():
+                col = date_index.get(day_key)
+                if col is None:
+                    continue
+                cumulative[row, col] = region_day_data["cumulative"]
+                day[row, col] = region_day_data["day"]
+                delta[row, col] = region_day_data["delta"]
+        res = cls(keys, lats, lngs, locations, date_keys, cumulative)
+        # The dict records carry their own day/delta, keep them as they are
+        res._day = day
+        res._delta = delta
+        return res
+
+
+def top_by_column(values):
+    """
+    Finds the top value of each column of a locations x dates matrix.
+    This mirrors scanning the locations in order and keeping a value only when it's
+    strictly greater than the current top, which starts at 0: The first location
+    with the highest positive value wins, if there is none the top is 0 at location 0.
+    :param values numpy.ndarray: locations x dates matrix
+    :returns tuple: (values numpy.ndarray, location indexes numpy.ndarray), one per column
+    """
+    if values.shape[0] == 0:
+        return (numpy.zeros(values.shape[1], dtype=values.dtype),
+                numpy.zeros(values.shape[1], dtype=numpy.int64))
+    location_idx = values.argmax(axis=0)
+    top = values[location_idx, numpy.arange(values.shape[1])]
+    positive = top > 0
+    return (numpy.where(positive, top, 0), numpy.where(positive, location_idx, 0))
+
+
+def top_k_by_column(values, k):
+    """
+    Finds the k top values of each column of a locations x dates matrix with a partial
+    selection, linear in the size of the matrix. Ties are broken by the lowest location,
+    as in top_by_column.
+    :param values numpy.ndarray: locations x dates matrix
+    :param k int: The number of locations per column, it's capped to the number of locations
+    :returns tuple: (location indexes, values), numpy.ndarray of dates x k sorted from the top down
+    """
+    locations, dates = values.shape
+    k = min(k, locations)
+    if k == 0:
+        return (numpy.zeros((dates, 0), dtype=numpy.int64),
+                numpy.zeros((dates, 0), dtype=values.dtype))
+    # The k-th value of each column, everything above it is in, the rest are ties
+    threshold = numpy.partition(values, locations - k, axis=0)[locations - k]
+    above = values > threshold
+    tied = values == threshold
+    tied_needed = k - above.sum(axis=0)
+    selected = above | (tied & (numpy.cumsum(tied, axis=0) <= tied_needed))
+    # Exactly k locations per column, nonzero on the transposed mask returns them by column
+    location_idx = numpy.nonzero(selected.T)[1].reshape(dates, k)
+    top = values.T[numpy.arange(dates)[:, None], location_idx]
+    order = numpy.lexsort((location_idx, -top), axis=1)
+    return (numpy.take_along_axis(location_idx, order, axis=1),
+            numpy.take_along_axis(top, order, axis=1))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Combined output of all the metrics, built from their binary outputs.
+The locations of the metrics are joined into a single table by name, each metric
+keeps its own Int32 matrix with the ids of its locations in that table, so the
+globe loads everything once and switches between the metrics without downloads.
+"""
+import json
+import logging
+import os
+
+COMBINED_VERSION = 1
+COPY_CHUNK_SIZE = 1 << 20
+
+
+class CombinedOutput:
+    """
+    The binary outputs of several metrics joined on their locations:
+    - locations: The location structs of all the metrics, a location is hidden if it's hidden in any of them
+    - metrics: By metric name, the binary index and "location_ids", its rows in locations
+    """
+
+    def __init__(self, output_dir, metrics):
+        """
+        :param output_dir str: The directory of the binary outputs
+        :param metrics list: The names of the outputs, i.e. ["confirmed", "deaths", "recovered"]
+        """
+        self.logger = logging.getLogger("CombinedOutput")
+        self.output_dir = output_dir
+        self.locations = []
+        self.metrics = dict()
+        self.date_keys = None
+        location_ids = dict()
+        for metric in metrics:
+            with open(os.path.join(output_dir, "{}.index.json".format(metric))) as file_handle:
+                index = json.load(file_handle)
+            if self.date_keys is None:
+                self.date_keys = index["date_keys"]
+                self.channels = index["channels"]
+            elif index["date_keys"] != self.date_keys:
+                raise ValueError(
+                    "The date keys of {} do not match the other metrics".format(metric))
+            index["location_ids"] = []
+            occurrences = dict()
+            for location in index["locations"]:
+                # The n-th location with a name in a metric is the n-th one in the others
+                occurrence = occurrences.get(location["location"], 0)
+                occurrences[location["location"]] = occurrence + 1
+                identity = (location["location"], occurrence)
+                if identity not in location_ids:
+                    location_ids[identity] = len(self.locations)
+                    self.locations.append(dict(location))
+                location_id = location_ids[identity]
+                if location.get("hidden"):
+                    self.locations[location_id]["hidden"] = 1
+                index["location_ids"].append(location_id)
+            self.metrics[metric] = index
+        self.logger.info("Joined %s metrics into %s locations",
+                         len(metrics), len(self.locations))
+
+    def generate_binary(self, blob_name):
+        """
+        Returns the combined index JSON and the chunks of its blob, the blobs of the metrics one after the other
+        :param blob_name str: The file name of the blob, relative to the index
+        :returns tuple: (index JSON str, generator of bytes chunks)
+        """
+        index = dict()
+        index["format"] = "globe-combined"
+        index["version"] = COMBINED_VERSION
+        index["blob"] = blob_name
+        index["dtype"] = "<i4"
+        index["channels"] = self.channels
+        index["date_keys"] = self.date_keys
+        index["locations"] = self.locations
+        index["metrics"] = dict()
+        offset = 0
+        for metric, metric_index in self.metrics.items():
+            metric_struct = dict()
+            # The first Int32 of the metric matrix in the blob
+            metric_struct["offset"] = offset
+            metric_struct["shape"] = metric_index["shape"]
+            metric_struct["location_ids"] = metric_index["location_ids"]
+            metric_struct["series_stats"] = metric_index["series_stats"]
+            index["metrics"][metric] = metric_struct
+            offset += metric_index["shape"][0] * \
+                metric_index["shape"][1] * metric_index["shape"][2]
+
+        def blob_chunks():
+            # The metric blobs have the same layout, they are copied as they are
+            for metric_index in self.metrics.values():
+                with open(os.path.join(self.output_dir, metric_index["blob"]), "rb") as file_handle:
+                    for chunk in iter(lambda: file_handle.read(COPY_CHUNK_SIZE), b""):
+                        yield chunk
+        return (json.dumps(index), blob_chunks())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Derived metrics of the locations: rolling means of the daily values and rates per
+100k inhabitants, calculated for every location and day with cumulative sums, so
+the cost is linear in the number of cells whatever the window.
+They are written as a Float32 blob with the same locations and dates as the binary
+output, its index has the channels and their top location of each day.
+"""
+import json
+import logging
+import numpy
+from columnar import top_by_column
+
+DERIVED_VERSION = 1
+DERIVED_CHANNELS = ["day_avg_7", "day_avg_14",
+                    "day_avg_7_per_100k", "cumulative_per_100k"]
+
+
+def rolling_mean(values, window):
+    """
+    Returns the mean of each day and the previous window - 1 days, the first
+    days are the mean of the days available
+    :param values numpy.ndarray: locations x dates integer matrix
+    :param window int: The number of days
+    :returns numpy.ndarray: locations x dates float64 matrix
+    """
+    cumsum = numpy.zeros(
+        (values.shape[0], values.shape[1] + 1), dtype=numpy.int64)
+    numpy.cumsum(values, axis=1, out=cumsum[:, 1:])
+    ends = numpy.arange(1, values.shape[1] + 1)
+    starts = numpy.maximum(ends - window, 0)
+    return (cumsum[:, ends] - cumsum[:, starts]) / (ends - starts)
+
+
+class DerivedMetrics:
+    """
+    The DERIVED_CHANNELS of the drawable locations, in the order of the outputs:
+    - day_avg_7, day_avg_14: The rolling means of the daily values
+    - day_avg_7_per_100k, cumulative_per_100k: Per 100k inhabitants, 0 for the locations without population
+    """
+
+    def __init__(self, records, location_index):
+        """
+        :param records ColumnarRecords: The records of the output
+        :param location_index LocationIndex: The index of the records, see CSSEGISandData.location_index
+        """
+        self.logger = logging.getLogger("DerivedMetrics")
+        rows = location_index.valid_ids
+        self.date_keys = sorted(records.date_keys)
+        columns = [records.date_index[date_key] for date_key in self.date_keys]
+        self.hidden = location_index.hidden[rows]
+        self.has_population = location_index.has_population[rows]
+        # The locations without population are divided by 1 and then zeroed
+        population = numpy.where(
+            self.has_population, location_index.population[rows], 1).astype(numpy.float64)
+        per_100k = numpy.where(self.has_population, 100000 / population, 0)[:, None]
+        day = records.day[rows][:, columns]
+        self.values = dict()
+        self.values["day_avg_7"] = rolling_mean(day, 7)
+        self.values["day_avg_14"] = rolling_mean(day, 14)
+        self.values["day_avg_7_per_100k"] = self.values["day_avg_7"] * per_100k
+        self.values["cumulative_per_100k"] = records.cumulative[rows][:, columns] * per_100k
+
+    def series_stats(self):
+        """
+        Returns the top location of each channel for every day, sorted by date key.
+        The hidden locations are not included, the per 100k channels only include
+        the locations with population.
+        :returns list: [{"name", "top_<channel>": {"value", "location_idx"}}]
+        """
+        tops = dict()
+        for channel in DERIVED_CHANNELS:
+            included = ~self.hidden
+            if channel.endswith("_per_100k"):
+                included &= self.has_population
+            included_ids = numpy.flatnonzero(included)
+            top, top_idx = top_by_column(self.values[channel][included_ids])
+            if len(included_ids):
+                top_idx = numpy.where(top > 0, included_ids[top_idx], 0)
+            tops[channel] = (top.tolist(), top_idx.tolist())
+        res = []
+        for col, date_key in enumerate(self.date_keys):
+            day_stats = dict()
+            day_stats["name"] = date_key
+            for channel in DERIVED_CHANNELS:
+                top, top_idx = tops[channel]
+                day_stats["top_{}".format(channel)] = {
+                    "value": top[col], "location_idx": top_idx[col]}
+            res.append(day_stats)
+        return res
+
+    def generate_binary(self, blob_name):
+        """
+        Returns the index JSON and the chunks of the Float32 blob of locations x dates x channels
+        :param blob_name str: The file name of the blob, relative to the index
+        :returns tuple: (index JSON str, generator of bytes chunks)
+        """
+        index = dict()
+        index["format"] = "globe-derived"
+        index["version"] = DERIVED_VERSION
+        index["blob"] = blob_name
+        index["dtype"] = "<f4"
+        index["channels"] = DERIVED_CHANNELS
+        index["shape"] = [len(self.hidden), len(self.date_keys),
+                          len(DERIVED_CHANNELS)]
+        index["date_keys"] = self.date_keys
+        index["series_stats"] = self.series_stats()
+
+        def blob_chunks():
+            # One location at a time, to avoid a copy of the whole matrix
+            for location_id in range(len(self.hidden)):
+                yield numpy.stack([self.values[channel][location_id] for channel in DERIVED_CHANNELS],
+                                  axis=1).astype("<f4").tobytes()
+        return (json.dumps(index), blob_chunks())
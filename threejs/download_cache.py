@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""
+On-disk cache of the downloaded datasources.
+The bodies are stored with their ETag/Last-Modified so the next requests are
+conditional, and they can be used to run without network access.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = 60
+
+
+def create_session(pool_size=10, retries=3, backoff_factor=0.5):
+    """
+    Creates a session whose connections are pooled and reused between requests.
+    Failed connections and 429/5xx responses are retried with exponential backoff.
+    :param pool_size int: The maximum number of connections kept per host
+    :param retries int: The number of retries of a request
+    :param backoff_factor float: The sleep between retries is backoff_factor * 2 ^ (retry - 1)
+    :returns requests.Session: The session
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(["GET", "HEAD"]))
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class TeeReader(io.RawIOBase):
+    """
+    Reads a binary stream counting the bytes read, optionally copying them into a file
+    """
+
+    def __init__(self, source, copy_to=None):
+        """
+        :param source: The binary stream, i.e. a file or the raw stream of a response
+        :param copy_to: A binary file that receives a copy of the bytes read
+        """
+        self.source = source
+        self.copy_to = copy_to
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self.bytes_read += size
+        if self.copy_to is not None:
+            self.copy_to.write(data)
+        return size
+
+
+def text_lines(reader):
+    """
+    Decodes a binary stream into lines of text, as the csv module expects them
+    :param reader TeeReader: The binary stream
+    :returns io.TextIOWrapper: An iterator of the lines
+    """
+    return io.TextIOWrapper(io.BufferedReader(reader), encoding="utf-8", newline="")
+
+
+@contextmanager
+def open_url_stream(session, url, timeout=DEFAULT_TIMEOUT):
+    """
+    Yields a TeeReader over the body of an URL as it's received
+    :param session requests.Session: The session used for the request
+    :param url str: The URL to download
+    :param timeout float: The timeout in seconds of the request
+    """
+    with session.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        # Undo the Content-Encoding, i.e. gzip, as the body is read
+        response.raw.decode_content = True
+        yield TeeReader(response.raw)
+
+
+class DownloadCache:
+    """
+    Caches the body of URLs in a directory, one body and one metadata file per URL.
+    """
+
+    def __init__(self, cache_dir, offline=False, session=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Sets up the cache directory
+        :param cache_dir str: The directory where the downloads are stored
+        :param offline bool: Only use the cached bodies, never perform requests
+        :param session requests.Session: The session used for the requests
+        :param timeout float: The timeout in seconds of each request
+        """
+        self.logger = logging.getLogger("DownloadCache")
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.session = session if session is not None else create_session()
+        self.timeout = timeout
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_paths(self, url):
+        """
+        Returns the body and metadata file paths of an URL
+        """
+        url_hash = hashlib.sha256(url.encode()).hexdigest()
+        return (os.path.join(self.cache_dir, "{}.body".format(url_hash)),
+                os.path.join(self.cache_dir, "{}.json".format(url_hash)))
+
+    def load(self, url):
+        """
+        Returns the cached body and metadata of an URL
+        :returns tuple: (bytes, dict), the body is None when the URL is not cached
+        """
+        body_path, meta_path = self.cache_paths(url)
+        try:
+            with open(meta_path) as file_handle:
+                meta = json.load(file_handle)
+            with open(body_path, "rb") as file_handle:
+                body = file_handle.read()
+        except (OSError, ValueError):
+            return (None, dict())
+        return (body, meta)
+
+    def load_meta(self, url):
+        """
+        Returns the metadata of a cached URL without reading its body
+        :returns dict: The metadata, None when the URL is not cached
+        """
+        body_path, meta_path = self.cache_paths(url)
+        try:
+            with open(meta_path) as file_handle:
+                meta = json.load(file_handle)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.exists(body_path) else None
+
+    def store(self, url, body, headers):
+        """
+        Stores the body and the validators of a response
+        """
+        body_path, meta_path = self.cache_paths(url)
+        # The body is written first, the metadata marks the entry as complete
+        self.write_atomically(body_path, body)
+        self.store_meta(url, headers)
+
+    def store_meta(self, url, headers):
+        """
+        Stores the validators of a response whose body is already in the cache
+        """
+        _body_path, meta_path = self.cache_paths(url)
+        meta = dict()
+        meta["url"] = url
+        meta["etag"] = headers.get("ETag")
+        meta["last_modified"] = headers.get("Last-Modified")
+        self.write_atomically(meta_path, json.dumps(meta).encode())
+
+    def write_atomically(self, filename, content):
+        """
+        Writes the content in a temporary file and renames it into place
+        """
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(file_descriptor, "wb") as file_handle:
+                file_handle.write(content)
+            os.replace(tmp_path, filename)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, url):
+        """
+        Returns the body of an URL.
+        A cached URL is requested with If-None-Match/If-Modified-Since and a
+        304 reuses the cached body. When the request fails the cached body is used.
+        :param url str: The URL to download
+        :returns bytes: The body of the URL
+        """
+        body, meta = self.load(url)
+        if self.offline:
+            if body is None:
+                raise FileNotFoundError(
+                    "Offline mode and {} is not in the cache {}".format(url, self.cache_dir))
+            self.logger.debug("Offline mode, using cached %s", url)
+            return body
+        headers = dict()
+        if body is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = self.session.get(
+                url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and body is not None:
+                self.logger.debug("Not modified, using cached %s", url)
+                return body
+            response.raise_for_status()
+        except requests.RequestException as err:
+            if body is None:
+                raise
+            self.logger.warning(
+                "Unable to download %s, using the cached copy: %s", url, err)
+            return body
+        self.store(url, response.content, response.headers)
+        return response.content
+
+    @contextmanager
+    def open_stream(self, url):
+        """
+        Yields a TeeReader over the body of an URL, like get but without holding the body in memory.
+        A new body is copied into the cache as it's read, and only stored once it was read completely.
+        A 304, a failed request or the offline mode read the cached body from its file.
+        :param url str: The URL to download
+        """
+        body_path, _meta_path = self.cache_paths(url)
+        meta = self.load_meta(url)
+        if self.offline:
+            if meta is None:
+                raise FileNotFoundError(
+                    "Offline mode and {} is not in the cache {}".format(url, self.cache_dir))
+            self.logger.debug("Offline mode, streaming cached %s", url)
+            with open(body_path, "rb") as file_handle:
+                yield TeeReader(file_handle)
+            return
+        headers = dict()
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            response = self.session.get(
+                url, headers=headers, timeout=self.timeout, stream=True)
+            if response.status_code != 304 or meta is None:
+                response.raise_for_status()
+        except requests.RequestException as err:
+            if meta is None:
+                raise
+            self.logger.warning(
+                "Unable to download %s, streaming the cached copy: %s", url, err)
+            response = None
+        if response is None or response.status_code == 304:
+            if response is not None:
+                response.close()
+                self.logger.debug("Not modified, streaming cached %s", url)
+            with open(body_path, "rb") as file_handle:
+                yield TeeReader(file_handle)
+            return
+        with response:
+            response.raw.decode_content = True
+            file_descriptor, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            try:
+                with os.fdopen(file_descriptor, "wb") as copy_handle:
+                    reader = TeeReader(response.raw, copy_to=copy_handle)
+                    yield reader
+                    # The reader may stop before the end, the cached copy must be complete
+                    while reader.read(io.DEFAULT_BUFFER_SIZE):
+                        pass
+                os.replace(tmp_path, body_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.store_meta(url, response.headers)
@@ -313,6 +313,11 @@ DAT.Globe = function (container, colorFn) {
         renderer.setSize(window.innerWidth, window.innerHeight);
     }
 
+    this.getDistance = function () {
+        // The distance of the camera once the zoom finishes, 350 (zoomed in) to 1000 (zoomed out)
+        return distanceTarget;
+    }
+
     this.zoom = function (delta) {
         distanceTarget -= delta;
         distanceTarget = distanceTarget > 1000 ? 1000 : distanceTarget;
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Persisted state of a previous run, used to compute only the stats of the days
+that upstream appended since then. Only the stats are incremental, the records
+are still parsed and the outputs written in full.
+"""
+import hashlib
+import json
+import logging
+import os
+import numpy
+from columnar import ColumnarRecords
+import utils
+
+STATE_VERSION = 1
+
+
+def matrix_digest(matrix):
+    """
+    Returns a sha256 hex digest of the values of an integer matrix
+    """
+    return hashlib.sha256(numpy.ascontiguousarray(matrix, dtype=numpy.int64).tobytes()).hexdigest()
+
+
+def population_digest(global_population_dataset):
+    """
+    Returns a sha256 hex digest of the population table, the stats depend on it
+    """
+    population = sorted((str(country), int(value))
+                        for country, value in global_population_dataset.items())
+    return hashlib.sha256(json.dumps(population).encode()).hexdigest()
+
+
+class IncrementalState:
+    """
+    Keeps, for a single output, the date keys and locations that were processed,
+    a digest of the cumulative values, the per-location last cumulative and day
+    values and the per-day stats computed so far.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename str: The file where the state is persisted
+        """
+        self.logger = logging.getLogger("IncrementalState")
+        self.filename = filename
+        self.state = None
+
+    def load(self):
+        """
+        Loads the persisted state, a missing or unreadable state means a full rebuild
+        """
+        self.state = None
+        if not os.path.exists(self.filename):
+            self.logger.info("No previous state in %s", self.filename)
+            return
+        try:
+            with open(self.filename) as file_handle:
+                state = json.load(file_handle)
+        except (OSError, ValueError) as err:
+            self.logger.warning(
+                "Unable to read state %s: %s", self.filename, err)
+            return
+        if state.get("version") != STATE_VERSION:
+            self.logger.info("Ignoring state %s with version %s",
+                             self.filename, state.get("version"))
+            return
+        self.state = state
+
+    def appended_columns(self, records, population_hash):
+        """
+        Checks if the records only add trailing date columns to the persisted state
+        :param records ColumnarRecords: The records parsed on this run
+        :param population_hash str: The digest of the population table used on this run
+        :returns int: The number of columns already processed, or None if a full rebuild is needed
+        """
+        if self.state is None:
+            return None
+        previous_date_keys = self.state["date_keys"]
+        processed = len(previous_date_keys)
+        if processed == 0:
+            return None
+        if self.state["population_digest"] != population_hash:
+            self.logger.info("The population table changed, full rebuild")
+            return None
+        if records.date_keys != sorted(records.date_keys):
+            self.logger.info("The date columns are not sorted, full rebuild")
+            return None
+        if records.date_keys[:processed] != previous_date_keys:
+            self.logger.info("The previous date columns changed, full rebuild")
+            return None
+        if records.keys_list != self.state["location_keys"]:
+            self.logger.info("The locations changed, full rebuild")
+            return None
+        if matrix_digest(records.cumulative[:, :processed]) != self.state["prefix_digest"]:
+            self.logger.info("Previous values were revised upstream, full rebuild")
+            return None
+        return processed
+
+    def series_stats(self, csse_handler, gps_records, global_population_dataset, global_population):
+        """
+        Returns the series stats for the records, reusing the persisted stats when
+        upstream only appended new date columns. The state is updated but not saved.
+        :param csse_handler CSSEGISandData: The handler that parsed the records
+        :param gps_records dict: The per-day gps records, or ColumnarRecords
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param global_population int: The total population of the world
+        :returns list: The series stats, see CSSEGISandData.get_series_stats
+        """
+        records = ColumnarRecords.from_gps_records(
+            gps_records, csse_handler.date_keys)
+        population_hash = population_digest(global_population_dataset)
+        processed = self.appended_columns(records, population_hash)
+        if processed is None:
+            series_stats = csse_handler.get_series_stats(
+                records, global_population_dataset, global_population)
+        else:
+            self.logger.info("Reusing %s days, computing %s new days",
+                             processed, len(records.date_keys) - processed)
+            new_records = records.tail(
+                processed, self.state["last_cumulative"], self.state["last_day"])
+            series_stats = self.state["series_stats"] + csse_handler.get_series_stats(
+                new_records, global_population_dataset, global_population,
+                date_keys=new_records.date_keys)
+        state = dict()
+        state["version"] = STATE_VERSION
+        state["date_keys"] = records.date_keys
+        state["location_keys"] = records.keys_list
+        state["population_digest"] = population_hash
+        state["prefix_digest"] = matrix_digest(records.cumulative)
+        if records.date_keys:
+            state["last_cumulative"] = records.cumulative[:, -1].tolist()
+            state["last_day"] = records.day[:, -1].tolist()
+        else:
+            state["last_cumulative"] = [0] * len(records)
+            state["last_day"] = [0] * len(records)
+        state["series_stats"] = series_stats
+        self.state = state
+        return series_stats
+
+    def save(self):
+        """
+        Persists the state, it should be called once the outputs were written
+        """
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        utils.write_to_file(self.filename, json.dumps(self.state))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Reads the time series from a local clone of the CSSEGISandData/COVID-19 repo.
+The files are memory-mapped, and their size, mtime and content hash are kept
+between runs so an unchanged file doesn't need to be read to know its hash.
+"""
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+from contextlib import contextmanager
+from download_cache import TeeReader
+import utils
+
+SOURCES_STATE_VERSION = 2
+# The directory of the time series inside the repo clone
+TIME_SERIES_DIR = os.path.join("csse_covid_19_data", "csse_covid_19_time_series")
+
+
+class LocalSource:
+    """
+    The time series directory of a local checkout, and the fingerprints of its files.
+    """
+
+    def __init__(self, directory, state_file=None):
+        """
+        :param directory str: The time series directory, or the root of the repo clone
+        :param state_file str: Where the fingerprints are persisted between runs, by default they are not
+        """
+        self.logger = logging.getLogger("LocalSource")
+        if os.path.isdir(os.path.join(directory, TIME_SERIES_DIR)):
+            directory = os.path.join(directory, TIME_SERIES_DIR)
+        self.directory = directory
+        self.state_file = state_file
+        self.files = dict()
+        self.load()
+
+    def load(self):
+        """
+        Loads the fingerprints of the previous run, a missing or unreadable file means the files are hashed again
+        """
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file) as file_handle:
+                state = json.load(file_handle)
+        except (OSError, ValueError) as err:
+            self.logger.warning(
+                "Unable to read the sources state %s: %s", self.state_file, err)
+            return
+        if state.get("version") == SOURCES_STATE_VERSION:
+            self.files = state["files"]
+
+    def save(self):
+        """
+        Persists the fingerprints
+        """
+        if self.state_file is None:
+            return
+        state = dict()
+        state["version"] = SOURCES_STATE_VERSION
+        state["files"] = self.files
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        utils.write_to_file(self.state_file, json.dumps(state))
+
+    def path(self, file_name):
+        """
+        Returns the path of a time series file
+        """
+        return os.path.join(self.directory, file_name)
+
+    @contextmanager
+    def mapped(self, file_name):
+        """
+        Yields the contents of a file as a read-only memory map, the pages are loaded on access
+        """
+        with open(self.path(file_name), "rb") as file_handle:
+            if os.fstat(file_handle.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                yield b""
+                return
+            with mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                yield mapped_file
+
+    @contextmanager
+    def open_stream(self, file_name):
+        """
+        Yields a TeeReader over a memory-mapped file, like DownloadCache.open_stream
+        """
+        with self.mapped(file_name) as mapped_file:
+            if isinstance(mapped_file, bytes):
+                mapped_file = io.BytesIO(mapped_file)
+            yield TeeReader(mapped_file)
+
+    def fingerprint(self, file_name, previous=None):
+        """
+        Returns the size, mtime and sha256 of a file. When the size and mtime
+        match the previous fingerprint the file is not read again.
+        :param file_name str: The time series file
+        :param previous dict: The fingerprint of the previous run
+        :returns dict: {"size", "mtime_ns", "sha256"}
+        """
+        stat = os.stat(self.path(file_name))
+        res = dict()
+        res["size"] = stat.st_size
+        res["mtime_ns"] = stat.st_mtime_ns
+        if previous is not None and previous["size"] == res["size"] and previous["mtime_ns"] == res["mtime_ns"]:
+            res["sha256"] = previous["sha256"]
+            return res
+        with self.mapped(file_name) as mapped_file:
+            res["sha256"] = hashlib.sha256(mapped_file).hexdigest()
+        return res
+
+    def file_hash(self, file_name):
+        """
+        Returns the sha256 of a file, it's only read when its size or mtime changed since it was last hashed
+        :param file_name str: The time series file
+        """
+        self.files[file_name] = self.fingerprint(
+            file_name, self.files.get(file_name))
+        return self.files[file_name]["sha256"]
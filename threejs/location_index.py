@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Index of the locations of the parsed records.
+The "lat,lng,Country - Province" keys are parsed once into integer ids with
+float coordinates, country/province/county and a resolved population, so the
+later stages don't need to split the keys or look up the population again.
+"""
+import logging
+import numpy
+
+
+class LocationIndex:
+    """
+    One entry per records row, the location id is the row number:
+    - keys, locations: The "lat,lng,Country - Province" key and the "Country - Province" name
+    - countries, provinces, counties: The parts of the name, "" when missing
+    - lat, lng: numpy float64 arrays, NaN when they couldn't be parsed
+    - valid: numpy bool array, True when lat/lng were parsed and the location can be drawn
+    - population: numpy int64 array, 0 when the location is not in the population dataset
+    - has_population: numpy bool array, True when the location is in the population dataset
+    - hidden: numpy bool array, True for aggregated rows that are neither drawn nor totaled
+    """
+
+    def __init__(self, records, global_population_dataset, is_hidden):
+        """
+        Builds the index
+        :param records ColumnarRecords: The parsed records
+        :param global_population_dataset dict: The WorldOMeters population 2020 {"Country": <Population>}
+        :param is_hidden function: Returns True for the location names that are hidden
+        """
+        self.logger = logging.getLogger("LocationIndex")
+        self.global_population_dataset = global_population_dataset
+        location_count = len(records.locations)
+        self.keys = records.keys_list
+        self.locations = records.locations
+        self.countries = []
+        self.provinces = []
+        self.counties = []
+        self.lat = numpy.full(location_count, numpy.nan)
+        self.lng = numpy.full(location_count, numpy.nan)
+        self.valid = numpy.zeros(location_count, dtype=bool)
+        self.population = numpy.zeros(location_count, dtype=numpy.int64)
+        self.has_population = numpy.zeros(location_count, dtype=bool)
+        self.hidden = numpy.zeros(location_count, dtype=bool)
+        for location_id, location in enumerate(records.locations):
+            # The names look like "Country", "Country - Province" or "US - State - County"
+            name_parts = location.split(" - ", 2) + ["", ""]
+            self.countries.append(name_parts[0])
+            self.provinces.append(name_parts[1])
+            self.counties.append(name_parts[2])
+            try:
+                self.lat[location_id] = float(records.lats[location_id])
+                self.lng[location_id] = float(records.lngs[location_id])
+                self.valid[location_id] = True
+            except ValueError:
+                self.logger.error(
+                    "Unable to parse lat/lng on key %s", records.keys_list[location_id])
+            if location in global_population_dataset:
+                self.population[location_id] = int(
+                    global_population_dataset[location])
+                self.has_population[location_id] = self.population[location_id] > 0
+            self.hidden[location_id] = is_hidden(location)
+        self.valid_ids = numpy.flatnonzero(self.valid)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def location_struct(self, location_id):
+        """
+        Returns the metadata of a location as it's written in the outputs
+        :param location_id int: The id of a valid location
+        :returns dict: {"lat", "lng", "location", "population_2020"}, plus "hidden" for hidden locations
+        """
+        res = dict()
+        res["lat"] = float(self.lat[location_id])
+        res["lng"] = float(self.lng[location_id])
+        res["location"] = self.locations[location_id]
+        res["population_2020"] = int(self.population[location_id])
+        if self.hidden[location_id]:
+            res["hidden"] = 1
+        return res
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Spatial level of detail of the locations for the globe.
+The locations are bucketed into a quadtree over lat/lng: level z splits the globe
+into 2^z x 2^z cells, each cell being split into 4 on the next level. The values
+of the locations of each cell are summed for every day, so the globe can draw a
+few hundred clusters when it's zoomed out and the locations when it's zoomed in.
+"""
+import json
+import logging
+import numpy
+
+LOD_VERSION = 1
+DEFAULT_LOD_LEVEL = 6
+
+
+def cell_keys(lat, lng, level):
+    """
+    Returns the cell of each location on a level, as y * 2^level + x
+    :param lat numpy.ndarray: The latitudes, -90 to 90
+    :param lng numpy.ndarray: The longitudes, -180 to 180
+    :param level int: The quadtree level
+    """
+    cells = 2 ** level
+    x = numpy.clip(numpy.floor((lng + 180) / 360 * cells), 0, cells - 1).astype(numpy.int64)
+    y = numpy.clip(numpy.floor((lat + 90) / 180 * cells), 0, cells - 1).astype(numpy.int64)
+    return y * cells + x
+
+
+class LodIndex:
+    """
+    The clusters of each quadtree level, from level 0 (a single cell) to max_level.
+    Only the cells with locations are kept, the hidden locations are not included.
+    - levels: One dict per level, with one entry per cell in each list:
+      "lat", "lng" (the mean of its locations), "count" (its locations), "parent" (the
+      cell index on the previous level) and, on max_level, "locations" (the location ids)
+    - values: numpy int64 matrix of cells x dates x channels, the cells of all the levels in order
+    """
+
+    def __init__(self, records, location_index, max_level=DEFAULT_LOD_LEVEL):
+        """
+        :param records ColumnarRecords: The records of the output
+        :param location_index LocationIndex: The index of the records, see CSSEGISandData.location_index
+        :param max_level int: The finest quadtree level
+        """
+        self.logger = logging.getLogger("LodIndex")
+        rows = location_index.valid_ids
+        self.date_keys = sorted(records.date_keys)
+        columns = [records.date_index[date_key] for date_key in self.date_keys]
+        # The location ids are the positions in the outputs, the drawable rows
+        location_ids = numpy.flatnonzero(~location_index.hidden[rows])
+        drawn_rows = rows[location_ids]
+        lat = location_index.lat[drawn_rows]
+        lng = location_index.lng[drawn_rows]
+        channels = numpy.stack((records.cumulative[drawn_rows][:, columns],
+                                records.day[drawn_rows][:, columns],
+                                records.delta[drawn_rows][:, columns]), axis=2)
+        self.levels = []
+        level_values = []
+        parent_keys = None
+        for level in range(max_level + 1):
+            keys, cell_ids = numpy.unique(
+                cell_keys(lat, lng, level), return_inverse=True)
+            # Stable, so the locations keep their order inside a cell
+            order = numpy.argsort(cell_ids, kind="stable")
+            starts = numpy.searchsorted(cell_ids[order], numpy.arange(len(keys)))
+            counts = numpy.diff(numpy.append(starts, len(order)))
+            level_struct = dict()
+            level_struct["level"] = level
+            level_struct["lat"] = numpy.round(
+                self.sum_ranges(lat[order], starts) / counts, 4).tolist()
+            level_struct["lng"] = numpy.round(
+                self.sum_ranges(lng[order], starts) / counts, 4).tolist()
+            level_struct["count"] = counts.tolist()
+            if parent_keys is not None:
+                # The parent of (x, y) is (x // 2, y // 2) on the previous level
+                cells = 2 ** level
+                parents = (keys // cells // 2) * (cells // 2) + (keys % cells) // 2
+                level_struct["parent"] = numpy.searchsorted(parent_keys, parents).tolist()
+            if level == max_level:
+                level_struct["locations"] = [location_ids[order[start:start + count]].tolist()
+                                             for start, count in zip(starts, counts)]
+            self.levels.append(level_struct)
+            level_values.append(self.sum_ranges(channels[order], starts))
+            parent_keys = keys
+        self.values = numpy.concatenate(level_values)
+        self.logger.info("%s locations in %s cells on level %s", len(location_ids),
+                         len(self.levels[-1]["count"]), max_level)
+
+    @staticmethod
+    def sum_ranges(values, starts):
+        """
+        Returns the sums of the ranges of rows that start on each of starts
+        """
+        if len(starts) == 0:
+            return numpy.zeros((0,) + values.shape[1:], dtype=values.dtype)
+        return numpy.add.reduceat(values, starts, axis=0)
+
+    def generate_binary(self, blob_name):
+        """
+        Returns the index JSON and the chunks of the Int32 blob of cells x dates x channels
+        :param blob_name str: The file name of the blob, relative to the index
+        :returns tuple: (index JSON str, generator of bytes chunks)
+        """
+        int32 = numpy.iinfo(numpy.int32)
+        if self.values.size and (self.values.max() > int32.max or self.values.min() < int32.min):
+            raise ValueError("The values do not fit in the Int32 blob")
+        index = dict()
+        index["format"] = "globe-lod"
+        index["version"] = LOD_VERSION
+        index["blob"] = blob_name
+        index["dtype"] = "<i4"
+        index["channels"] = ["cumulative", "day", "delta"]
+        index["shape"] = list(self.values.shape)
+        index["date_keys"] = self.date_keys
+        offset = 0
+        for level_struct in self.levels:
+            # The first row of the level cells in the blob
+            level_struct["offset"] = offset
+            offset += len(level_struct["count"])
+        index["levels"] = self.levels
+
+        def blob_chunks():
+            # One cell at a time, to avoid a copy of the whole matrix
+            for cell_values in self.values:
+                yield cell_values.astype("<i4").tobytes()
+        return (json.dumps(index), blob_chunks())
@@ -9,6 +9,10 @@ if (!Detector.webgl) {
     var prev_stat_index = -1;
     var RADIAN = 180 / Math.PI;
     var TAU = Math.PI * 2;
+    // The coarsest level of detail drawn when zoomed out has at most this many clusters
+    var LOD_MAX_CLUSTERS = 400;
+    // The level of detail drawn on the globe, -1 when every location is drawn
+    var current_lod_level = -1;
 
     function locationHasDataforDelta(location_idx) {
         /* Checks if there's historic data before the current chosen day.
@@ -25,7 +29,7 @@ if (!Detector.webgl) {
         // XXX: This is a bad idea, using a hardcoded array index, maybe change it to a map(){idx: x, is_cumulative: true} with filter
         top_cumulative_idx = 0;
         // Zero entries, let's see if the previous day had data:
-        if (stats_config[top_cumulative_idx]["data_fn"](window.data["locations"][location_idx]["values"][current_day_index - 1], current_focused_location) > 0) {
+        if (stats_config[top_cumulative_idx]["data_fn"](locationDayValues(location_idx, current_day_index - 1), current_focused_location) > 0) {
             return true;
         }
         // If we reach this point, the previous day has no cumulative records and so the delta is meaningless
@@ -38,7 +42,7 @@ if (!Detector.webgl) {
             "series_stats_key": "cumulative_global",
             "legend": "Cases",
             "min_value_fn": function () {
-                return Math.min(0, ...window.data["locations"][current_focused_location]["values"].map(d => d[0]))
+                return Math.min(0, ...locationValues(current_focused_location).map(d => d[0]))
             },
             "max_value_fn": function () {return window.data["series_stats"][current_day_index]["top_cumulative"]["value"]},
             "data_fn": function (d, _loc) {return d[0]},
@@ -74,7 +78,7 @@ if (!Detector.webgl) {
             "series_stats_key": "day_global",
             "legend": "Cases",
             "min_value_fn": function () {
-                return Math.min(0, ...window.data["locations"][current_focused_location]["values"].map(d => d[1]))
+                return Math.min(0, ...locationValues(current_focused_location).map(d => d[1]))
             },
             "max_value_fn": function () {return window.data["series_stats"][current_day_index]["top_day"]["value"]},
             "data_fn": function (d, _loc) {return d[1]},
@@ -123,7 +127,7 @@ if (!Detector.webgl) {
             "legend": "Cases",
             // The trend can be negative, so we need to find the minimum value
             "min_value_fn": function () {
-                return Math.min(0, ...window.data["locations"][current_focused_location]["values"].map(d => d[2]))
+                return Math.min(0, ...locationValues(current_focused_location).map(d => d[2]))
             },
             "max_value_fn": function () {return window.data["series_stats"][current_day_index]["top_delta"]["value"]},
             "data_fn": function (d, _loc) {return d[2]},
@@ -170,7 +174,7 @@ if (!Detector.webgl) {
             "legend": "% of population",
             // The trend can be negative, so we need to find the minimum value
             "min_value_fn": function () {
-                return Math.min(0, ...window.data["locations"][current_focused_location]["values"].map(
+                return Math.min(0, ...locationValues(current_focused_location).map(
                     function (d) {
                         if (window.data["locations"][current_focused_location]["population_2020"] != "0") {
                             return (d[0] / window.data["locations"][current_focused_location]["population_2020"]) * 100;
@@ -241,7 +245,7 @@ function findClosestRegion(target_lat, target_lng, threshold = 5) {
     countrieInThreshold = Array();
     matchingLocations = window.data["locations"].map(function (_loc, idx) {
         // The value might not be drawn, so let's skip over non-drawn regions
-        day_value = stats_config[current_stat_index]["data_fn"](window.data["locations"][idx]["values"][current_day_index], idx)
+        day_value = stats_config[current_stat_index]["data_fn"](locationDayValues(idx, current_day_index), idx)
         color = stats_config[current_stat_index]["color_fn"](day_value, idx)
         if (color == null) {
             return {"idx": idx, "matches": false}
@@ -448,7 +452,7 @@ function updateCountryD3Graph(force = false) {
             series: [
                 {
                     name: window.data["locations"][current_focused_location]["location"],
-                    values: window.data["locations"][current_focused_location]["values"].map(
+                    values: locationValues(current_focused_location).map(
                         function (d) {
                             return stats_config[current_stat_index]["data_fn"](d, current_focused_location)
                         }
@@ -604,7 +608,7 @@ function updateFocusedRegionData() {
         current_focused_location = dayStats[stats_config[current_stat_index]["type"]]["location_idx"]
     }
     location_name = window.data["locations"][current_focused_location]["location"]
-    stat_value = stats_config[current_stat_index]["data_fn"](window.data["locations"][current_focused_location]["values"][current_day_index], current_focused_location)
+    stat_value = stats_config[current_stat_index]["data_fn"](locationDayValues(current_focused_location, current_day_index), current_focused_location)
     // Let's format the number to look like X,YYY
     stat_type = stats_config[current_stat_index]["type"]
     formatted_stat_value = stats_config[current_stat_index]["value_format_fn"](stat_value)
@@ -635,19 +639,66 @@ function updateFocusedRegionData() {
     centerGlobeToLocation(current_focused_location);
 }
 
+function lodLevelForDistance() {
+    // Returns the level of detail for the zoom of the globe, -1 to draw every location.
+    // Zoomed out draws the finest level with at most LOD_MAX_CLUSTERS clusters, zooming in
+    // refines up to the locations. The percent stat depends on the population of each location.
+    // The level applies to the whole globe, the cells in view are not refined more than the others.
+    if (!window.lod || !window.data || window.lod["date_keys"].length != window.data["series_stats"].length ||
+        stats_config[current_stat_index]["type"] == "top_cumulative_percent") {
+        return -1;
+    }
+    var levels = window.lod["levels"];
+    var coarsest = levels.length - 1;
+    while (coarsest > 0 && levels[coarsest]["count"].length > LOD_MAX_CLUSTERS) {
+        coarsest--;
+    }
+    var zoomed_out = (globe.getDistance() - 350) / 650;
+    var level = coarsest + Math.round((1 - zoomed_out) * (levels.length - coarsest));
+    return level >= levels.length ? -1 : level;
+}
+
+function loadLodClustersForDay(subgeo, level_idx) {
+    // Draws the clusters of a level of detail, sized relative to the largest cluster of the day
+    var level = window.lod["levels"][level_idx];
+    var days = window.lod["date_keys"].length;
+    var cluster_values = level["count"].map(function (_count, cell) {
+        var offset = ((level["offset"] + cell) * days + current_day_index) * 3;
+        return stats_config[current_stat_index]["data_fn"](window.lod["values_matrix"].subarray(offset, offset + 3), current_focused_location);
+    });
+    var max_value = Math.max(...cluster_values.map(Math.abs));
+    for (var cell = 0; cell < cluster_values.length; cell++) {
+        // A cluster is drawn only with a change on the day, there isn't a single location to check its history
+        if (cluster_values[cell] == 0) {
+            continue;
+        }
+        color = stats_config[current_stat_index]["color_fn"](cluster_values[cell], current_focused_location)
+        if (color == null) {
+            continue;
+        }
+        globe.addPoint(level["lat"][cell], level["lng"][cell], Math.abs(cluster_values[cell] / max_value) * 200, color, subgeo);
+    }
+}
+
 function loadGlobeDataForDay() {
     var subgeo = new THREE.Geometry();
+    current_lod_level = lodLevelForDistance();
+    if (current_lod_level >= 0) {
+        console.log("loadGlobeDataForDay: " + current_day_index + ", level of detail: " + current_lod_level);
+        loadLodClustersForDay(subgeo, current_lod_level);
+        globe.setBaseGeometry(subgeo);
+        return;
+    }
     // By default, let's show the color based on the dataset type
     focus_stat_max_value = stats_config[current_stat_index]["max_value_fn"]();
     console.log("loadGlobeDataForDay: " + current_day_index + ", max value: " + focus_stat_max_value);
     for (location_idx = 0; location_idx < window.data["locations"].length; location_idx++) {
-        // A 4th item in the values array could be for hiding a value (not drawing), to avoid counting several times
-        if (window.data["locations"][location_idx]["values"][current_day_index].length > 3) {
+        if (isHiddenLocation(location_idx)) {
             continue;
         }
         lat = window.data["locations"][location_idx]["lat"];
         lng = window.data["locations"][location_idx]["lng"];
-        day_value = stats_config[current_stat_index]["data_fn"](window.data["locations"][location_idx]["values"][current_day_index], location_idx)
+        day_value = stats_config[current_stat_index]["data_fn"](locationDayValues(location_idx, current_day_index), location_idx)
         if (location_idx < 10) {
             console.log("day_value: " + day_value);
         }
@@ -693,11 +744,109 @@ function updateDisplays(day_index) {
     }
 }
 
+function locationDayValues(location_idx, day_idx) {
+    // Returns [<cumulative>, <day_increment>, <day_increment_delta>] of a location for a day
+    if (window.data["values_matrix"]) {
+        // Binary format: A locations x dates x channels Int32Array, the subarray is a view, not a copy
+        var channels = window.data["channels"].length;
+        var offset = (location_idx * window.data["series_stats"].length + day_idx) * channels;
+        return window.data["values_matrix"].subarray(offset, offset + channels);
+    }
+    return window.data["locations"][location_idx]["values"][day_idx];
+}
+
+function locationValues(location_idx) {
+    // Returns the values of a location for all the days
+    if (!window.data["values_matrix"]) {
+        return window.data["locations"][location_idx]["values"];
+    }
+    var res = Array();
+    for (var day_idx = 0; day_idx < window.data["series_stats"].length; day_idx++) {
+        res.push(locationDayValues(location_idx, day_idx));
+    }
+    return res;
+}
+
+function isHiddenLocation(location_idx) {
+    // A 4th item in the values array could be for hiding a value (not drawing), to avoid counting several times
+    // In the binary format the index has a "hidden" flag instead.
+    if (window.data["locations"][location_idx]["hidden"]) {
+        return true;
+    }
+    return !window.data["values_matrix"] && locationDayValues(location_idx, current_day_index).length > 3;
+}
+
 function animate() {
     requestAnimationFrame(animate);
+    if (window.data && lodLevelForDistance() != current_lod_level) {
+        // The zoom crossed into another level of detail
+        globe.resetData();
+        loadGlobeDataForDay();
+        globe.createPoints();
+    }
     globe.render();
 }
 
+function loadLodData(base_url) {
+    // Loads <base_url>.lod.json and its Int32 blob of clusters when they have been generated
+    window.lod = null;
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", base_url + ".lod.json", true);
+    xhr.onreadystatechange = function (_e) {
+        if (xhr.readyState === 4 && xhr.status === 200) {
+            var lod = JSON.parse(xhr.responseText);
+            var blob_xhr = new XMLHttpRequest();
+            blob_xhr.open("GET", base_url.substring(0, base_url.lastIndexOf("/") + 1) + lod["blob"], true);
+            blob_xhr.responseType = "arraybuffer";
+            blob_xhr.onreadystatechange = function (_e) {
+                if (blob_xhr.readyState === 4 && blob_xhr.status === 200 && base_url == 'data/' + datasetType) {
+                    lod["values_matrix"] = new Int32Array(blob_xhr.response);
+                    // The globe is redrawn by animate if the zoom needs the clusters
+                    window.lod = lod;
+                }
+            };
+            blob_xhr.send(null);
+        }
+    };
+    xhr.send(null);
+}
+
+function decodeCompactData(data) {
+    // Schema version 2 (see data/data-schema.json) only stores the cumulative values,
+    // delta-encoded from the first non-zero day ("offset"). Rebuild the
+    // [<cumulative>, <day_increment>, <day_increment_delta>] values of version 1.
+    var days = data["date_keys"].length;
+    data["locations"].forEach(function (location) {
+        var values = Array(days);
+        var cumulative = 0;
+        var prev_cumulative = 0;
+        var prev_day = 0;
+        for (var day_idx = 0; day_idx < days; day_idx++) {
+            if (day_idx >= location["offset"]) {
+                cumulative += location["values"][day_idx - location["offset"]];
+            }
+            var day = cumulative - prev_cumulative;
+            // There is no delta on the first day
+            var delta = day_idx == 0 ? 0 : day - prev_day;
+            values[day_idx] = [cumulative, day, delta];
+            prev_cumulative = cumulative;
+            prev_day = day;
+        }
+        location["values"] = values;
+    });
+    return data;
+}
+
+function onDataLoaded() {
+    chartColumns = window.data["series_stats"].map(d => d.name);
+    document.body.style.backgroundImage = "none"; // remove loading
+    // Focus the last day statistics
+    current_day_index = window.data["series_stats"].length - 1;
+    autofocus = true;
+    updateAutoFocusIcon();
+    updateDisplays();
+}
+
 function loadData(url) {
     document.body.style.backgroundImage = "url('images/loading.gif')";
     var xhr;
@@ -707,20 +856,200 @@ function loadData(url) {
         if (xhr.readyState === 4) {
             if (xhr.status === 200) {
                 window.data = JSON.parse(xhr.responseText);
-                chartColumns = window.data["series_stats"].map(d => d.name);
-                document.body.style.backgroundImage = "none"; // remove loading
-                // Focus the last day statistics
-                current_day_index = window.data["series_stats"].length - 1;
-                autofocus = true;
-                updateAutoFocusIcon();
-                updateDisplays();
+                if (window.data["schema_version"] == 2) {
+                    decodeCompactData(window.data);
+                }
+                onDataLoaded();
             }
         }
     };
     xhr.send(null);
 }
+
+function placeholderDayStats(name) {
+    // Stats of a day whose tile has not been loaded yet
+    var top = {"value": 0, "location_idx": 0};
+    return {
+        "name": name,
+        "top_cumulative": top,
+        "top_day": top,
+        "top_delta": top,
+        "top_cumulative_percent": top,
+        "cumulative_global": 0,
+        "cumulative_global_percent": 0,
+        "day_global": 0,
+        "delta_global": 0,
+    };
+}
+
+function loadTile(manifest_url, manifest, tile_entry, on_loaded) {
+    // Fetches a tile and copies its values and stats into its manifest, the tile
+    // is dropped if another dataset was loaded in the meantime
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", manifest_url.substring(0, manifest_url.lastIndexOf("/") + 1) + tile_entry["file"], true);
+    xhr.onreadystatechange = function (_e) {
+        if (xhr.readyState === 4 && xhr.status === 200) {
+            if (window.data !== manifest) {
+                return;
+            }
+            var tile = JSON.parse(xhr.responseText);
+            for (var day = 0; day < tile["series_stats"].length; day++) {
+                manifest["series_stats"][tile["first_day_index"] + day] = tile["series_stats"][day];
+            }
+            for (var location_idx = 0; location_idx < tile["values"].length; location_idx++) {
+                for (var day = 0; day < tile["values"][location_idx].length; day++) {
+                    manifest["locations"][location_idx]["values"][tile["first_day_index"] + day] = tile["values"][location_idx][day];
+                }
+            }
+            on_loaded();
+        }
+    };
+    xhr.send(null);
+}
+
+function loadTiledData(base_url) {
+    // Loads <base_url>.manifest.json, then the most recent tile to draw the last day,
+    // the older tiles are loaded afterwards, from the newest to the oldest.
+    // Falls back to the binary or JSON formats when the tiles have not been generated.
+    document.body.style.backgroundImage = "url('images/loading.gif')";
+    var manifest_url = base_url + ".manifest.json";
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", manifest_url, true);
+    xhr.onreadystatechange = function (_e) {
+        if (xhr.readyState === 4) {
+            if (xhr.status !== 200) {
+                loadBinaryData(base_url);
+                return;
+            }
+            var manifest = JSON.parse(xhr.responseText);
+            var empty_day = manifest["channels"].map(_c => 0);
+            manifest["series_stats"] = manifest["date_keys"].map(placeholderDayStats);
+            manifest["locations"].forEach(function (location) {
+                location["values"] = manifest["date_keys"].map(_d => empty_day);
+            });
+            window.data = manifest;
+            var pending_tiles = manifest["tiles"].slice();
+            var loadOlderTile = function () {
+                if (pending_tiles.length > 0 && window.data === manifest) {
+                    loadTile(manifest_url, manifest, pending_tiles.pop(), function () {
+                        // Redraw the region chart with the older days
+                        updateCountryD3Graph(true);
+                        loadOlderTile();
+                    });
+                }
+            };
+            if (pending_tiles.length == 0) {
+                onDataLoaded();
+                return;
+            }
+            loadTile(manifest_url, manifest, pending_tiles.pop(), function () {
+                onDataLoaded();
+                loadOlderTile();
+            });
+        }
+    };
+    xhr.send(null);
+}
+
+function loadBinaryData(base_url) {
+    // Loads <base_url>.index.json and its Int32 blob, falls back to <base_url>.json
+    // when the binary format has not been generated.
+    document.body.style.backgroundImage = "url('images/loading.gif')";
+    var xhr;
+    xhr = new XMLHttpRequest();
+    xhr.open("GET", base_url + ".index.json", true);
+    xhr.onreadystatechange = function (_e) {
+        if (xhr.readyState === 4) {
+            if (xhr.status !== 200) {
+                loadData(base_url + ".json");
+                return;
+            }
+            var index = JSON.parse(xhr.responseText);
+            var blob_url = base_url.substring(0, base_url.lastIndexOf("/") + 1) + index["blob"];
+            var blob_xhr = new XMLHttpRequest();
+            blob_xhr.open("GET", blob_url, true);
+            blob_xhr.responseType = "arraybuffer";
+            blob_xhr.onreadystatechange = function (_e) {
+                if (blob_xhr.readyState === 4) {
+                    if (blob_xhr.status === 200) {
+                        // The blob is little-endian, as are the typed arrays on the supported platforms
+                        index["values_matrix"] = new Int32Array(blob_xhr.response);
+                        window.data = index;
+                        onDataLoaded();
+                    } else {
+                        loadData(base_url + ".json");
+                    }
+                }
+            };
+            blob_xhr.send(null);
+        }
+    };
+    xhr.send(null);
+}
+
+function combinedMetricData(metric) {
+    // A view of a metric of the combined output in the binary format of loadBinaryData,
+    // the location structs are shared and the values are a view of the combined blob, not a copy
+    var metric_struct = window.combined["metrics"][metric];
+    var shape = metric_struct["shape"];
+    return {
+        "locations": metric_struct["location_ids"].map(location_id => window.combined["locations"][location_id]),
+        "series_stats": metric_struct["series_stats"],
+        "date_keys": window.combined["date_keys"],
+        "channels": window.combined["channels"],
+        "shape": shape,
+        "values_matrix": window.combined["values_matrix"].subarray(
+            metric_struct["offset"], metric_struct["offset"] + shape[0] * shape[1] * shape[2]),
+    };
+}
+
+function loadCombinedData(base_url) {
+    // Loads <base_url>.json and its Int32 blob once, the metrics are then switched without downloads.
+    // Falls back to the outputs of each metric when the combined output has not been generated.
+    document.body.style.backgroundImage = "url('images/loading.gif')";
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", base_url + ".json", true);
+    xhr.onreadystatechange = function (_e) {
+        if (xhr.readyState === 4) {
+            if (xhr.status !== 200) {
+                window.combined = null;
+                changeDataSet();
+                return;
+            }
+            var index = JSON.parse(xhr.responseText);
+            var blob_xhr = new XMLHttpRequest();
+            blob_xhr.open("GET", base_url.substring(0, base_url.lastIndexOf("/") + 1) + index["blob"], true);
+            blob_xhr.responseType = "arraybuffer";
+            blob_xhr.onreadystatechange = function (_e) {
+                if (blob_xhr.readyState === 4) {
+                    if (blob_xhr.status === 200) {
+                        index["values_matrix"] = new Int32Array(blob_xhr.response);
+                        window.combined = index;
+                    } else {
+                        window.combined = null;
+                    }
+                    changeDataSet();
+                }
+            };
+            blob_xhr.send(null);
+        }
+    };
+    xhr.send(null);
+}
+
 function changeDataSet() {
     select = document.getElementById("datasetSelection")
     datasetType = select.options[select.selectedIndex].value
-    loadData('data/' + datasetType + '.json');
+    if (window.combined === undefined) {
+        // Not tried yet, changeDataSet is called again once it's loaded or missing
+        loadCombinedData('data/combined');
+        return;
+    }
+    if (window.combined && window.combined["metrics"][datasetType]) {
+        window.data = combinedMetricData(datasetType);
+        onDataLoaded();
+    } else {
+        loadTiledData('data/' + datasetType);
+    }
+    loadLodData('data/' + datasetType);
 }
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Per-stage metrics of a transform run.
+Each stage (download, parse, stats, serialize, write) records spans with their
+wall time, the rows/cells processed, the bytes in/out and the peak RSS so far.
+The outputs are listed as generated, or reused when their inputs didn't change.
+"""
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import utils
+
+METRICS_VERSION = 1
+STAGES = ["download", "parse", "stats", "serialize", "write"]
+COUNTS = ["rows", "cells", "bytes_in", "bytes_out"]
+
+
+def max_rss_bytes():
+    """
+    Returns the peak resident set size of the process so far
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class TimedIterator:
+    """
+    Wraps an iterator and adds up the time spent producing its items, so the time
+    spent serializing chunks can be told apart from the time spent writing them.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+class StageMetrics:
+    """
+    Collects the spans of a run, the downloads record them from several threads.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("StageMetrics")
+        self.spans = []
+        # "generated" or "reused" by output name
+        self.outputs = dict()
+        self.lock = threading.Lock()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.start = time.perf_counter()
+
+    def __getstate__(self):
+        # The lock can't be pickled, i.e. when the helper is sent to a worker process
+        state = dict(self.__dict__)
+        del state["lock"]
+        del state["logger"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("StageMetrics")
+
+    def record(self, stage, name, seconds, **counts):
+        """
+        Records a span
+        :param stage str: One of STAGES
+        :param name str: What was processed, i.e. "Global Confirmed" or a file name
+        :param seconds float: The wall time of the span
+        :param counts: The rows, cells, bytes_in and bytes_out of the span
+        :returns dict: The recorded span
+        """
+        span = dict()
+        span["stage"] = stage
+        span["name"] = name
+        span["seconds"] = seconds
+        for count in COUNTS:
+            if count in counts:
+                span[count] = int(counts[count])
+        span["peak_rss_bytes"] = max_rss_bytes()
+        self.logger.debug("%s %s: %.3fs", stage, name, seconds)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, stage, name, **counts):
+        """
+        Times the block, the yielded dict can be filled with the counts known at the end:
+            with metrics.span("parse", "Global Confirmed") as span:
+                span["rows"] = ...
+        """
+        start = time.perf_counter()
+        yield counts
+        self.record(stage, name, time.perf_counter() - start, **counts)
+
+    def extend(self, spans):
+        """
+        Adds the spans recorded somewhere else, i.e. in a worker process
+        """
+        with self.lock:
+            self.spans.extend(spans)
+
+    def summary(self):
+        """
+        Returns the totals of each stage
+        :returns dict: {stage: {"spans", "seconds", "rows", "cells", "bytes_in", "bytes_out", "peak_rss_bytes"}}
+        """
+        res = dict()
+        with self.lock:
+            spans = list(self.spans)
+        for stage in STAGES:
+            stage_spans = [span for span in spans if span["stage"] == stage]
+            totals = dict()
+            totals["spans"] = len(stage_spans)
+            totals["seconds"] = sum(span["seconds"] for span in stage_spans)
+            for count in COUNTS:
+                totals[count] = sum(span.get(count, 0) for span in stage_spans)
+            totals["peak_rss_bytes"] = max(
+                [span["peak_rss_bytes"] for span in stage_spans], default=0)
+            res[stage] = totals
+        return res
+
+    def to_dict(self):
+        """
+        Returns the metrics of the run as they are written in the metrics file
+        """
+        res = dict()
+        res["version"] = METRICS_VERSION
+        res["started_at"] = self.started_at
+        res["wall_seconds"] = time.perf_counter() - self.start
+        res["peak_rss_bytes"] = max_rss_bytes()
+        res["stages"] = self.summary()
+        res["outputs"] = self.outputs
+        with self.lock:
+            res["spans"] = list(self.spans)
+        return res
+
+    def write(self, filename):
+        """
+        Writes the metrics of the run as JSON
+        """
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        utils.write_to_file(filename, json.dumps(self.to_dict(), indent=2))
+        for stage, totals in self.summary().items():
+            self.logger.info("%s: %.2fs in %s spans, %s bytes in, %s bytes out", stage,
+                             totals["seconds"], totals["spans"], totals["bytes_in"], totals["bytes_out"])
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Tags each output with a hash of everything it's generated from: the raw time
+series, the population table, the output settings and the outputs version.
+An output whose tag matches and whose files exist doesn't need to be parsed
+nor written again, which also keeps its files and mtimes for downstream caches.
+"""
+import hashlib
+import json
+import logging
+import os
+import utils
+
+OUTPUT_TAGS_VERSION = 1
+
+
+def input_hash(inputs):
+    """
+    Returns the sha256 hex digest of the inputs of an output
+    :param inputs dict: JSON serializable description of the inputs, i.e. the hashes of the source files
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class OutputTags:
+    """
+    The input hash and files of each output written, persisted between runs
+    """
+
+    def __init__(self, filename=None):
+        """
+        :param filename str: Where the tags are persisted, by default they are not
+        """
+        self.logger = logging.getLogger("OutputTags")
+        self.filename = filename
+        self.tags = dict()
+        # The tags of the outputs written on this run
+        self.completed = dict()
+        self.load()
+
+    def load(self):
+        """
+        Loads the tags of the previous runs, a missing or unreadable file means nothing is reused
+        """
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as file_handle:
+                state = json.load(file_handle)
+        except (OSError, ValueError) as err:
+            self.logger.warning(
+                "Unable to read the output tags %s: %s", self.filename, err)
+            return
+        if state.get("version") == OUTPUT_TAGS_VERSION:
+            self.tags = state["outputs"]
+
+    def save(self):
+        """
+        Persists the tags, it should be called once the outputs were written
+        """
+        if self.filename is None:
+            return
+        state = dict()
+        state["version"] = OUTPUT_TAGS_VERSION
+        state["outputs"] = self.tags
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        utils.write_to_file(self.filename, json.dumps(state))
+
+    def is_current(self, name, inputs_hash, files):
+        """
+        Checks if an output was written from the same inputs and its files are still there
+        :param name str: The name of the output, i.e. "confirmed"
+        :param inputs_hash str: The input_hash of this run
+        :param files list: The paths of the files of the output
+        """
+        tag = self.tags.get(name)
+        if tag is None or tag["input_hash"] != inputs_hash or tag["files"] != files:
+            return False
+        return all(os.path.exists(path) for path in files)
+
+    def tag(self, name, inputs_hash, files):
+        """
+        Records the input hash of an output that was just written
+        """
+        tag = dict()
+        tag["input_hash"] = inputs_hash
+        tag["files"] = files
+        self.tags[name] = tag
+        self.completed[name] = tag
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Queries over the binary outputs of transform.py (--format binary or both).
+The blob is memory-mapped and the locations are looked up by name or country
+and the dates by column in <name>.lookup.json, written along with the blob, so
+a query neither loads the location structs nor the series stats of the index,
+and only reads the rows and days it returns.
+    ./transform.py query confirmed --country Italy --start 20-03-01 --end 20-03-31
+"""
+import bisect
+import datetime
+import json
+import logging
+import os
+import re
+import numpy
+
+AGGREGATES = ["sum", "mean", "min", "max"]
+LOOKUP_VERSION = 1
+DATE_PATTERN = re.compile(r"^(\d{2}|\d{4})-\d{2}-\d{2}$")
+
+
+def date_key(date):
+    """
+    Returns the date key of the outputs ("YY-MM-DD") of a date, which can also be "YYYY-MM-DD"
+    :raises ValueError: When the date is not in one of those formats
+    """
+    if DATE_PATTERN.match(date):
+        date_format = "%Y-%m-%d" if len(date) == 10 else "%y-%m-%d"
+        try:
+            return datetime.datetime.strptime(date, date_format).strftime("%y-%m-%d")
+        except ValueError:
+            pass
+    raise ValueError(
+        "Invalid date: {}, expected YYYY-MM-DD or YY-MM-DD".format(date))
+
+
+def generate_lookup(blob_name, locations, date_keys, channels):
+    """
+    Returns the lookup JSON of a binary output, the only file a query loads besides the blob
+    :param blob_name str: The file name of the blob, relative to the lookup
+    :param locations list: The location structs of the binary index, in the blob order
+    :param date_keys list: The sorted date keys of the blob
+    :param channels list: The channels of the blob
+    :returns str: {"format", "version", "blob", "dtype", "shape", "channels", "date_keys",
+                   "names", "locations": {name: [ids]}, "countries": {country: [ids]}}
+    """
+    lookup = dict()
+    lookup["format"] = "globe-lookup"
+    lookup["version"] = LOOKUP_VERSION
+    lookup["blob"] = blob_name
+    lookup["dtype"] = "<i4"
+    lookup["shape"] = [len(locations), len(date_keys), len(channels)]
+    lookup["channels"] = channels
+    lookup["date_keys"] = date_keys
+    lookup["names"] = [location["location"] for location in locations]
+    lookup["locations"] = dict()
+    lookup["countries"] = dict()
+    for location_id, location in enumerate(locations):
+        # Several locations can have the same name
+        lookup["locations"].setdefault(location["location"], []).append(location_id)
+        # The hidden rows are aggregates of other rows of the same country
+        if not location.get("hidden"):
+            country = location["location"].split(" - ", 1)[0]
+            lookup["countries"].setdefault(country, []).append(location_id)
+    return json.dumps(lookup)
+
+
+class OutputQuery:
+    """
+    The binary output of a metric, indexed by location name, country and date
+    """
+
+    def __init__(self, output_dir, name):
+        """
+        :param output_dir str: The directory of the outputs, i.e. "data"
+        :param name str: The name of the output, i.e. "confirmed"
+        """
+        self.logger = logging.getLogger("OutputQuery")
+        lookup_file = os.path.join(output_dir, "{}.lookup.json".format(name))
+        if not os.path.exists(lookup_file):
+            raise ValueError("There is no binary output {}, transform.py must run with --format binary or both".format(
+                lookup_file))
+        with open(lookup_file) as file_handle:
+            lookup = json.load(file_handle)
+        if lookup.get("version") != LOOKUP_VERSION:
+            raise ValueError("Unsupported lookup version: {}".format(
+                lookup.get("version")))
+        self.names = lookup["names"]
+        self.date_keys = lookup["date_keys"]
+        self.channels = lookup["channels"]
+        self.values = numpy.memmap(os.path.join(output_dir, lookup["blob"]), dtype=lookup["dtype"],
+                                   mode="r", shape=tuple(lookup["shape"]))
+        self.location_ids = lookup["locations"]
+        self.country_ids = lookup["countries"]
+
+    def find(self, locations=(), countries=()):
+        """
+        Returns the location ids of some locations and countries, in the given order
+        :param locations list: The "Country - Province" names, all the locations with a name are included
+        :param countries list: The countries, all their locations are included
+        :returns list: The location ids
+        """
+        res = []
+        for location in locations:
+            if location not in self.location_ids:
+                raise KeyError("Unknown location: {}".format(location))
+            res.extend(self.location_ids[location])
+        for country in countries:
+            if country not in self.country_ids:
+                raise KeyError("Unknown country: {}".format(country))
+            res.extend(self.country_ids[country])
+        return res
+
+    def columns(self, start=None, end=None):
+        """
+        Returns the slice of the date columns between two dates, both included
+        :param start str: The first date, by default the first day of the output
+        :param end str: The last date, by default the last day of the output
+        """
+        first = 0 if start is None else bisect.bisect_left(
+            self.date_keys, date_key(start))
+        last = len(self.date_keys) if end is None else bisect.bisect_right(
+            self.date_keys, date_key(end))
+        return slice(first, max(first, last))
+
+    def series(self, location_ids, start=None, end=None, channel="day"):
+        """
+        Returns the values of some locations between two dates
+        :param location_ids list: The location ids, see find
+        :param start str: The first date, included
+        :param end str: The last date, included
+        :param channel str: "cumulative", "day" or "delta"
+        :returns dict: {"date_keys", "channel", "locations": [{"location", "values"}]}
+        """
+        columns = self.columns(start, end)
+        channel_idx = self.channels.index(channel)
+        res = dict()
+        res["date_keys"] = self.date_keys[columns]
+        res["channel"] = channel
+        res["locations"] = []
+        for location_id in location_ids:
+            location_series = dict()
+            location_series["location"] = self.names[location_id]
+            location_series["values"] = self.values[location_id,
+                                                    columns, channel_idx].tolist()
+            res["locations"].append(location_series)
+        return res
+
+    def aggregate(self, location_ids, start=None, end=None, channel="day", function="sum"):
+        """
+        Returns an aggregate of the values of some locations between two dates
+        :param location_ids list: The location ids, see find
+        :param start str: The first date, included
+        :param end str: The last date, included
+        :param channel str: "cumulative", "day" or "delta"
+        :param function str: One of AGGREGATES
+        :returns dict: {"date_keys", "channel", "function", "locations": [{"location", "value"}], "total"}
+                 the total is the aggregate of the summed locations, None when there are no days
+        """
+        if function not in AGGREGATES:
+            raise ValueError("Unknown aggregate: {}".format(function))
+        columns = self.columns(start, end)
+        channel_idx = self.channels.index(channel)
+        values = numpy.asarray(
+            self.values[location_ids, columns, channel_idx], dtype=numpy.int64)
+        res = dict()
+        res["date_keys"] = self.date_keys[columns]
+        res["channel"] = channel
+        res["function"] = function
+        res["locations"] = []
+        has_days = values.shape[1] > 0
+        for location_id, location_values in zip(location_ids, values):
+            location_aggregate = dict()
+            location_aggregate["location"] = self.names[location_id]
+            location_aggregate["value"] = getattr(numpy, function)(
+                location_values).item() if has_days else None
+            res["locations"].append(location_aggregate)
+        res["total"] = getattr(numpy, function)(values.sum(axis=0)).item() if has_days else None
+        return res
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Per-day top-K rankings of the locations.
+For each day and metric the K top location ids are found with a partial selection
+(see columnar.top_k_by_column), so a "top 10" panel doesn't need to scan the values.
+"""
+import json
+import logging
+import numpy
+from columnar import top_k_by_column
+
+RANKINGS_VERSION = 1
+RANKING_METRICS = ["cumulative", "day", "delta", "cumulative_percent"]
+
+
+class Rankings:
+    """
+    The top location ids of each day, by metric:
+    - cumulative, day: The highest values
+    - delta: The highest absolute values
+    - cumulative_percent: The highest cumulative per population, only for the locations with population
+    Only the drawable, non-hidden locations with a positive value are ranked,
+    so a day can have less than K locations.
+    """
+
+    def __init__(self, records, location_index, k):
+        """
+        :param records ColumnarRecords: The records of the output
+        :param location_index LocationIndex: The index of the records, see CSSEGISandData.location_index
+        :param k int: The number of locations per day and metric
+        """
+        self.logger = logging.getLogger("Rankings")
+        self.k = k
+        self.date_keys = sorted(records.date_keys)
+        columns = [records.date_index[date_key] for date_key in self.date_keys]
+        ranked = location_index.valid_ids[~location_index.hidden[location_index.valid_ids]]
+        percent_rows = ranked[location_index.has_population[ranked]]
+        population = location_index.population[percent_rows].astype(numpy.float64)
+        self.rankings = dict()
+        self.rankings["cumulative"] = self.top_k(
+            ranked, records.cumulative[ranked][:, columns])
+        self.rankings["day"] = self.top_k(
+            ranked, records.day[ranked][:, columns])
+        self.rankings["delta"] = self.top_k(
+            ranked, numpy.abs(records.delta[ranked][:, columns]))
+        self.rankings["cumulative_percent"] = self.top_k(
+            percent_rows, (records.cumulative[percent_rows][:, columns] / population[:, None]) * 100)
+
+    def top_k(self, rows, values):
+        """
+        Returns the ranked location ids of each day
+        :param rows numpy.ndarray: The location id of each row of values
+        :param values numpy.ndarray: locations x dates matrix
+        :returns list: One list of location ids per day, from the top down
+        """
+        location_idx, top = top_k_by_column(values, self.k)
+        location_ids = rows[location_idx]
+        return [day_ids[day_top > 0].tolist() for day_ids, day_top in zip(location_ids, top)]
+
+    def generate_json_chunks(self):
+        """
+        Yields the rankings JSON one metric at a time:
+        {"version", "k", "date_keys", "rankings": {<metric>: [[<location_idx>, ...], ...]}}
+        """
+        yield '{{"version": {}, "k": {}, "date_keys": {}, "rankings": {{'.format(
+            RANKINGS_VERSION, self.k, json.dumps(self.date_keys))
+        for metric_number, metric in enumerate(RANKING_METRICS):
+            if metric_number:
+                yield ", "
+            yield "{}: {}".format(json.dumps(metric), json.dumps(self.rankings[metric]))
+        yield "}}"
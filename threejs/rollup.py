@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Country rollups of the sub-national rows.
+The drawable locations are grouped by country, so each country is a contiguous
+range of location ids, and the per-country values are summed over the ranges
+in one vectorized pass. The aggregated rows of the global file (the "US" row)
+are dropped, the rollup of the US county rows replaces them.
+"""
+import json
+import logging
+import numpy
+
+ROLLUP_VERSION = 1
+
+
+class CountryRollup:
+    """
+    The records grouped by country and the sums of each group:
+    - records: ColumnarRecords of the drawable, non-hidden rows, grouped by country
+    - countries: The country names, sorted
+    - starts, ends: numpy int64 arrays, the location ids [start, end) of each country in records
+    - population: numpy int64 array, the population of each country, 0 when it's unknown
+    - cumulative, day, delta: numpy int64 matrices of countries x dates
+    - undrawn: ColumnarRecords of the non-hidden rows whose lat/lng can't be parsed (i.e. ships),
+      they are not drawn but they are in the global totals, see add_undrawn_totals
+    """
+
+    def __init__(self, records, location_index):
+        """
+        :param records ColumnarRecords: The parsed records
+        :param location_index LocationIndex: The index of the records, see CSSEGISandData.location_index
+        """
+        self.logger = logging.getLogger("CountryRollup")
+        rows = location_index.valid_ids[~location_index.hidden[location_index.valid_ids]]
+        row_countries = numpy.array(
+            [location_index.countries[row] for row in rows], dtype=str)
+        self.countries, country_ids = numpy.unique(
+            row_countries, return_inverse=True)
+        self.countries = self.countries.tolist()
+        # Stable, so the locations keep their order inside a country
+        order = numpy.argsort(country_ids, kind="stable")
+        self.records = records.take(rows[order])
+        self.undrawn = records.take(numpy.flatnonzero(
+            ~location_index.valid & ~location_index.hidden))
+        self.starts = numpy.searchsorted(
+            country_ids[order], numpy.arange(len(self.countries)))
+        self.ends = numpy.append(self.starts[1:], len(rows)).astype(numpy.int64)
+        self.population = numpy.array([int(location_index.global_population_dataset.get(country, 0))
+                                       for country in self.countries], dtype=numpy.int64)
+        self.cumulative = self.sum_ranges(self.records.cumulative)
+        self.day = self.sum_ranges(self.records.day)
+        self.delta = self.sum_ranges(self.records.delta)
+        self.logger.info("Rolled up %s locations into %s countries",
+                         len(rows), len(self.countries))
+
+    def sum_ranges(self, values):
+        """
+        Returns the sums of the rows of each country range
+        :param values numpy.ndarray: locations x dates matrix, in the order of self.records
+        :returns numpy.ndarray: countries x dates matrix
+        """
+        if len(self.countries) == 0:
+            return numpy.zeros((0, values.shape[1]), dtype=values.dtype)
+        return numpy.add.reduceat(values, self.starts, axis=0)
+
+    def add_undrawn_totals(self, series_stats, global_population):
+        """
+        Returns a copy of the series stats of self.records with the undrawn rows added to the
+        global totals, as they are without --rollups. The tops only point to drawn locations.
+        :param series_stats list: The series stats of self.records, see CSSEGISandData.get_series_stats
+        :param global_population int: The total population of the world
+        :returns list: The series stats with the global totals of all the non-hidden rows
+        """
+        res = []
+        for day_stats in series_stats:
+            day_stats = dict(day_stats)
+            col = self.undrawn.date_index[day_stats["name"]]
+            day_stats["cumulative_global"] += int(self.undrawn.cumulative[:, col].sum())
+            day_stats["cumulative_global_percent"] = (
+                day_stats["cumulative_global"] / global_population) * 100
+            day_stats["day_global"] += int(self.undrawn.day[:, col].sum())
+            day_stats["delta_global"] += int(self.undrawn.delta[:, col].sum())
+            res.append(day_stats)
+        return res
+
+    def generate_json_chunks(self):
+        """
+        Yields the countries JSON one country at a time:
+        {"version", "date_keys", "channels", "countries": [{"country", "population_2020", "locations", "values"}]}
+        "locations" is the [start, end) range of location ids of the country in the other outputs.
+        """
+        columns = [self.records.date_index[date_key]
+                   for date_key in sorted(self.records.date_keys)]
+        yield '{{"version": {}, "date_keys": {}, "channels": {}, "countries": ['.format(
+            ROLLUP_VERSION, json.dumps(sorted(self.records.date_keys)),
+            json.dumps(["cumulative", "day", "delta"]))
+        for country_id, country in enumerate(self.countries):
+            if country_id:
+                yield ", "
+            country_struct = dict()
+            country_struct["country"] = country
+            country_struct["population_2020"] = int(
+                self.population[country_id])
+            country_struct["locations"] = [int(self.starts[country_id]),
+                                           int(self.ends[country_id])]
+            country_struct["values"] = [list(day_values) for day_values in zip(
+                self.cumulative[country_id, columns].tolist(),
+                self.day[country_id, columns].tolist(),
+                self.delta[country_id, columns].tolist())]
+            yield json.dumps(country_struct)
+        yield "]}"
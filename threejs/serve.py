@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Daemon mode of transform.py: the sources are polled on an interval, the outputs
+are regenerated when their inputs change (see output_tags) and everything is served from memory with
+strong ETags, Cache-Control and precompressed gzip variants.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The globe page and the files it loads, relative to this directory
+STATIC_FILES = ["index.html", "main.js", "globe.js"]
+STATIC_DIRS = ["third-party", "images"]
+COMPRESSIBLE_EXTENSIONS = (".json", ".js", ".html", ".css", ".svg", ".csv", ".txt")
+# The tile names contain their content hash, they never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The rest must be revalidated, which is a 304 when the ETag still matches
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+
+class StoredFile:
+    """
+    A file held in memory with its ETag and, when it's smaller, its gzip variant
+    """
+
+    def __init__(self, body, content_type, cache_control, stat_key=None):
+        """
+        :param body bytes: The contents of the file
+        :param content_type str: The Content-Type header
+        :param cache_control str: The Cache-Control header
+        :param stat_key tuple: The (size, mtime_ns) the file was loaded with, to reuse unchanged entries
+        """
+        self.body = body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.stat_key = stat_key
+        content_hash = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = '"{}"'.format(content_hash)
+        self.gzip_body = None
+        self.gzip_etag = None
+        if content_type.startswith(("application/json", "application/javascript", "text/")):
+            # mtime=0 keeps the compressed bytes identical for identical contents
+            gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gzip_body) < len(body):
+                self.gzip_body = gzip_body
+                # Each representation has its own strong ETag
+                self.gzip_etag = '"{}-gzip"'.format(content_hash)
+
+
+class OutputStore:
+    """
+    The files being served by URL path. The files of a directory are swapped
+    all at once, so a request never sees a mix of two generations.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("OutputStore")
+        self.files = dict()
+        self.lock = threading.Lock()
+
+    def get(self, url_path):
+        """
+        Returns the StoredFile of an URL path, None when it doesn't exist
+        """
+        with self.lock:
+            return self.files.get(url_path)
+
+    def load_file(self, path, cache_control, previous=None):
+        """
+        Reads a file into a StoredFile, reusing the previous entry if the file didn't change
+        """
+        stat = os.stat(path)
+        stat_key = (stat.st_size, stat.st_mtime_ns)
+        if previous is not None and previous.stat_key == stat_key:
+            return previous
+        with open(path, "rb") as file_handle:
+            body = file_handle.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/json", "application/javascript"):
+            content_type = "{}; charset=utf-8".format(content_type)
+        return StoredFile(body, content_type, cache_control, stat_key)
+
+    def load_directory(self, directory, url_prefix, exclude=()):
+        """
+        Loads the files of a directory tree under an URL prefix, replacing the previous ones
+        :param directory str: The directory to load
+        :param url_prefix str: The URL path of the directory, i.e. "/data"
+        :param exclude list: Directories and files that are not served, i.e. the state directory
+        :returns int: The number of files loaded
+        """
+        excluded = set(os.path.abspath(path) for path in exclude)
+        prefix = "{}/".format(url_prefix.rstrip("/"))
+        with self.lock:
+            previous_files = dict(self.files)
+        loaded = dict()
+        for root, dirs, file_names in os.walk(directory):
+            dirs[:] = [name for name in sorted(dirs) if not name.startswith(".") and
+                       os.path.abspath(os.path.join(root, name)) not in excluded]
+            for file_name in file_names:
+                # The temporary files of the atomic writes start with a dot
+                if file_name.startswith("."):
+                    continue
+                path = os.path.join(root, file_name)
+                if os.path.abspath(path) in excluded:
+                    continue
+                url_path = prefix + os.path.relpath(path, directory).replace(os.sep, "/")
+                cache_control = REVALIDATE_CACHE_CONTROL
+                if "/tiles/" in url_path:
+                    cache_control = IMMUTABLE_CACHE_CONTROL
+                loaded[url_path] = self.load_file(
+                    path, cache_control, previous_files.get(url_path))
+        with self.lock:
+            files = {url_path: stored_file for url_path, stored_file in self.files.items()
+                     if not url_path.startswith(prefix)}
+            files.update(loaded)
+            self.files = files
+        self.logger.info("Loaded %s files from %s", len(loaded), directory)
+        return len(loaded)
+
+    def load_static(self, directory):
+        """
+        Loads the globe page and its scripts and images, they are served from the root
+        """
+        with self.lock:
+            files = dict(self.files)
+        for file_name in STATIC_FILES:
+            files["/{}".format(file_name)] = self.load_file(
+                os.path.join(directory, file_name), REVALIDATE_CACHE_CONTROL)
+        for static_dir in STATIC_DIRS:
+            for file_name in sorted(os.listdir(os.path.join(directory, static_dir))):
+                files["/{}/{}".format(static_dir, file_name)] = self.load_file(
+                    os.path.join(directory, static_dir, file_name), REVALIDATE_CACHE_CONTROL)
+        files["/"] = files["/index.html"]
+        with self.lock:
+            self.files = files
+
+
+class OutputRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of the store, the store is set on the subclass made by make_handler
+    """
+    store = None
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        stored_file = self.store.get(self.path.split("?", 1)[0])
+        if stored_file is None:
+            self.send_error(404)
+            return
+        body = stored_file.body
+        etag = stored_file.etag
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        use_gzip = stored_file.gzip_body is not None and "gzip" in accept_encoding
+        if use_gzip:
+            body = stored_file.gzip_body
+            etag = stored_file.gzip_etag
+        if_none_match = self.headers.get("If-None-Match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            self.send_response(304)
+            self.send_common_headers(stored_file, etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_common_headers(stored_file, etag)
+        self.send_header("Content-Type", stored_file.content_type)
+        if use_gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_common_headers(self, stored_file, etag):
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", stored_file.cache_control)
+        if stored_file.gzip_body is not None:
+            self.send_header("Vary", "Accept-Encoding")
+
+    def log_message(self, log_format, *args):
+        logging.getLogger("OutputRequestHandler").debug(log_format, *args)
+
+
+def make_handler(store):
+    """
+    Returns a request handler class that serves the files of a store
+    """
+    return type("StoreRequestHandler", (OutputRequestHandler,), {"store": store})
+
+
+class RefreshDaemon:
+    """
+    Regenerates the outputs on an interval and keeps the store up to date
+    """
+
+    def __init__(self, create_helper, store, output_dir, interval=3600, workers=1,
+                 metrics_file=None, exclude=()):
+        """
+        :param create_helper function: Returns a new CSSEGISandDataHelper for each refresh,
+               they should share an OutputTags so the unchanged outputs are reused
+        :param store OutputStore: Where the outputs are loaded after each refresh
+        :param output_dir str: The directory the helpers write into
+        :param interval float: Seconds between the refreshes
+        :param workers int: The process_all workers
+        :param metrics_file str: Where the metrics of each refresh are written
+        :param exclude list: Directories and files in output_dir that are not served
+        """
+        self.logger = logging.getLogger("RefreshDaemon")
+        self.create_helper = create_helper
+        self.store = store
+        self.output_dir = output_dir
+        self.interval = interval
+        self.workers = workers
+        self.metrics_file = metrics_file
+        self.exclude = exclude
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        """
+        Loads the sources and regenerates the outputs whose inputs changed
+        :returns bool: True when any output was regenerated
+        """
+        self.logger.info("INIT refresh")
+        csse_helper = self.create_helper()
+        csse_helper.load_default_datasources()
+        csse_helper.process_all(workers=self.workers)
+        if self.metrics_file:
+            csse_helper.metrics.write(self.metrics_file)
+        if "generated" not in csse_helper.metrics.outputs.values():
+            self.logger.info("DONE refresh, the sources didn't change")
+            return False
+        self.store.load_directory(self.output_dir, "/data", exclude=self.exclude)
+        self.logger.info("DONE refresh")
+        return True
+
+    def run(self):
+        """
+        Refreshes until stopped, a failed refresh keeps serving the previous outputs
+        """
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("Refresh failed, serving the previous outputs")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def serve(create_helper, output_dir, host="", port=8000, interval=3600, workers=1,
+          metrics_file=None, exclude=(), static_dir=None):
+    """
+    Serves the globe and its outputs, refreshing them in a background thread
+    :param static_dir str: The directory of index.html and its scripts, by default this directory
+    """
+    logger = logging.getLogger("serve")
+    store = OutputStore()
+    store.load_static(static_dir or os.path.dirname(os.path.abspath(__file__)))
+    if os.path.isdir(output_dir):
+        # The outputs of a previous run are served until the first refresh finishes
+        store.load_directory(output_dir, "/data", exclude=exclude)
+    daemon = RefreshDaemon(create_helper, store, output_dir, interval=interval, workers=workers,
+                           metrics_file=metrics_file, exclude=exclude)
+    refresh_thread = threading.Thread(target=daemon.run, daemon=True)
+    refresh_thread.start()
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    logger.info("Serving on %s:%s, refreshing every %ss",
+                host or "0.0.0.0", server.server_port, interval)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        server.server_close()
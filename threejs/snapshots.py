@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+Versioned snapshots of the parsed cumulative matrices, to audit the values revised upstream.
+Each matrix is cut into blocks of locations x dates stored as compressed NumPy archives
+named by their content hash, so the blocks that didn't change are shared between snapshots.
+A snapshot is a manifest with its location keys, date keys and block hashes, two snapshots
+are compared block by block and only the blocks whose hashes differ are loaded:
+    ./snapshots.py data/snapshots confirmed --list
+    ./snapshots.py data/snapshots confirmed --diff <from> <to>
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import numpy
+from columnar import ColumnarRecords
+import utils
+
+SNAPSHOT_VERSION = 1
+BLOCK_ROWS = 256
+BLOCK_DATES = 64
+
+
+def block_hash(keys, date_keys, values):
+    """
+    Returns the sha256 hex digest of a block, its labels are included so
+    the same values at other locations or dates are a different block
+    :param keys list: The location keys of the block rows
+    :param date_keys list: The date keys of the block columns
+    :param values numpy.ndarray: The cumulative values of the block
+    """
+    digest = hashlib.sha256(json.dumps([keys, date_keys]).encode())
+    digest.update(numpy.ascontiguousarray(values, dtype="<i8").tobytes())
+    return digest.hexdigest()
+
+
+class Snapshot:
+    """
+    The manifest of a snapshot, its blocks are loaded on demand and kept once loaded
+    """
+
+    def __init__(self, store, snapshot_id, manifest):
+        """
+        :param store SnapshotStore: Where the blocks are read from
+        :param snapshot_id str: The id of the snapshot, see SnapshotStore.save
+        :param manifest dict: {"version", "name", "keys", "date_keys", "block_rows", "block_dates", "blocks"}
+        """
+        self.store = store
+        self.snapshot_id = snapshot_id
+        self.keys = manifest["keys"]
+        self.date_keys = manifest["date_keys"]
+        self.block_rows = manifest["block_rows"]
+        self.block_dates = manifest["block_dates"]
+        # The hashes of the blocks, by row block and date block
+        self.blocks = manifest["blocks"]
+        self.row_index = {key: row for row, key in enumerate(self.keys)}
+        self.date_index = {date_key: col for col,
+                           date_key in enumerate(self.date_keys)}
+        self.loaded = dict()
+
+    def block_hash(self, row_block, date_block):
+        """
+        Returns the hash of a block, None when the snapshot doesn't have it
+        """
+        if row_block >= len(self.blocks) or date_block >= len(self.blocks[row_block]):
+            return None
+        return self.blocks[row_block][date_block]
+
+    def block(self, row_block, date_block):
+        """
+        Returns the values of a block
+        """
+        block_id = self.blocks[row_block][date_block]
+        if block_id not in self.loaded:
+            self.loaded[block_id] = self.store.load_block(block_id)
+        return self.loaded[block_id]
+
+    def block_slices(self, row_block, date_block):
+        """
+        Returns the row and column slices of a block in the full matrix
+        """
+        rows = slice(row_block * self.block_rows,
+                     min((row_block + 1) * self.block_rows, len(self.keys)))
+        cols = slice(date_block * self.block_dates,
+                     min((date_block + 1) * self.block_dates, len(self.date_keys)))
+        return rows, cols
+
+    def values(self, rows, cols):
+        """
+        Returns the values of some cells, only the blocks that contain them are loaded
+        :param rows numpy.ndarray: The row numbers
+        :param cols numpy.ndarray: The column numbers
+        :returns numpy.ndarray: rows x cols matrix
+        """
+        res = numpy.zeros((len(rows), len(cols)), dtype=numpy.int64)
+        row_blocks = rows // self.block_rows
+        col_blocks = cols // self.block_dates
+        for row_block in numpy.unique(row_blocks):
+            res_rows = numpy.flatnonzero(row_blocks == row_block)
+            for date_block in numpy.unique(col_blocks):
+                res_cols = numpy.flatnonzero(col_blocks == date_block)
+                block = self.block(int(row_block), int(date_block))
+                res[numpy.ix_(res_rows, res_cols)] = block[numpy.ix_(
+                    rows[res_rows] % self.block_rows, cols[res_cols] % self.block_dates)]
+        return res
+
+    def to_records(self):
+        """
+        Loads every block into ColumnarRecords, i.e. to recompute the outputs of a snapshot
+        """
+        cumulative = self.values(numpy.arange(len(self.keys)),
+                                 numpy.arange(len(self.date_keys)))
+        # The keys are "lat,lng,Country - Province"
+        key_parts = [key.split(",") for key in self.keys]
+        return ColumnarRecords(self.keys, [parts[0] for parts in key_parts], [parts[1] for parts in key_parts],
+                               [parts[2] for parts in key_parts], self.date_keys, cumulative)
+
+
+class SnapshotStore:
+    """
+    The snapshots of each output in a directory:
+    - <directory>/blocks/<hash>.npz: The blocks, shared by all the snapshots
+    - <directory>/<name>/<snapshot_id>.json: The snapshot manifests
+    """
+
+    def __init__(self, directory, block_rows=BLOCK_ROWS, block_dates=BLOCK_DATES):
+        """
+        :param directory str: Where the snapshots are kept
+        :param block_rows int: The locations per block
+        :param block_dates int: The dates per block, the appended days only change the last date blocks
+        """
+        self.logger = logging.getLogger("SnapshotStore")
+        self.directory = directory
+        self.block_rows = block_rows
+        self.block_dates = block_dates
+
+    def block_path(self, block_id):
+        return os.path.join(self.directory, "blocks", "{}.npz".format(block_id))
+
+    def manifest_path(self, name, snapshot_id):
+        return os.path.join(self.directory, name, "{}.json".format(snapshot_id))
+
+    def load_block(self, block_id):
+        """
+        Returns the values of a block
+        """
+        with numpy.load(self.block_path(block_id)) as archive:
+            return archive["values"]
+
+    def snapshots(self, name):
+        """
+        Returns the snapshot ids of an output, from the oldest to the newest
+        """
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(file_name[:-len(".json")] for file_name in os.listdir(directory)
+                      if file_name.endswith(".json") and not file_name.startswith("."))
+
+    def load(self, name, snapshot_id):
+        """
+        Returns a Snapshot of an output, its blocks are not loaded yet
+        """
+        with open(self.manifest_path(name, snapshot_id)) as file_handle:
+            manifest = json.load(file_handle)
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version: {}".format(
+                manifest.get("version")))
+        return Snapshot(self, snapshot_id, manifest)
+
+    def save(self, name, records):
+        """
+        Stores the cumulative matrix of an output, the existing blocks are not written again
+        :param name str: The name of the output, i.e. "confirmed"
+        :param records ColumnarRecords: The parsed records
+        :returns str: The snapshot id, the one of the latest snapshot if nothing changed
+        """
+        self.logger.info("INIT snapshot of %s", name)
+        os.makedirs(os.path.join(self.directory, "blocks"), exist_ok=True)
+        os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        date_keys = sorted(records.date_keys)
+        cumulative = records.cumulative[:, [
+            records.date_index[date_key] for date_key in date_keys]]
+        blocks = []
+        written = 0
+        for row_start in range(0, len(records.keys_list), self.block_rows):
+            row_blocks = []
+            keys = records.keys_list[row_start:row_start + self.block_rows]
+            for col_start in range(0, len(date_keys), self.block_dates):
+                values = cumulative[row_start:row_start + self.block_rows,
+                                    col_start:col_start + self.block_dates]
+                block_id = block_hash(
+                    keys, date_keys[col_start:col_start + self.block_dates], values)
+                if not os.path.exists(self.block_path(block_id)):
+                    content = io.BytesIO()
+                    numpy.savez_compressed(content, values=values)
+                    utils.write_chunks_to_file(self.block_path(
+                        block_id), [content.getvalue()], mode="wb")
+                    written += 1
+                row_blocks.append(block_id)
+            blocks.append(row_blocks)
+        manifest = dict()
+        manifest["version"] = SNAPSHOT_VERSION
+        manifest["name"] = name
+        manifest["keys"] = records.keys_list
+        manifest["date_keys"] = date_keys
+        manifest["block_rows"] = self.block_rows
+        manifest["block_dates"] = self.block_dates
+        manifest["blocks"] = blocks
+        previous = self.snapshots(name)
+        if previous:
+            latest = self.load(name, previous[-1])
+            if latest.keys == manifest["keys"] and latest.date_keys == date_keys and latest.blocks == blocks:
+                self.logger.info("DONE snapshot of %s, unchanged since %s", name, previous[-1])
+                return previous[-1]
+        snapshot_id = datetime.datetime.now(
+            datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        utils.write_to_file(self.manifest_path(
+            name, snapshot_id), json.dumps(manifest))
+        self.logger.info("DONE snapshot %s of %s, %s new blocks",
+                         snapshot_id, name, written)
+        return snapshot_id
+
+    def diff(self, name, from_id, to_id):
+        """
+        Returns the cells that changed between two snapshots of an output.
+        The blocks with the same hash at the same position are skipped without being loaded,
+        so the work is proportional to the changed blocks.
+        :param name str: The name of the output, i.e. "confirmed"
+        :param from_id str: The older snapshot id
+        :param to_id str: The newer snapshot id
+        :returns dict: {"from", "to", "added_locations", "removed_locations", "added_dates", "removed_dates",
+                 "changed_blocks", "total_blocks", "cells": [{"location", "date", "from", "to"}]}
+        """
+        old = self.load(name, from_id)
+        new = self.load(name, to_id)
+        res = dict()
+        res["from"] = from_id
+        res["to"] = to_id
+        res["added_locations"] = [key for key in new.keys if key not in old.row_index]
+        res["removed_locations"] = [key for key in old.keys if key not in new.row_index]
+        res["added_dates"] = [date_key for date_key in new.date_keys if date_key not in old.date_index]
+        res["removed_dates"] = [date_key for date_key in old.date_keys if date_key not in new.date_index]
+        res["changed_blocks"] = 0
+        res["total_blocks"] = 0
+        res["cells"] = []
+        for row_block, row_blocks in enumerate(old.blocks):
+            for date_block, block_id in enumerate(row_blocks):
+                res["total_blocks"] += 1
+                # The hash covers the labels, an equal hash is the same cells with the same values
+                if new.block_hash(row_block, date_block) == block_id:
+                    continue
+                res["changed_blocks"] += 1
+                rows, cols = old.block_slices(row_block, date_block)
+                keys = old.keys[rows]
+                date_keys = old.date_keys[cols]
+                old_rows = numpy.array([row for row, key in enumerate(keys) if key in new.row_index],
+                                       dtype=numpy.int64)
+                old_cols = numpy.array([col for col, date_key in enumerate(date_keys) if date_key in new.date_index],
+                                       dtype=numpy.int64)
+                if len(old_rows) == 0 or len(old_cols) == 0:
+                    continue
+                old_values = old.block(row_block, date_block)[
+                    numpy.ix_(old_rows, old_cols)]
+                new_values = new.values(
+                    numpy.array([new.row_index[keys[row]]
+                                for row in old_rows], dtype=numpy.int64),
+                    numpy.array([new.date_index[date_keys[col]] for col in old_cols], dtype=numpy.int64))
+                for row, col in zip(*numpy.nonzero(old_values != new_values)):
+                    cell = dict()
+                    cell["location"] = keys[old_rows[row]]
+                    cell["date"] = date_keys[old_cols[col]]
+                    cell["from"] = int(old_values[row, col])
+                    cell["to"] = int(new_values[row, col])
+                    res["cells"].append(cell)
+        return res
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments
+    :param argv list: The arguments, by default sys.argv is used
+    """
+    parser = argparse.ArgumentParser(
+        description="Lists and compares the snapshots written by transform.py --snapshot-dir")
+    parser.add_argument("directory", help="The --snapshot-dir of transform.py")
+    parser.add_argument("name", help="The output, i.e. confirmed")
+    parser.add_argument("--list", action="store_true",
+                        help="List the snapshot ids, from the oldest to the newest")
+    parser.add_argument("--diff", nargs="*", metavar="SNAPSHOT_ID",
+                        help="The changed cells between two snapshots, by default the two latest")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    store = SnapshotStore(args.directory)
+    snapshot_ids = store.snapshots(args.name)
+    if args.list:
+        for snapshot_id in snapshot_ids:
+            print(snapshot_id)
+    if args.diff is not None:
+        if len(args.diff) not in (0, 2):
+            raise SystemExit("--diff takes two snapshot ids, or none for the two latest")
+        if not args.diff and len(snapshot_ids) < 2:
+            raise SystemExit("There are less than two snapshots of {}".format(args.name))
+        from_id, to_id = args.diff if args.diff else snapshot_ids[-2:]
+        print(json.dumps(store.diff(args.name, from_id, to_id), indent=2))
+
+
+if __name__ == "__main__":
+    main()
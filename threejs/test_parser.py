@@ -1,16 +1,90 @@
 #!/usr/bin/env python
 import unittest
+import benchmark
 import transform
 from CSSEGISandData import CSSEGISandDataHelper
 from CSSEGISandData import CSSEGISandData
+import contextlib
+import hashlib
+import io
 import json
 import logging
+import os
+import tempfile
+import threading
+import unittest.mock
+import numpy
+import requests
+import serve
 import utils
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from download_cache import DownloadCache
+from world_population import WorldOMeters
+from incremental import IncrementalState
+from local_source import LocalSource
+from output_tags import OutputTags
+from snapshots import SnapshotStore
+from query import OutputQuery
 
 logger = logging.getLogger()
 logger.level = logging.ERROR
 
 
+GLOBAL_CSV = "\n".join([
+    "Province/State,Country/Region,Lat,Long,1/21/20,1/22/20,1/23/20",
+    ",Country,0,80,5,6,4",
+    ",US,40,-100,3,4,9",
+    '"Some, Province",Other,10,5,1,5,9',
+]).encode()
+US_CONFIRMED_CSV = "\n".join([
+    "UID,iso2,iso3,code3,FIPS,Admin2,Province_State,Country_Region,Lat,Long_,Combined_Key,1/21/20,1/22/20,1/23/20",
+    '1,US,USA,840,1001,Autauga,Alabama,US,32.5,-86.6,"Autauga, Alabama, US",1,2,5',
+    '2,US,USA,840,1003,Baldwin,Alabama,US,30.7,-87.7,"Baldwin, Alabama, US",2,2,4',
+]).encode()
+US_DEATHS_CSV = "\n".join([
+    "UID,iso2,iso3,code3,FIPS,Admin2,Province_State,Country_Region,Lat,Long_,Combined_Key,Population,1/21/20,1/22/20,1/23/20",
+    '1,US,USA,840,1001,Autauga,Alabama,US,32.5,-86.6,"Autauga, Alabama, US",55869,0,1,1',
+    '2,US,USA,840,1003,Baldwin,Alabama,US,30.7,-87.7,"Baldwin, Alabama, US",223234,0,0,1',
+]).encode()
+
+
+def offline_helper(output_dir, **kwargs):
+    """
+    Returns a CSSEGISandDataHelper loaded with the test datasets, without network access
+    """
+    csse_helper = CSSEGISandDataHelper(
+        logger, load_population=False, output_dir=output_dir, **kwargs)
+    csse_helper.global_population_dataset = {"Country": 100, "Other": 1000}
+    csse_helper.global_population = 1100
+    csse_helper.global_confirmed_dataset = GLOBAL_CSV
+    csse_helper.global_deaths_dataset = GLOBAL_CSV
+    csse_helper.global_recovered_dataset = GLOBAL_CSV
+    csse_helper.us_confirmed_dataset = US_CONFIRMED_CSV
+    csse_helper.us_deaths_dataset = US_DEATHS_CSV
+    return csse_helper
+
+
+def read_outputs(output_dir):
+    """
+    Returns the contents of the files in the output directory, by file name
+    """
+    res = dict()
+    for filename in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, filename)
+        if os.path.isfile(path):
+            with open(path, "rb") as file_handle:
+                res[filename] = file_handle.read()
+    return res
+
+
+def appended_day(content):
+    """
+    Returns a time series CSV with one more day, 1/24/20
+    """
+    lines = content.decode().split("\n")
+    return "\n".join([lines[0] + ",1/24/20"] + [line + ",10" for line in lines[1:]]).encode()
+
+
 class TestParsing(unittest.TestCase):
 
     def setUp(self):
@@ -168,13 +242,795 @@ class TestParsing(unittest.TestCase):
     def test_date_key_sanity_check(self):
         header_1 = "Province,Country,Lat,Long,1/21/20,1/22/20".split(",")
         header_2 = "Province,Country,Lat,Long,1/25/20,1/26/20".split(",")
-        csse_helper = CSSEGISandDataHelper(logger)
+        with tempfile.TemporaryDirectory() as output_dir:
+            csse_helper = offline_helper(output_dir)
         csse_handler_1 = CSSEGISandData(logger)
         self.assertTrue(csse_helper.date_keys_sanity_check(csse_handler_1.date_keys, do_exit=False))
         csse_handler_1.parse_header(header_1)
+        self.assertTrue(csse_helper.date_keys_sanity_check(csse_handler_1.date_keys, do_exit=False))
         csse_handler_2 = CSSEGISandData(logger)
         csse_handler_2.parse_header(header_2)
         self.assertFalse(csse_helper.date_keys_sanity_check(csse_handler_2.date_keys, do_exit=False))
-        
+
+    def test_columnar_engine_matches_dict_engine(self):
+        content = "\n".join([
+            "Province,Country,Lat,Long,1/21/20,1/22/20,1/23/20",
+            "Province,Country,0,80,5,6,4",
+            '"Some, Province",Country,10,5,1.0,5,9',
+            ",Other,20,30,0,0,2",
+            "Province,Country,0,80,7,8,9",
+        ]).encode()
+        dict_handler = CSSEGISandData(logger)
+        dict_records = dict_handler.parse_csv_file_contents(content)
+        numpy_handler = CSSEGISandData(logger, engine="numpy")
+        numpy_records = numpy_handler.parse_csv_file_contents(content)
+        self.assertEqual(list(numpy_records.keys()), list(dict_records.keys()))
+        self.assertEqual(numpy_records.to_dict(), dict_records)
+        self.assertEqual(numpy_records["0,80,Country - Province"]["20-01-23"], {
+                         "cumulative": 9, "day": 1, "delta": 0})
+        self.assertEqual(
+            numpy_handler.generate_globe_json_string(
+                numpy_records, self.world_population_dataset, self.world_population),
+            dict_handler.generate_globe_json_string(
+                dict_records, self.world_population_dataset, self.world_population))
+
+    def test_series_stats_match_stats_for_day(self):
+        content = "\n".join([
+            "Province,Country,Lat,Long,1/21/20,1/22/20,1/23/20,1/24/20",
+            ",Country,0,80,5,6,4,4",
+            ",US,40,-100,90,95,120,110",
+            ",Small,10,5,0,3,3,10",
+            "Province,Country,20,30,0,-2,2,0",
+            ",Zero,1,1,0,0,0,0",
+        ]).encode()
+        population = {"Country": 100, "Small": 7, "US": 1000}
+        for engine in ("dict", "numpy"):
+            csse_handler = CSSEGISandData(logger, engine=engine)
+            gps_records = csse_handler.parse_csv_file_contents(content)
+            expected = [
+                csse_handler.get_stats_for_day(gps_records, series, population, 1107)
+                for series in sorted(csse_handler.date_keys)]
+            series_stats = csse_handler.get_series_stats(gps_records, population, 1107)
+            self.assertEqual(json.dumps(series_stats), json.dumps(expected))
+
+    def test_incremental_series_stats(self):
+        header = "Province,Country,Lat,Long,1/21/20,1/22/20,1/23/20"
+        rows = [",Country,0,80,5,6,4", ",Other,10,5,1,5,9"]
+        content = "\n".join([header] + rows).encode()
+        appended_content = "\n".join([header + ",1/24/20"] + [
+            row + ",20" for row in rows]).encode()
+        revised_content = "\n".join([header + ",1/24/20"] + [
+            row.replace(",5,", ",7,") + ",20" for row in rows]).encode()
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_file = os.path.join(state_dir, "confirmed.json")
+            for engine in ("dict", "numpy"):
+                csse_handler = CSSEGISandData(logger, engine=engine)
+                state = IncrementalState(state_file)
+                state.load()
+                state.series_stats(csse_handler, csse_handler.parse_csv_file_contents(
+                    content), self.world_population_dataset, self.world_population)
+                state.save()
+                for new_content, expected_processed in ((appended_content, 3), (revised_content, None)):
+                    csse_handler = CSSEGISandData(logger, engine=engine)
+                    gps_records = csse_handler.parse_csv_file_contents(new_content)
+                    state = IncrementalState(state_file)
+                    state.load()
+                    records = csse_handler.parse_csv_file_contents_columnar(new_content)
+                    self.assertEqual(state.appended_columns(
+                        records, state.state["population_digest"]), expected_processed)
+                    self.assertEqual(
+                        state.series_stats(csse_handler, gps_records,
+                                           self.world_population_dataset, self.world_population),
+                        csse_handler.get_series_stats(gps_records, self.world_population_dataset, self.world_population))
+                os.remove(state_file)
+
+    def test_columnar_merge_matches_merge_dict(self):
+        header = "Province,Country,Lat,Long,1/21/20,1/22/20"
+        lhs_content = "\n".join(
+            [header, "Province,Country,0,80,5,6", ",Other,1,2,3,4"]).encode()
+        rhs_content = "\n".join(
+            [header, ",Other,1,2,5,5", "Province,Country,10,5,1,5"]).encode()
+        parsed = {}
+        for engine in ("dict", "numpy"):
+            parsed[engine] = (
+                CSSEGISandData(logger, engine=engine).parse_csv_file_contents(lhs_content),
+                CSSEGISandData(logger, engine=engine).parse_csv_file_contents(rhs_content))
+        merged_dict = utils.merge_dict(*parsed["dict"])
+        merged_columns = parsed["numpy"][0].merge(parsed["numpy"][1])
+        self.assertEqual(list(merged_columns.keys()), list(merged_dict.keys()))
+        self.assertEqual(merged_columns.to_dict(), merged_dict)
+
+    def test_location_index(self):
+        content = GLOBAL_CSV + b"\n,Nowhere,x,x,1,2,3"
+        csse_handler = CSSEGISandData(logger, engine="numpy")
+        records = csse_handler.parse_csv_file_contents(content)
+        location_index = csse_handler.location_index(
+            records, self.world_population_dataset)
+        self.assertIs(csse_handler.location_index(
+            records, self.world_population_dataset), location_index)
+        self.assertEqual(location_index.countries, [
+                         "Country", "US", "Other", "Nowhere"])
+        self.assertEqual(location_index.provinces, [
+                         "", "", "Some Province", ""])
+        self.assertEqual(location_index.population.tolist(), [100, 0, 0, 0])
+        self.assertEqual(location_index.hidden.tolist(), [
+                         False, True, False, False])
+        # The row without lat/lng is not drawn, but it keeps its id
+        self.assertEqual(location_index.valid_ids.tolist(), [0, 1, 2])
+        self.assertEqual(location_index.location_struct(1), {
+                         "lat": 40.0, "lng": -100.0, "location": "US", "population_2020": 0, "hidden": 1})
+        us_handler = CSSEGISandData(logger, USFileType=True, engine="numpy")
+        us_index = us_handler.location_index(
+            us_handler.parse_csv_file_contents(US_CONFIRMED_CSV), self.world_population_dataset)
+        self.assertEqual(us_index.counties, ["Autauga", "Baldwin"])
+        self.assertEqual(us_index.provinces, ["Alabama", "Alabama"])
+
+
+POPULATION_PAGE = b"""<html><body><table>
+<tr><th>#</th><th>Country (or dependency)</th><th>Population (2020)</th></tr>
+<tr><td>1</td><td>Country</td><td>100</td></tr>
+</table></body></html>"""
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves fixed files with an ETag, counting the full responses
+    """
+    files = {
+        "/confirmed.csv": b"Province,Country,Lat,Long,1/21/20\n,Country,0,80,5\n",
+        "/population": POPULATION_PAGE,
+    }
+    full_responses = 0
+
+    def do_GET(self):
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"{}"'.format(len(body))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        StandInHandler.full_responses += 1
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHelper(unittest.TestCase):
+
+    def test_parallel_processing_matches_sequential(self):
+        with tempfile.TemporaryDirectory() as sequential_dir, tempfile.TemporaryDirectory() as parallel_dir:
+            offline_helper(sequential_dir).process_all(workers=1)
+            offline_helper(parallel_dir, engine="numpy").process_all(workers=3)
+            sequential_outputs = read_outputs(sequential_dir)
+            self.assertEqual(sorted(sequential_outputs.keys()), [
+                             "confirmed.json", "deaths.json", "recovered.json"])
+            self.assertEqual(read_outputs(parallel_dir), sequential_outputs)
+
+    def test_parallel_date_keys_mismatch_matches_sequential(self):
+        outputs = []
+        for workers in (1, 3):
+            with tempfile.TemporaryDirectory() as output_dir:
+                csse_helper = offline_helper(output_dir, tiles=True, tile_days=2)
+                # The deaths have one more day than the confirmed
+                csse_helper.global_deaths_dataset = appended_day(GLOBAL_CSV)
+                csse_helper.us_deaths_dataset = appended_day(US_DEATHS_CSV)
+                with self.assertRaises(SystemExit):
+                    csse_helper.process_all(workers=workers)
+                outputs.append(sorted(os.path.relpath(os.path.join(root, file_name), output_dir)
+                                      for root, _dirs, file_names in os.walk(output_dir)
+                                      for file_name in file_names))
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertIn("confirmed.json", outputs[0])
+        self.assertNotIn("deaths.json", outputs[0])
+        self.assertNotIn("recovered.json", outputs[0])
+        self.assertFalse([path for path in outputs[1] if os.path.basename(path).startswith(".")])
+
+    def test_stage_metrics(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            csse_helper = offline_helper(
+                output_dir, output_format="both", tiles=True)
+            csse_helper.process_all(workers=2)
+            metrics_file = os.path.join(output_dir, "metrics", "run.json")
+            csse_helper.metrics.write(metrics_file)
+            with open(metrics_file) as file_handle:
+                run_metrics = json.load(file_handle)
+        stages = run_metrics["stages"]
+        # 5 files are parsed, 3 outputs get stats
+        self.assertEqual(stages["parse"]["spans"], 5)
+        self.assertEqual(stages["parse"]["rows"], 3 * 3 + 2 * 2)
+        self.assertEqual(stages["parse"]["cells"], 3 * (3 * 3 + 2 * 2))
+        self.assertEqual(stages["parse"]["bytes_in"], 3 * len(GLOBAL_CSV) +
+                         len(US_CONFIRMED_CSV) + len(US_DEATHS_CSV))
+        self.assertEqual(stages["stats"]["spans"], 3)
+        self.assertEqual(stages["download"]["spans"], 0)
+        written = [span for span in run_metrics["spans"]
+                   if span["stage"] == "write"]
+        self.assertIn("confirmed.bin", [span["name"] for span in written])
+        self.assertEqual(stages["write"]["bytes_out"],
+                         sum(span["bytes_out"] for span in written))
+        self.assertGreater(run_metrics["peak_rss_bytes"], 0)
+
+    def test_local_source_reuses_unchanged_outputs(self):
+        with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as expected_dir, \
+                tempfile.TemporaryDirectory() as output_dir:
+            for name, content in (("confirmed_global", GLOBAL_CSV), ("deaths_global", GLOBAL_CSV),
+                                  ("recovered_global", GLOBAL_CSV), ("confirmed_US", US_CONFIRMED_CSV),
+                                  ("deaths_US", US_DEATHS_CSV)):
+                with open(os.path.join(source_dir, "time_series_covid19_{}.csv".format(name)), "wb") as file_handle:
+                    file_handle.write(content)
+            offline_helper(expected_dir).process_all()
+            state_file = os.path.join(output_dir, "state", "sources.json")
+            tags_file = os.path.join(output_dir, "state", "outputs.json")
+            us_deaths_file = os.path.join(source_dir, "time_series_covid19_deaths_US.csv")
+
+            def parsed_files(workers):
+                csse_helper = offline_helper(
+                    output_dir, local_source=LocalSource(source_dir, state_file=state_file),
+                    output_tags=OutputTags(tags_file))
+                for dataset_attribute in ("global_confirmed_dataset", "global_deaths_dataset",
+                                          "global_recovered_dataset", "us_confirmed_dataset",
+                                          "us_deaths_dataset"):
+                    setattr(csse_helper, dataset_attribute, None)
+                csse_helper.process_all(workers=workers)
+                return sorted(span["name"] for span in csse_helper.metrics.spans if span["stage"] == "parse")
+            self.assertEqual(len(parsed_files(1)), 5)
+            self.assertEqual(read_outputs(output_dir), read_outputs(expected_dir))
+            self.assertEqual(parsed_files(2), [])
+            # A new mtime with the same contents is hashed, but not processed
+            os.utime(us_deaths_file, ns=(0, 0))
+            self.assertEqual(parsed_files(1), [])
+            with open(us_deaths_file, "ab") as file_handle:
+                file_handle.write(b"\n")
+            self.assertEqual(parsed_files(2), ["Global Deaths", "US Deaths"])
+            os.remove(os.path.join(output_dir, "recovered.json"))
+            self.assertEqual(parsed_files(1), ["Global Recovered"])
+            self.assertEqual(read_outputs(output_dir), read_outputs(expected_dir))
+
+    def test_output_tags_reuse_outputs_of_unchanged_inputs(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            tags_file = os.path.join(output_dir, "state", "outputs.json")
+
+            def run(**kwargs):
+                csse_helper = offline_helper(
+                    output_dir, output_tags=OutputTags(tags_file), output_format="both")
+                for attribute, value in kwargs.items():
+                    setattr(csse_helper, attribute, value)
+                csse_helper.process_all(workers=1)
+                return csse_helper.metrics.outputs
+            self.assertEqual(set(run().values()), {"generated"})
+            mtimes = {name: os.stat(os.path.join(output_dir, name)).st_mtime_ns
+                      for name in read_outputs(output_dir)}
+            self.assertEqual(set(run().values()), {"reused"})
+            self.assertEqual({name: os.stat(os.path.join(output_dir, name)).st_mtime_ns
+                              for name in read_outputs(output_dir)}, mtimes)
+            outputs = run(global_recovered_dataset=GLOBAL_CSV + b"\n")
+            self.assertEqual(outputs, {"confirmed": "reused", "deaths": "reused",
+                                       "recovered": "generated"})
+            # The outputs are generated again to record their first snapshot
+            snapshot_dir = os.path.join(output_dir, "snapshots")
+            outputs = run(global_recovered_dataset=GLOBAL_CSV + b"\n", snapshot_dir=snapshot_dir)
+            self.assertEqual(set(outputs.values()), {"generated"})
+            self.assertEqual(len(SnapshotStore(snapshot_dir).snapshots("confirmed")), 1)
+            population = {"Country": 100, "Other": 2000}
+            self.assertEqual(set(run(global_population_dataset=population).values()), {"generated"})
+            # The tags of an other output format don't match
+            csse_helper = offline_helper(
+                output_dir, output_tags=OutputTags(tags_file), compact=True)
+            csse_helper.process_all(workers=1)
+            self.assertEqual(set(csse_helper.metrics.outputs.values()), {"generated"})
+
+    def test_output_tags_check_the_tile_files(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            tags_file = os.path.join(output_dir, "state", "outputs.json")
+
+            def run():
+                csse_helper = offline_helper(
+                    output_dir, output_tags=OutputTags(tags_file), tiles=True, tile_days=2)
+                csse_helper.process_all(workers=1)
+                return csse_helper.metrics.outputs
+            self.assertEqual(set(run().values()), {"generated"})
+            self.assertEqual(set(run().values()), {"reused"})
+            with open(os.path.join(output_dir, "deaths.manifest.json")) as file_handle:
+                tile_file = json.load(file_handle)["tiles"][0]["file"]
+            os.remove(os.path.join(output_dir, tile_file))
+            self.assertEqual(run(), {"confirmed": "reused", "deaths": "generated",
+                                     "recovered": "reused"})
+            self.assertTrue(os.path.exists(os.path.join(output_dir, tile_file)))
+
+    def test_country_rollups(self):
+        with tempfile.TemporaryDirectory() as plain_dir, tempfile.TemporaryDirectory() as rollup_dir, \
+                tempfile.TemporaryDirectory() as numpy_dir:
+            offline_helper(plain_dir).process_all()
+            offline_helper(rollup_dir, rollups=True,
+                           output_format="both").process_all()
+            offline_helper(numpy_dir, rollups=True, engine="numpy",
+                           output_format="both").process_all()
+            plain = json.loads(read_outputs(plain_dir)["confirmed.json"])
+            outputs = read_outputs(rollup_dir)
+            self.assertEqual(read_outputs(numpy_dir), outputs)
+        globe = json.loads(outputs["confirmed.json"])
+        rollup = json.loads(outputs["confirmed.countries.json"])
+        # The aggregated US row is not shipped, the counties are grouped under US
+        self.assertEqual([location["location"] for location in globe["locations"]], [
+            "Country", "Other - Some Province", "US - Alabama - Autauga", "US - Alabama - Baldwin"])
+        self.assertEqual([country["country"] for country in rollup["countries"]], [
+            "Country", "Other", "US"])
+        self.assertEqual(rollup["countries"][2]["locations"], [2, 4])
+        self.assertEqual(rollup["countries"][1]["population_2020"], 1000)
+        for country in rollup["countries"]:
+            start, end = country["locations"]
+            for day_idx, day_values in enumerate(country["values"]):
+                self.assertEqual(day_values, [sum(location["values"][day_idx][channel]
+                                                  for location in globe["locations"][start:end])
+                                              for channel in range(3)])
+        self.assertEqual([day_stats["cumulative_global"] for day_stats in globe["series_stats"]],
+                         [day_stats["cumulative_global"] for day_stats in plain["series_stats"]])
+        index = json.loads(outputs["confirmed.index.json"])
+        self.assertNotIn("hidden", json.dumps(index["locations"]))
+
+    def test_country_rollups_total_the_undrawn_rows(self):
+        # A row without lat/lng, i.e. a ship, is not drawn but it's in the totals
+        global_csv = GLOBAL_CSV + b"\n,Ship,,,100,100,100"
+        for engine in ("dict", "numpy"):
+            with tempfile.TemporaryDirectory() as plain_dir, tempfile.TemporaryDirectory() as rollup_dir:
+                for output_dir, rollups in ((plain_dir, False), (rollup_dir, True)):
+                    csse_helper = offline_helper(output_dir, rollups=rollups, engine=engine)
+                    csse_helper.global_confirmed_dataset = global_csv
+                    csse_helper.process_all()
+                plain = json.loads(read_outputs(plain_dir)["confirmed.json"])
+                outputs = read_outputs(rollup_dir)
+            globe = json.loads(outputs["confirmed.json"])
+            rollup = json.loads(outputs["confirmed.countries.json"])
+            for stat in ("cumulative_global", "cumulative_global_percent", "day_global", "delta_global"):
+                self.assertEqual([day_stats[stat] for day_stats in globe["series_stats"]],
+                                 [day_stats[stat] for day_stats in plain["series_stats"]])
+            self.assertEqual(globe["series_stats"][0]["cumulative_global"], 109)
+            self.assertNotIn("Ship", [country["country"] for country in rollup["countries"]])
+            self.assertEqual(len(globe["locations"]), 4)
+            self.assertEqual(rollup["countries"][-1]["locations"], [2, 4])
+            # The tops only point to drawn locations
+            self.assertEqual(globe["series_stats"][0]["top_cumulative"], {"value": 5, "location_idx": 0})
+
+    def test_rankings_match_sorted_values(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, rankings=2).process_all()
+            outputs = read_outputs(output_dir)
+        globe = json.loads(outputs["confirmed.json"])
+        rankings = json.loads(outputs["confirmed.rankings.json"])
+        self.assertEqual(rankings["k"], 2)
+        self.assertEqual(rankings["date_keys"], [
+                         day_stats["name"] for day_stats in globe["series_stats"]])
+        locations = globe["locations"]
+        metrics = {"cumulative": lambda location, day_idx: location["values"][day_idx][0],
+                   "day": lambda location, day_idx: location["values"][day_idx][1],
+                   "delta": lambda location, day_idx: abs(location["values"][day_idx][2]),
+                   "cumulative_percent": lambda location, day_idx: (location["values"][day_idx][0] /
+                                                                    location["population_2020"]) * 100
+                   if location["population_2020"] else 0}
+        for metric, value_fn in metrics.items():
+            for day_idx, day_ranking in enumerate(rankings["rankings"][metric]):
+                # The hidden US row is not ranked
+                ranked = [location_idx for location_idx, location in enumerate(locations)
+                          if len(location["values"][day_idx]) == 3 and value_fn(location, day_idx) > 0]
+                ranked.sort(key=lambda location_idx: -value_fn(locations[location_idx], day_idx))
+                self.assertEqual(day_ranking, ranked[:2], metric)
+        # Only "Country" matches the population table
+        self.assertEqual(rankings["rankings"]["cumulative_percent"][0], [0])
+
+    def test_snapshot_diff(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            store = SnapshotStore(snapshot_dir, block_rows=2, block_dates=2)
+            csse_handler = CSSEGISandData(logger, engine="numpy")
+            first = csse_handler.parse_csv_file_contents_columnar(GLOBAL_CSV)
+            first_id = store.save("confirmed", first)
+            self.assertEqual(store.save("confirmed", first), first_id)
+            # A revised past value and an appended day
+            revised = GLOBAL_CSV.replace(b",US,40,-100,3,4,9", b",US,40,-100,3,7,9,12").replace(
+                b"1/23/20\n", b"1/23/20,1/24/20\n").replace(b",5,6,4\n", b",5,6,4,4\n").replace(
+                b",1,5,9", b",1,5,9,9")
+            second = CSSEGISandData(logger, engine="numpy").parse_csv_file_contents_columnar(revised)
+            second_id = store.save("confirmed", second)
+            self.assertEqual(store.snapshots("confirmed"), [first_id, second_id])
+            blocks = os.listdir(os.path.join(snapshot_dir, "blocks"))
+            diff = store.diff("confirmed", first_id, second_id)
+            restored = store.load("confirmed", second_id).to_records()
+        self.assertEqual(diff["added_dates"], ["20-01-24"])
+        self.assertEqual(diff["added_locations"], [])
+        self.assertEqual(diff["cells"], [{"location": "40,-100,US", "date": "20-01-22", "from": 4, "to": 7}])
+        # 2 location blocks x 2 date blocks, the first date block of the other locations is shared
+        self.assertEqual((diff["changed_blocks"], diff["total_blocks"]), (3, 4))
+        self.assertEqual(len(blocks), 4 + 3)
+        self.assertEqual(restored.keys_list, second.keys_list)
+        numpy.testing.assert_array_equal(restored.cumulative, second.cumulative)
+
+    def test_query_matches_json(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, output_format="both").process_all()
+            globe = json.loads(read_outputs(output_dir)["confirmed.json"])
+            output_query = OutputQuery(output_dir, "confirmed")
+            location_ids = output_query.find(locations=["Country"], countries=["US"])
+            series = output_query.series(
+                location_ids, start="2020-01-22", channel="cumulative")
+            aggregate = output_query.aggregate(
+                location_ids, end="20-01-22", function="max")
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                transform.main(["query", "confirmed", "--data-dir", output_dir,
+                                "--country", "Other", "--aggregate", "sum"])
+        locations = {location["location"]: location["values"] for location in globe["locations"]}
+        # The hidden aggregated US row is not part of the US country
+        self.assertEqual([location["location"] for location in series["locations"]], [
+                         "Country", "US - Alabama - Autauga", "US - Alabama - Baldwin"])
+        self.assertEqual(series["date_keys"], ["20-01-22", "20-01-23"])
+        for location in series["locations"]:
+            self.assertEqual(location["values"], [
+                             day_values[0] for day_values in locations[location["location"]][1:]])
+        self.assertEqual(aggregate["date_keys"], ["20-01-21", "20-01-22"])
+        self.assertEqual([location["value"] for location in aggregate["locations"]], [5, 1, 2])
+        self.assertEqual(aggregate["total"], 8)
+        self.assertEqual(json.loads(stdout.getvalue())["total"], 9)
+        with self.assertRaises(KeyError):
+            output_query.find(countries=["Atlantis"])
+        with self.assertRaises(ValueError):
+            output_query.columns(start="2020-3-1")
+
+    def test_query_loads_only_the_lookup(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            csse_helper = offline_helper(output_dir, output_format="binary")
+            # A second location named "Country"
+            csse_helper.global_confirmed_dataset = GLOBAL_CSV + b"\n,Country,1,81,7,8,9"
+            csse_helper.process_all()
+            # The index with the location structs and series stats is not needed
+            os.remove(os.path.join(output_dir, "confirmed.index.json"))
+            output_query = OutputQuery(output_dir, "confirmed")
+            location_ids = output_query.find(locations=["Country"])
+            series = output_query.series(location_ids, channel="cumulative")
+        self.assertEqual(len(location_ids), 2)
+        self.assertEqual([location["values"] for location in series["locations"]],
+                         [[5, 6, 4], [7, 8, 9]])
+
+    def test_derived_metrics(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, derived=True).process_all()
+            outputs = read_outputs(output_dir)
+        globe = json.loads(outputs["confirmed.json"])
+        index = json.loads(outputs["confirmed.derived.json"])
+        self.assertEqual(index["shape"], [len(globe["locations"]), 3, 4])
+        values = numpy.frombuffer(outputs[index["blob"]], dtype=index["dtype"]).reshape(index["shape"])
+        for location_idx, location in enumerate(globe["locations"]):
+            day = [day_values[1] for day_values in location["values"]]
+            population = location["population_2020"]
+            for day_idx, day_values in enumerate(location["values"]):
+                expected = [numpy.mean(day[max(0, day_idx - 6):day_idx + 1]),
+                            numpy.mean(day[max(0, day_idx - 13):day_idx + 1])]
+                expected.append(expected[0] * 100000 / population if population else 0)
+                expected.append(day_values[0] * 100000 / population if population else 0)
+                numpy.testing.assert_allclose(values[location_idx, day_idx], expected, rtol=1e-6)
+        # Only "Country" has population, the hidden US row is not a top
+        self.assertEqual([day_stats["top_cumulative_per_100k"]["location_idx"] for day_stats in index["series_stats"]],
+                         [0, 0, 0])
+        self.assertNotIn(1, [day_stats["top_day_avg_7"]["location_idx"] for day_stats in index["series_stats"]])
+
+    def test_lod_clusters_sum_their_locations(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, lod=True, lod_level=3).process_all()
+            outputs = read_outputs(output_dir)
+        globe = json.loads(outputs["confirmed.json"])
+        index = json.loads(outputs["confirmed.lod.json"])
+        values = numpy.frombuffer(outputs[index["blob"]], dtype=index["dtype"]).reshape(index["shape"])
+        self.assertEqual([level["count"] for level in index["levels"]], [[4], [2, 2], [2, 2], [1, 1, 2]])
+        # The hidden US row is not in any cluster
+        self.assertEqual(index["levels"][-1]["locations"], [[2], [0], [3, 4]])
+        location_values = numpy.array([location["values"] for location in globe["locations"]
+                                       if len(location["values"][0]) == 3])
+        for level in index["levels"]:
+            level_values = values[level["offset"]:level["offset"] + len(level["count"])]
+            numpy.testing.assert_array_equal(level_values.sum(axis=0), location_values.sum(axis=0))
+        finest = index["levels"][-1]
+        for cell, location_ids in enumerate(finest["locations"]):
+            numpy.testing.assert_array_equal(values[finest["offset"] + cell], numpy.sum(
+                [globe["locations"][location_id]["values"] for location_id in location_ids], axis=0))
+        self.assertEqual(finest["parent"], [1, 1, 0])
+
+    def test_combined_output_shares_locations(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            tags_file = os.path.join(output_dir, "state", "outputs.json")
+            offline_helper(output_dir, output_format="binary", combined=True,
+                           output_tags=OutputTags(tags_file)).process_all(workers=2)
+            outputs = read_outputs(output_dir)
+            csse_helper = offline_helper(output_dir, output_format="binary", combined=True,
+                                         output_tags=OutputTags(tags_file))
+            csse_helper.process_all()
+            self.assertEqual(csse_helper.metrics.outputs["combined"], "reused")
+        with self.assertRaises(ValueError):
+            offline_helper(output_dir, combined=True)
+        combined = json.loads(outputs["combined.json"])
+        self.assertEqual([location["location"] for location in combined["locations"]], [
+            "Country", "US", "Other - Some Province", "US - Alabama - Autauga", "US - Alabama - Baldwin"])
+        self.assertEqual(combined["locations"][1]["hidden"], 1)
+        values = numpy.frombuffer(outputs["combined.bin"], dtype=combined["dtype"])
+        for metric in ("confirmed", "deaths", "recovered"):
+            index = json.loads(outputs["{}.index.json".format(metric)])
+            metric_struct = combined["metrics"][metric]
+            self.assertEqual([combined["locations"][location_id]["location"] for location_id in metric_struct["location_ids"]],
+                             [location["location"] for location in index["locations"]])
+            self.assertEqual(metric_struct["series_stats"], index["series_stats"])
+            size = numpy.prod(metric_struct["shape"])
+            self.assertEqual(values[metric_struct["offset"]:metric_struct["offset"] + size].tobytes(),
+                             outputs[index["blob"]])
+        # The recovered file has no US counties
+        self.assertEqual(combined["metrics"]["recovered"]["location_ids"], [0, 1, 2])
+
+    def test_combined_output_of_metrics_generated_without_it(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            tags_file = os.path.join(output_dir, "state", "outputs.json")
+
+            def run(appended, combined):
+                csse_helper = offline_helper(output_dir, output_format="binary", combined=combined,
+                                             output_tags=OutputTags(tags_file))
+                if appended:
+                    for dataset_attribute in ("global_confirmed_dataset", "global_deaths_dataset",
+                                              "global_recovered_dataset", "us_confirmed_dataset",
+                                              "us_deaths_dataset"):
+                        setattr(csse_helper, dataset_attribute,
+                                appended_day(getattr(csse_helper, dataset_attribute)))
+                csse_helper.process_all()
+                return csse_helper.metrics.outputs
+            self.assertEqual(run(False, True)["combined"], "generated")
+            # Upstream appends a day, the metrics are generated without the combined output
+            self.assertEqual(set(run(True, False).values()), {"generated"})
+            outputs = run(True, True)
+            self.assertEqual(set(outputs[metric] for metric in ("confirmed", "deaths", "recovered")),
+                             {"reused"})
+            self.assertEqual(outputs["combined"], "generated")
+            self.assertEqual(run(True, True)["combined"], "reused")
+            written = read_outputs(output_dir)
+        combined = json.loads(written["combined.json"])
+        self.assertEqual(combined["date_keys"], json.loads(written["confirmed.index.json"])["date_keys"])
+        self.assertEqual(len(combined["date_keys"]), 4)
+
+    def test_binary_output_matches_json(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, output_format="both").process_all()
+            for name in ("confirmed", "deaths", "recovered"):
+                with open(os.path.join(output_dir, "{}.json".format(name))) as file_handle:
+                    globe_json = json.load(file_handle)
+                with open(os.path.join(output_dir, "{}.index.json".format(name))) as file_handle:
+                    index = json.load(file_handle)
+                blob = numpy.fromfile(os.path.join(output_dir, index["blob"]), dtype=index["dtype"])
+                values = blob.reshape(index["shape"])
+                self.assertEqual(index["series_stats"], globe_json["series_stats"])
+                self.assertEqual(len(index["locations"]), len(globe_json["locations"]))
+                for location_idx, location_struct in enumerate(globe_json["locations"]):
+                    hidden = [day_values[3:] for day_values in location_struct["values"]]
+                    self.assertEqual(index["locations"][location_idx].pop("hidden", 0) == 1, hidden[0] == [1])
+                    self.assertEqual(values[location_idx].tolist(), [
+                                     day_values[:3] for day_values in location_struct.pop("values")])
+                    self.assertEqual(index["locations"][location_idx], location_struct)
+
+    def test_tiles_match_json(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(output_dir, tiles=True, tile_days=2).process_all()
+            with open(os.path.join(output_dir, "confirmed.json")) as file_handle:
+                globe_json = json.load(file_handle)
+            with open(os.path.join(output_dir, "confirmed.manifest.json")) as file_handle:
+                manifest = json.load(file_handle)
+            self.assertEqual([tile["days"] for tile in manifest["tiles"]], [2, 1])
+            series_stats = []
+            values = [[] for _location in manifest["locations"]]
+            for tile_entry in manifest["tiles"]:
+                with open(os.path.join(output_dir, tile_entry["file"]), "rb") as file_handle:
+                    content = file_handle.read()
+                self.assertEqual(hashlib.sha256(content).hexdigest(), tile_entry["sha256"])
+                tile = json.loads(content)
+                self.assertEqual(tile["first_day_index"], len(series_stats))
+                series_stats.extend(tile["series_stats"])
+                for location_idx, location_values in enumerate(tile["values"]):
+                    values[location_idx].extend(location_values)
+            self.assertEqual(series_stats, globe_json["series_stats"])
+            self.assertEqual(values, [[day_values[:3] for day_values in location_struct["values"]]
+                                      for location_struct in globe_json["locations"]])
+
+    def test_compact_json_decodes_to_json(self):
+        with tempfile.TemporaryDirectory() as json_dir, tempfile.TemporaryDirectory() as compact_dir:
+            offline_helper(json_dir).process_all()
+            offline_helper(compact_dir, compact=True).process_all()
+            for name in ("confirmed", "deaths", "recovered"):
+                with open(os.path.join(json_dir, "{}.json".format(name))) as file_handle:
+                    globe_json = json.load(file_handle)
+                with open(os.path.join(compact_dir, "{}.json".format(name))) as file_handle:
+                    compact_json = json.load(file_handle)
+                self.assertEqual(compact_json["schema_version"], 2)
+                self.assertEqual(compact_json["series_stats"], globe_json["series_stats"])
+                for location_idx, location_struct in enumerate(globe_json["locations"]):
+                    compact_location = compact_json["locations"][location_idx]
+                    cumulative = [0] * compact_location["offset"] + numpy.cumsum(
+                        compact_location["values"], dtype=numpy.int64).tolist()
+                    day = numpy.diff(cumulative, prepend=0)
+                    delta = numpy.diff(day, prepend=day[:1])
+                    self.assertEqual(numpy.stack((cumulative, day, delta), axis=1).tolist(), [
+                        day_values[:3] for day_values in location_struct["values"]])
+                    self.assertEqual(compact_location["population_2020"], location_struct["population_2020"])
+
+    def test_streamed_json_matches_json_dumps(self):
+        csse_handler = CSSEGISandData(logger)
+        gps_records = csse_handler.parse_csv_file_contents(GLOBAL_CSV)
+        population = {"Country": 100}
+        expected = dict()
+        expected["locations"] = list(
+            csse_handler.generate_location_structs(gps_records, population))
+        expected["series_stats"] = csse_handler.get_series_stats(gps_records, population, 100)
+        self.assertEqual("".join(csse_handler.generate_globe_json_chunks(
+            gps_records, population, 100)), json.dumps(expected))
+
+    def test_interrupted_write_keeps_previous_file(self):
+        def failing_chunks():
+            yield '{"locations": ['
+            raise RuntimeError("Interrupted")
+        with tempfile.TemporaryDirectory() as output_dir:
+            filename = os.path.join(output_dir, "confirmed.json")
+            utils.write_to_file(filename, "{}")
+            with self.assertRaises(RuntimeError):
+                utils.write_chunks_to_file(filename, failing_chunks())
+            self.assertEqual(read_outputs(output_dir), {"confirmed.json": b"{}"})
+
+
+class TestDownloads(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.url = "{}/confirmed.csv".format(self.base_url)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        StandInHandler.full_responses = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def test_conditional_get_reuses_cached_body(self):
+        cache = DownloadCache(self.cache_dir.name)
+        self.assertEqual(cache.get(self.url), StandInHandler.files["/confirmed.csv"])
+        self.assertEqual(cache.get(self.url), StandInHandler.files["/confirmed.csv"])
+        self.assertEqual(StandInHandler.full_responses, 1)
+
+    def test_offline_uses_only_the_cache(self):
+        offline_cache = DownloadCache(self.cache_dir.name, offline=True)
+        with self.assertRaises(FileNotFoundError):
+            offline_cache.get(self.url)
+        DownloadCache(self.cache_dir.name).get(self.url)
+        self.server.shutdown()
+        self.assertEqual(offline_cache.get(self.url), StandInHandler.files["/confirmed.csv"])
+        self.assertEqual(StandInHandler.full_responses, 1)
+
+    def test_population_file_avoids_download_until_stale(self):
+        population_file = os.path.join(self.cache_dir.name, "world_population.json")
+        for max_age, expected_responses in ((3600, 1), (3600, 1), (-1, 2)):
+            world_pop_handler = WorldOMeters(population_file=population_file, max_age=max_age)
+            world_pop_handler.global_population_url = "{}/population".format(self.base_url)
+            world_pop_handler.load_default_datasources()
+            self.assertEqual(world_pop_handler.global_population_dataset, {"Country": 100})
+            self.assertEqual(StandInHandler.full_responses, expected_responses)
+
+    def test_concurrent_downloads_from_stand_in_server(self):
+        csv_content = StandInHandler.files["/confirmed.csv"]
+        for name in ("confirmed_global", "deaths_global", "recovered_global", "confirmed_US", "deaths_US"):
+            StandInHandler.files["/time_series_covid19_{}.csv".format(name)] = csv_content
+        csse_helper = CSSEGISandDataHelper(
+            logger, base_url=self.base_url, load_population=False)
+        csse_helper.world_pop_handler.global_population_url = "{}/population".format(self.base_url)
+        csse_helper.load_default_datasources()
+        self.assertEqual(csse_helper.global_confirmed_dataset, csv_content)
+        self.assertEqual(csse_helper.us_deaths_dataset, csv_content)
+        self.assertEqual(csse_helper.global_population_dataset, {"Country": 100})
+        self.assertEqual(csse_helper.global_population, 100)
+        self.assertEqual(len(csse_helper.download_timings), 6)
+
+    def test_streamed_parsing_matches_downloaded(self):
+        for name, content in (("confirmed_global", GLOBAL_CSV), ("deaths_global", GLOBAL_CSV),
+                              ("recovered_global", GLOBAL_CSV), ("confirmed_US", US_CONFIRMED_CSV),
+                              ("deaths_US", US_DEATHS_CSV)):
+            StandInHandler.files["/time_series_covid19_{}.csv".format(name)] = content
+        with tempfile.TemporaryDirectory() as expected_dir, tempfile.TemporaryDirectory() as output_dir:
+            offline_helper(expected_dir).process_all()
+            for offline, engine in ((False, "dict"), (False, "numpy"), (True, "numpy")):
+                cache = DownloadCache(self.cache_dir.name, offline=offline)
+                csse_helper = offline_helper(
+                    output_dir, engine=engine, cache=cache, base_url=self.base_url, stream=True)
+                for dataset_attribute in ("global_confirmed_dataset", "global_deaths_dataset",
+                                          "global_recovered_dataset", "us_confirmed_dataset",
+                                          "us_deaths_dataset"):
+                    setattr(csse_helper, dataset_attribute, None)
+                csse_helper.process_all()
+                self.assertEqual(read_outputs(output_dir), read_outputs(expected_dir))
+                # The cached copies are revalidated, the bodies are only sent once
+                self.assertEqual(StandInHandler.full_responses, 5)
+                self.assertEqual(csse_helper.metrics.summary()["parse"]["bytes_in"], 3 * len(GLOBAL_CSV) +
+                                 len(US_CONFIRMED_CSV) + len(US_DEATHS_CSV))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_files_parse(self):
+        global_handler = CSSEGISandData(logger, engine="numpy")
+        global_records = global_handler.parse_csv_file_contents(
+            benchmark.generate_global_csv(12, 40))
+        self.assertEqual(global_records.cumulative.shape, (12, 40))
+        self.assertEqual(global_handler.date_keys[0], "20-01-22")
+        self.assertIn("Country 2 - Province 10", global_records.locations)
+        self.assertTrue((global_records.day >= 0).all())
+        us_handler = CSSEGISandData(
+            logger, USFileType=True, offset_dates=12, engine="numpy")
+        us_records = us_handler.parse_csv_file_contents(
+            benchmark.generate_us_csv(7, 40, population_column=True))
+        self.assertEqual(us_records.cumulative.shape, (7, 40))
+        self.assertEqual(us_handler.date_keys, global_handler.date_keys)
+
+    def test_benchmark_report(self):
+        bench = benchmark.Benchmark(locations=10, us_locations=5, dates=20, repeat=1,
+                                    memory=False)
+        bench.run()
+        report = json.loads(json.dumps(bench.report()))
+        self.assertEqual(len(report["results"]), 16)
+        self.assertEqual(set(result["engine"] for result in report["results"]), {
+                         "dict", "numpy"})
+        comparison = benchmark.compare_results(report, report)
+        self.assertEqual([speedup for _name, _engine, _previous, _current, speedup in comparison],
+                         [1.0] * 16)
+
+
+class TestServe(unittest.TestCase):
+
+    def test_refresh_and_serve_from_memory(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            store = serve.OutputStore()
+            output_tags = OutputTags()
+            metrics_file = os.path.join(output_dir, "metrics.json")
+            daemon = serve.RefreshDaemon(lambda: offline_helper(output_dir, tiles=True, output_tags=output_tags),
+                                         store, output_dir, metrics_file=metrics_file,
+                                         exclude=[os.path.join(output_dir, "state"), metrics_file])
+            # load_default_datasources would download, the datasets are already loaded
+            with unittest.mock.patch.object(CSSEGISandDataHelper, "load_default_datasources"):
+                self.assertTrue(daemon.refresh())
+                self.assertFalse(daemon.refresh())
+            server = HTTPServer(("127.0.0.1", 0), serve.make_handler(store))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = "http://127.0.0.1:{}".format(server.server_port)
+            session = requests.Session()
+            try:
+                response = session.get("{}/data/confirmed.json".format(base_url))
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertEqual(response.headers["Cache-Control"], serve.REVALIDATE_CACHE_CONTROL)
+                with open(os.path.join(output_dir, "confirmed.json"), "rb") as file_handle:
+                    self.assertEqual(response.content, file_handle.read())
+                revalidated = session.get("{}/data/confirmed.json".format(base_url),
+                                          headers={"If-None-Match": response.headers["ETag"]})
+                self.assertEqual(revalidated.status_code, 304)
+                identity = session.get("{}/data/confirmed.json".format(base_url),
+                                       headers={"Accept-Encoding": "identity"})
+                self.assertNotIn("Content-Encoding", identity.headers)
+                self.assertNotEqual(identity.headers["ETag"], response.headers["ETag"])
+                manifest = session.get("{}/data/confirmed.manifest.json".format(base_url)).json()
+                tile = session.get("{}/data/{}".format(base_url, manifest["tiles"][0]["file"]))
+                self.assertEqual(tile.headers["Cache-Control"], serve.IMMUTABLE_CACHE_CONTROL)
+                self.assertEqual(session.get("{}/data/missing.json".format(base_url)).status_code, 404)
+                self.assertTrue(os.path.exists(metrics_file))
+                self.assertEqual(session.get("{}/data/metrics.json".format(base_url)).status_code, 404)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+
 if __name__ == '__main__':
     unittest.main()
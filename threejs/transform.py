@@ -9,18 +9,174 @@ TODO:
       We should find a way to find consistency between datasets to avoid this confusion.
 """
 
+import argparse
+import json
 import logging
+import os
 from CSSEGISandData import CSSEGISandDataHelper
+from download_cache import DEFAULT_TIMEOUT, DownloadCache, create_session
+from local_source import LocalSource
+from lod import DEFAULT_LOD_LEVEL
+from output_tags import OutputTags
+import query
+import serve
+from world_population import DEFAULT_POPULATION_MAX_AGE
 
 
-def main():
+def parse_args(argv=None):
+    """
+    Parses the command line arguments
+    :param argv list: The arguments, by default sys.argv is used
+    """
+    parser = argparse.ArgumentParser(
+        description="Transforms the CSSEGISandData time series into the globe JSON files")
+    parser.add_argument("--engine", choices=["dict", "numpy"], default="dict",
+                        help="dict builds a dict per location-day, numpy parses into columnar matrices")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only calculate the stats of the days appended upstream since the previous run, the outputs are still written in full")
+    parser.add_argument("--state-dir", default="data/state",
+                        help="Where the state between incremental runs is kept")
+    parser.add_argument("--cache-dir",
+                        help="Cache the downloads in this directory and use conditional requests")
+    parser.add_argument("--offline", action="store_true",
+                        help="Run only from the downloads in --cache-dir, without network access")
+    parser.add_argument("--source-dir",
+                        help="Read the time series from a local clone of the CSSEGISandData repo instead of downloading them")
+    parser.add_argument("--base-url",
+                        help="Download the time series CSVs from this URL instead of github")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="Timeout in seconds of each download request")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Retries of each download request, with exponential backoff")
+    parser.add_argument("--population-file", default="data/world_population.json",
+                        help="Where the parsed population table is kept between runs")
+    parser.add_argument("--population-max-age", type=float, default=DEFAULT_POPULATION_MAX_AGE,
+                        help="Seconds after which the population table is downloaded again")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Process confirmed, deaths and recovered in parallel with this many processes")
+    parser.add_argument("--format", choices=["json", "binary", "both"], default="json",
+                        help="json writes data/<name>.json, binary writes data/<name>.index.json and data/<name>.bin")
+    parser.add_argument("--compact", action="store_true",
+                        help="Write the JSON in the compact schema: delta-encoded cumulative values only")
+    parser.add_argument("--tiles", action="store_true",
+                        help="Also write date tiles of the values and stats with a manifest, data/<name>.manifest.json")
+    parser.add_argument("--tile-days", type=int,
+                        help="Days per tile, by default there is a tile per month")
+    parser.add_argument("--rollups", action="store_true",
+                        help="Group the locations by country, drop the aggregated US row and write data/<name>.countries.json")
+    parser.add_argument("--rankings", type=int, metavar="K",
+                        help="Also write the K top locations of each day and metric into data/<name>.rankings.json")
+    parser.add_argument("--derived", action="store_true",
+                        help="Also write the 7/14 day rolling means and per 100k rates into data/<name>.derived.json/.bin")
+    parser.add_argument("--lod", action="store_true",
+                        help="Also write the quadtree clusters of the locations for the globe into data/<name>.lod.json/.bin")
+    parser.add_argument("--lod-level", type=int, default=DEFAULT_LOD_LEVEL,
+                        help="The finest quadtree level of --lod, it has 2^level x 2^level cells")
+    parser.add_argument("--combined", action="store_true",
+                        help="Also join the binary outputs of all the metrics into data/combined.json/.bin, it needs --format binary or both")
+    parser.add_argument("--snapshot-dir",
+                        help="Keep the parsed values of each run in this directory, see snapshots.py")
+    parser.add_argument("--stream", action="store_true",
+                        help="Parse each time series line by line as it's downloaded instead of downloading them first")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep running: regenerate the outputs when the sources change and serve them over HTTP")
+    parser.add_argument("--host", default="",
+                        help="The address --serve listens on, all of them by default")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="The port --serve listens on")
+    parser.add_argument("--interval", type=float, default=3600,
+                        help="Seconds between the checks of the sources with --serve")
+    parser.add_argument("--force", action="store_true",
+                        help="Regenerate all the outputs, even those whose inputs didn't change since the last run")
+    parser.add_argument("--metrics-file", default="data/metrics.json",
+                        help="Where the time, sizes and peak RSS of each stage of the run are written")
+    subparsers = parser.add_subparsers(dest="command")
+    query_parser = subparsers.add_parser(
+        "query", help="Query the binary outputs instead of transforming, see query.py")
+    query_parser.add_argument("name", help="The output, i.e. confirmed")
+    query_parser.add_argument("--location", nargs="+", default=[],
+                              help="The \"Country - Province\" names of the locations")
+    query_parser.add_argument("--country", nargs="+", default=[],
+                              help="Include all the locations of these countries")
+    query_parser.add_argument("--start",
+                              help="The first date, YY-MM-DD or YYYY-MM-DD")
+    query_parser.add_argument("--end",
+                              help="The last date, YY-MM-DD or YYYY-MM-DD")
+    query_parser.add_argument("--channel", choices=["cumulative", "day", "delta"], default="day",
+                              help="The values to return")
+    query_parser.add_argument("--aggregate", choices=query.AGGREGATES,
+                              help="Aggregate the values of the date range instead of returning them")
+    query_parser.add_argument("--data-dir", default="data",
+                              help="The directory of the outputs")
+    args = parser.parse_args(argv)
+    if args.offline and not args.cache_dir:
+        parser.error("--offline requires --cache-dir")
+    if args.combined and args.format == "json":
+        parser.error("--combined requires --format binary or both")
+    return args
+
+
+def run_query(args):
+    """
+    Prints the result of a query subcommand as JSON
+    """
+    output_query = query.OutputQuery(args.data_dir, args.name)
+    location_ids = output_query.find(
+        locations=args.location, countries=args.country)
+    if args.aggregate:
+        res = output_query.aggregate(location_ids, start=args.start, end=args.end,
+                                     channel=args.channel, function=args.aggregate)
+    else:
+        res = output_query.series(
+            location_ids, start=args.start, end=args.end, channel=args.channel)
+    print(json.dumps(res))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "query":
+        run_query(args)
+        return
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("main transform")
-    csse_handler = CSSEGISandDataHelper(logger)
+    state_dir = args.state_dir if args.incremental else None
+    session = create_session(retries=args.retries)
+    cache = None
+    if args.cache_dir:
+        cache = DownloadCache(args.cache_dir, offline=args.offline,
+                              session=session, timeout=args.timeout)
+    local_source = None
+    if args.source_dir:
+        local_source = LocalSource(args.source_dir, state_file=os.path.join(
+            args.state_dir, "sources.json"))
+    # The outputs whose inputs didn't change since the last run are skipped
+    output_tags = OutputTags(os.path.join(args.state_dir, "outputs.json"))
+    if args.force:
+        # Nothing is reused, but the new tags are still saved for the next run
+        output_tags.tags = dict()
+
+    def create_helper():
+        # The population is downloaded along with the time series in load_default_datasources
+        return CSSEGISandDataHelper(
+            logger, engine=args.engine, state_dir=state_dir, cache=cache, base_url=args.base_url,
+            session=session, timeout=args.timeout, load_population=False, output_format=args.format,
+            tiles=args.tiles, tile_days=args.tile_days, compact=args.compact,
+            population_file=args.population_file, population_max_age=args.population_max_age,
+            stream=args.stream, local_source=local_source, output_tags=output_tags,
+            rollups=args.rollups, rankings=args.rankings,
+            snapshot_dir=args.snapshot_dir, derived=args.derived,
+            lod=args.lod, lod_level=args.lod_level, combined=args.combined)
+    if args.serve:
+        # Only the outputs are served, not the files kept between runs
+        exclude = [args.state_dir, args.metrics_file, args.population_file]
+        exclude.extend(path for path in (args.cache_dir, args.snapshot_dir) if path)
+        serve.serve(create_helper, "data", host=args.host, port=args.port, interval=args.interval,
+                    workers=args.workers, metrics_file=args.metrics_file, exclude=exclude)
+        return
+    csse_handler = create_helper()
     csse_handler.load_default_datasources()
-    csse_handler.process_confirmed()
-    csse_handler.process_deaths()
-    csse_handler.process_recovered()
+    csse_handler.process_all(workers=args.workers)
+    csse_handler.metrics.write(args.metrics_file)
 
 
 if __name__ == "__main__":
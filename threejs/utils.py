@@ -2,16 +2,72 @@
 Shared utils for dataset handling
 """
 import logging
+import os
+import tempfile
 
 
 def write_to_file(filename, content):
     """
     Writes some input content into an input filename
     """
+    write_chunks_to_file(filename, [content])
+
+
+def write_chunks_to_file(filename, chunks, mode="w", staged=None):
+    """
+    Writes the chunks one at a time into a temporary file in the same directory
+    and renames it into place, so readers never see a partially written file.
+    :param filename str: The destination file
+    :param chunks iterable: The str (or bytes for mode "wb") pieces of the content
+    :param mode str: "w" for text, "wb" for binary chunks
+    :param staged list: When given, the temporary file is not renamed, (temporary path, filename)
+                        is appended to it instead, see commit_staged_files
+    :returns int: The number of bytes written
+    """
     logging.info("INIT Writing %s", filename)
-    with open(filename, "w") as file_handle:
-        file_handle.write(content)
+    directory = os.path.dirname(filename) or "."
+    file_descriptor, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=".{}.".format(os.path.basename(filename)), suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, mode) as file_handle:
+            for chunk in chunks:
+                file_handle.write(chunk)
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+            written = os.fstat(file_handle.fileno()).st_size
+        # mkstemp creates the file readable only by its owner
+        os.chmod(tmp_path, 0o644)
+        if staged is None:
+            os.replace(tmp_path, filename)
+        else:
+            staged.append((tmp_path, filename))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
     logging.info("DONE writing %s", filename)
+    return written
+
+
+def commit_staged_files(staged):
+    """
+    Renames the staged files into place in the order they were written
+    :param staged list: (temporary path, filename), a None temporary path removes the file
+    """
+    for tmp_path, filename in staged:
+        if tmp_path is None:
+            if os.path.exists(filename):
+                os.remove(filename)
+        else:
+            os.replace(tmp_path, filename)
+
+
+def discard_staged_files(staged):
+    """
+    Removes the temporary files of staged files that won't be committed
+    """
+    for tmp_path, _filename in staged:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
 def merge_dict(lhs, rhs):
     """
@@ -6,10 +6,15 @@ Library for parsing the data from: https://www.worldometers.info/
 import logging
 import csv
 import json
+import os
+import time
 import requests
-from bs4 import BeautifulSoup
+from io import StringIO
 from pprint import pprint
-import pandas
+import utils
+
+# The population table is refreshed after a week by default
+DEFAULT_POPULATION_MAX_AGE = 7 * 24 * 3600
 
 
 class WorldOMeters:
@@ -17,11 +22,23 @@ class WorldOMeters:
     Handles the population-by-country from worldometers.
     """
 
-    def __init__(self):
+    def __init__(self, cache=None, session=None, timeout=None, population_file=None,
+                 max_age=DEFAULT_POPULATION_MAX_AGE):
         """
         Sets up initial variables on the source of the data
+        :param cache DownloadCache: When set, the download goes through this cache
+        :param session requests.Session: The session used for the request
+        :param timeout float: The timeout in seconds of the request
+        :param population_file str: Where the parsed population table is persisted, when set
+               the page is only downloaded and parsed when the file is missing or stale
+        :param max_age float: The seconds after which the population_file is refreshed
         """
         self.logger = logging.getLogger("world_population")
+        self.cache = cache
+        self.population_file = population_file
+        self.max_age = max_age
+        self.session = session if session is not None else requests.Session()
+        self.timeout = timeout
         raw_https_base_url = "www.worldometers.info/world-population/"
         self.global_population_url = "https://{}/{}".format(
             raw_https_base_url,
@@ -33,12 +50,83 @@ class WorldOMeters:
         The data is loaded into strings which can later be parsed
         """
         self.logger.info("INIT load_default_datasources")
+        if self.load_population_file():
+            self.logger.info("DONE load_default_datasources")
+            return
         self.logger.debug("Downloading Global Population from %s",
                           self.global_population_url)
-        global_population_req = requests.get(self.global_population_url)
-        soup = BeautifulSoup(global_population_req.content, features="html.parser")
+        try:
+            content = self.download()
+        except (requests.RequestException, OSError):
+            # A stale table is better than no table
+            if self.load_population_file(ignore_age=True):
+                self.logger.warning(
+                    "Unable to refresh the population, using %s", self.population_file)
+                self.logger.info("DONE load_default_datasources")
+                return
+            raise
+        self.parse_population_page(content)
+        self.logger.info("DONE load_default_datasources")
+
+    def load_population_file(self, ignore_age=False):
+        """
+        Loads global_population_dataset from the persisted population_file
+        :param ignore_age bool: Load it even when it's older than max_age
+        :returns bool: True if the population was loaded
+        """
+        if not self.population_file:
+            return False
+        try:
+            with open(self.population_file) as file_handle:
+                population_table = json.load(file_handle)
+        except (OSError, ValueError):
+            return False
+        age = time.time() - population_table.get("fetched_at", 0)
+        if not ignore_age and age > self.max_age:
+            self.logger.info("The population file %s is %.0f seconds old, refreshing",
+                             self.population_file, age)
+            return False
+        self.global_population_dataset = population_table["population"]
+        return True
+
+    def save_population_file(self):
+        """
+        Persists global_population_dataset into population_file
+        """
+        population_table = dict()
+        population_table["url"] = self.global_population_url
+        population_table["fetched_at"] = time.time()
+        population_table["population"] = {str(country): int(population)
+                                          for country, population in self.global_population_dataset.items()}
+        directory = os.path.dirname(self.population_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        utils.write_to_file(self.population_file,
+                            json.dumps(population_table))
+
+    def download(self):
+        """
+        Returns the population page, through the cache if there is one
+        """
+        if self.cache is not None:
+            return self.cache.get(self.global_population_url)
+        response = self.session.get(
+            self.global_population_url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def parse_population_page(self, content):
+        """
+        Parses the population-by-country table into global_population_dataset
+        The table is persisted into population_file when there is one.
+        :param content bytes: The HTML of the population page
+        """
+        # These are slow to import, they are only needed when the page is parsed
+        from bs4 import BeautifulSoup
+        import pandas
+        soup = BeautifulSoup(content, features="html.parser")
         countries = soup.find_all("table")[0]
-        data_frame = pandas.read_html(str(countries))[0]
+        data_frame = pandas.read_html(StringIO(str(countries)))[0]
         # The data frame data looks like:
         #        # Country (or dependency)  Population (2020) Yearly Change  Net Change  Density (P/Km_)  Land Area (Km_)  Migrants (net) Fert. Rate Med. Age Urban Pop % World Share
         # 0      1                   China         1439323776        0.39 %     5540090              153          9388211       -348399.0        1.7       38        61 %     18.47 %
@@ -51,7 +139,8 @@ class WorldOMeters:
             res[country] = populations[row_number]
             row_number+=1
         self.global_population_dataset = res
-        self.logger.info("DONE load_default_datasources")
+        if self.population_file:
+            self.save_population_file()
 
     def parse_header(self, header_array, USFileType=False):
         """